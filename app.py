@@ -19,22 +19,316 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from flask import Flask, Response, request, redirect, url_for, \
     send_from_directory, jsonify
+from werkzeug.datastructures import MultiDict
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as wait_futures
+import fcntl
+import glob
+import hashlib
+import itertools
 import json
+import math
 import os
 import re
 import requests
+import string
 import subprocess
+import threading
+import time
 import traceback
+from typing import Dict, List, Optional, Tuple
+
+from cache import SharedCache
+from projection import Projection, parse_fields, project_results, stream_projected
+
+DATA = '/srv/hound'
 
 app = Flask(__name__)
 if os.path.exists('/etc/codesearch_ports.json'):
     with open('/etc/codesearch_ports.json') as f:
         app.config['PORTS'] = json.load(f)
+# Optional tunables, see the defaults below
+if os.path.exists('/etc/codesearch_config.json'):
+    with open('/etc/codesearch_config.json') as f:
+        app.config.update(json.load(f))
+# Logical backends that are split across several hound instances, as
+# written by write_config.py --shards, and instances that live on other
+# hosts, as "host:port" in PORTS, as placed by write_config.py --nodes.
+# Both are reread whenever write_config.py rewrites them.
+app.config.setdefault('PORTS', {})
+app.config.setdefault('SHARDS', {})
+# Seconds to wait for all shards of a backend before answering with
+# whatever results are in
+app.config.setdefault('SHARD_TIMEOUT', 20)
+# Seconds between background health probes while someone is waiting on
+# /_health.json?wait=N, and the longest N that is honoured
+app.config.setdefault('HEALTH_INTERVAL', 2)
+app.config.setdefault('HEALTH_MAX_WAIT', 60)
+# Searches run against each hound instance every CANARY_INTERVAL seconds
+# (while health is being checked), by instance, logical backend or
+# 'default', e.g. {"default": [{"name": "core", "q": "wfGetDB", "repos":
+# "MediaWiki core"}]}. An instance whose canaries take longer than
+# CANARY_DEGRADED_SECONDS, or fail, is reported as "degraded".
+app.config.setdefault('CANARY_QUERIES', {})
+app.config.setdefault('CANARY_INTERVAL', 60)
+app.config.setdefault('CANARY_TIMEOUT', 30)
+app.config.setdefault('CANARY_DEGRADED_SECONDS', 5)
+# Where to remember how long indexing took, for estimating how long it will take
+app.config.setdefault('INDEXING_HISTORY', os.path.join(DATA, 'indexing-history.json'))
+# Seconds each /_metrics scrape may spend re-measuring changed data
+# directories (walks that take longer are spread over several scrapes),
+# and how many of the largest repos to report
+app.config.setdefault('DISK_SCAN_BUDGET', 1.0)
+app.config.setdefault('DISK_TOP_REPOS', 20)
+# Seconds between samples of hound's /proc stats, taken in the background
+# while /_metrics is being scraped
+app.config.setdefault('PROCESS_SAMPLE_INTERVAL', 15)
+# Directory for the response cache shared by all workers (disabled if unset),
+# how large it may grow, and how often to check whether an index changed
+app.config.setdefault('CACHE_DIR', None)
+app.config.setdefault('CACHE_MAX_BYTES', 256 * 1024 * 1024)
+app.config.setdefault('CACHE_REVALIDATE', 10)
+# Ports of the standby ("green") copies of instances, see write_config.py --blue-green
+app.config.setdefault('STANDBY_PORTS', {})
+# Token buckets for the search API, per backend name (or 'default'), e.g.
+# {"search": {"rate": 2, "burst": 20, "weight": 2}}. Clients sending a
+# known token in RATE_LIMIT_HEADER get a bucket under that token's name,
+# everyone else is limited by IP. Disabled when empty.
+app.config.setdefault('RATE_LIMITS', {})
+app.config.setdefault('RATE_LIMIT_HEADER', 'X-Codesearch-Token')
+app.config.setdefault('RATE_LIMIT_TOKENS', {})
+app.config.setdefault('RATE_LIMIT_TOP_CLIENTS', 10)
+# Most queries accepted in one POST to /_batch, and how many of them may
+# run against each backend at once (shared by all batches in a worker)
+app.config.setdefault('BATCH_MAX_QUERIES', 500)
+app.config.setdefault('BATCH_CONCURRENCY', 4)
+# Where saved queries and their last results are kept, and how many there
+# may be. Saving or deleting one takes a token from RATE_LIMIT_TOKENS, and
+# only the client that saved a query, or one of the names listed in
+# SAVED_QUERIES_ADMINS, may change it.
+app.config.setdefault('SAVED_QUERIES_DIR', os.path.join(DATA, 'saved-queries'))
+app.config.setdefault('SAVED_QUERIES_MAX', 1000)
+app.config.setdefault('SAVED_QUERIES_ADMINS', [])
+# Seconds after which saved queries against instances on other nodes are
+# run again, as their index can't be checked for changes from here
+app.config.setdefault('SAVED_QUERIES_MAX_AGE', 60 * 60)
 
 HIDDEN = ['armchairgm', 'shouthow', 'devtools']
+# Responses that only change when the index does
+CACHEABLE = ['', 'api/v1/search', 'api/v1/repos']
 HOUND_STARTUP = 'Hound is not ready.\n'
+# Bytes to read from hound at a time when trimming responses
+STREAM_CHUNK = 64 * 1024
+STARTING_UP_MSG = """
+Hound is still starting up, please wait a few minutes for the initial indexing
+to complete. See <https://codesearch.wmcloud.org/_health> for more
+information.
+"""
+UNAVAILABLE_MSG = """
+Unable to contact hound. If <https://codesearch.wmcloud.org/_health>
+says "starting up", please wait a few minutes for the initial indexing
+to complete.
+
+If this error continues, please report it in Phabricator
+with the following information:
+
+"""
+
+shared_cache: Optional[SharedCache] = None
+if app.config['CACHE_DIR']:
+    shared_cache = SharedCache(app.config['CACHE_DIR'], app.config['CACHE_MAX_BYTES'])
+
+
+class WatchedFile:
+    """A JSON file written by write_config.py, reread whenever it changes"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.mtime: Optional[float] = None
+        self.data: Optional[dict] = None
+
+    def load(self) -> bool:
+        """Reread the file if it changed, returning whether it did"""
+        try:
+            mtime = os.stat(os.path.join(DATA, self.name)).st_mtime
+            if mtime == self.mtime:
+                return False
+            with open(os.path.join(DATA, self.name)) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            if self.mtime is None and self.data is None:
+                return False
+            mtime, self.data = None, None
+        self.mtime = mtime
+        return True
+
+
+shards_file = WatchedFile('shards.json')
+placement_file = WatchedFile('placement.json')
+# PORTS as configured, before any placement on other nodes
+base_ports = dict(app.config['PORTS'])
+_topology_lock = threading.Lock()
+
+
+@app.before_request
+def reload_topology():
+    """Pick up shards and placement that changed since the last request"""
+    with _topology_lock:
+        if shards_file.load():
+            app.config['SHARDS'] = shards_file.data or {}
+        if placement_file.load():
+            app.config['PORTS'] = dict(base_ports, **(placement_file.data or {}).get('targets', {}))
+
+
+reload_topology()
+
+
+class RateLimiter:
+    """
+    Token buckets per client and backend. Every search costs some tokens
+    depending on how expensive it is likely to be, and buckets refill at a
+    steady rate up to their burst size. Buckets live in each worker, so
+    the effective limit scales with the number of workers.
+    """
+    # Keep memory bounded with many one-off clients
+    MAX_CLIENTS = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (client, backend) -> [tokens, last refill, rate, burst]
+        self.buckets: Dict[Tuple[str, str], List[float]] = {}
+        # client -> [tokens spent, times throttled]
+        self.usage: Dict[str, List[float]] = {}
+
+    def acquire(self, client: str, backend: str, cost: float, rate: float, burst: float) -> float:
+        """Take tokens from a bucket, or return how many seconds to wait"""
+        # Even the most expensive search has to fit in a full bucket
+        cost = min(cost, burst)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get((client, backend))
+            if bucket is None:
+                if len(self.buckets) >= self.MAX_CLIENTS:
+                    self.prune(now)
+                bucket = self.buckets[(client, backend)] = [burst, now, rate, burst]
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1:] = [now, rate, burst]
+            usage = self.usage.setdefault(client, [0.0, 0])
+            if bucket[0] < cost:
+                usage[1] += 1
+                return (cost - bucket[0]) / rate
+            bucket[0] -= cost
+            usage[0] += cost
+            return 0.0
+
+    def delay(self, client: str, backend: str, cost: float, rate: float, burst: float) -> float:
+        """How many seconds until a bucket has the tokens, without taking them"""
+        cost = min(cost, burst)
+        with self.lock:
+            bucket = self.buckets.get((client, backend))
+            if bucket is None:
+                return 0.0
+            tokens = min(burst, bucket[0] + (time.monotonic() - bucket[1]) * rate)
+            if tokens >= cost:
+                return 0.0
+            self.usage.setdefault(client, [0.0, 0])[1] += 1
+            return (cost - tokens) / rate
+
+    def prune(self, now: float):
+        """Forget buckets that have refilled, and the lightest clients"""
+        for key, (tokens, updated, rate, burst) in list(self.buckets.items()):
+            if tokens + (now - updated) * rate >= burst:
+                del self.buckets[key]
+        if len(self.usage) >= self.MAX_CLIENTS:
+            for client in sorted(self.usage, key=lambda c: self.usage[c][0])[:self.MAX_CLIENTS // 2]:
+                del self.usage[client]
+
+    def top(self, n: int) -> List[Tuple[str, float, float]]:
+        with self.lock:
+            heaviest = sorted(self.usage.items(), key=lambda item: item[1][0], reverse=True)[:n]
+        return [(client, spent, throttled) for client, (spent, throttled) in heaviest]
+
+
+rate_limiter = RateLimiter()
+
+
+def token_owner() -> Optional[str]:
+    """Name of the client if the request has a known token"""
+    token = request.headers.get(app.config['RATE_LIMIT_HEADER'])
+    if token and token in app.config['RATE_LIMIT_TOKENS']:
+        return app.config['RATE_LIMIT_TOKENS'][token]
+    return None
+
+
+def client_id() -> str:
+    """Who is making the request, for rate limiting purposes"""
+    owner = token_owner()
+    if owner is not None:
+        return owner
+    # The last hop was added by our own front proxy
+    return request.access_route[-1] if request.access_route else 'unknown'
+
+
+def hound_bool(value: Optional[str]) -> bool:
+    """Interpret a boolean query parameter the way hound does"""
+    return (value or '').lower() in ('true', '1', 'fosho')
+
+
+def query_cost(params) -> float:
+    """Guess how much work a search is for hound, relative to a simple one"""
+    q = params.get('q', '')
+    cost = 1.0
+    # Hound narrows candidate files down using trigrams, which doesn't
+    # help much for very short queries or those that are mostly regex
+    literal = hound_bool(params.get('literal'))
+    trigram_chars = q if literal else re.sub(r'\\.|[.*+?|()\[\]{}^$]', ' ', q)
+    if max((len(part) for part in trigram_chars.split()), default=0) < 3:
+        cost += 3
+    if params.get('repos', '*') in ('', '*'):
+        cost += 1
+    if hound_bool(params.get('i')):
+        cost += 0.5
+    return cost
+
+
+def rate_limits(backend: str, params) -> Optional[Tuple[float, float, float]]:
+    """The cost of a search and the rate and burst of the backend's limit"""
+    limits = app.config['RATE_LIMITS'].get(backend) or app.config['RATE_LIMITS'].get('default')
+    if not limits:
+        return None
+    return query_cost(params) * limits.get('weight', 1), limits['rate'], limits['burst']
+
+
+def rate_limit(backend: str, params, client: str) -> Optional[Response]:
+    """Charge the client for a search, returning a 429 if they're out of tokens"""
+    limits = rate_limits(backend, params)
+    if limits is None:
+        return None
+    delay = rate_limiter.acquire(client, backend, *limits)
+    if not delay:
+        return None
+    resp = Response("""
+Too many searches, please slow down. If you are running a tool against
+Codesearch and need a higher limit, please get in touch through Phabricator.
+""", 429, mimetype='text/plain')
+    resp.headers['Retry-After'] = str(math.ceil(delay))
+    return resp
+
+
+def rate_limit_delay(backend: str, params, client: str) -> float:
+    """How long until the client can afford a search, without charging them"""
+    limits = rate_limits(backend, params)
+    if limits is None:
+        return 0.0
+    return rate_limiter.delay(client, backend, *limits)
+
+
+# (shard name, outcome) -> [request count, total seconds], and shard
+# name -> requests that missed the fan out deadline
+_shard_latency: Dict[Tuple[str, str], List[float]] = {}
+_shard_timeouts: Dict[str, int] = {}
+_shard_lock = threading.Lock()
 
 
 @app.after_request
@@ -62,32 +356,718 @@ def parse_systemctl_show(output):
     return data
 
 
+def hound_url(backend: str) -> str:
+    """Base URL of the hound instance serving a (non-sharded) backend"""
+    if active_slot(backend) == 'green':
+        return f'http://{target(app.config["STANDBY_PORTS"][backend])}'
+    return f'http://{target(app.config["PORTS"][backend])}'
+
+
+def target(port) -> str:
+    """host:port for a PORTS entry, which is either a local port or host:port"""
+    return port if ':' in str(port) else f'localhost:{port}'
+
+
+def node(instance: str) -> str:
+    """Host an instance runs on"""
+    return target(app.config['PORTS'][instance]).rpartition(':')[0]
+
+
+def is_local(instance: str) -> bool:
+    """Whether an instance runs here, so that systemd and /proc can tell us about it"""
+    return node(instance) in ('localhost', '127.0.0.1', '::1', '[::1]')
+
+
+def active_slot(instance: str) -> str:
+    """
+    Which of the two copies of an instance is serving, 'blue' (the usual
+    hound-<name>) or 'green' (hound-<name>-green on STANDBY_PORTS), as
+    switched by write_config.py --blue-green
+    """
+    if instance not in app.config['STANDBY_PORTS']:
+        return 'blue'
+    try:
+        with open(os.path.join(DATA, f'hound-{instance}', 'active')) as f:
+            return 'green' if f.read().strip() == 'green' else 'blue'
+    except OSError:
+        return 'blue'
+
+
+def instance_name(instance: str) -> str:
+    """Name of the systemd unit and directory currently serving an instance"""
+    return f'hound-{instance}-green' if active_slot(instance) == 'green' else f'hound-{instance}'
+
+
+def instance_dir(instance: str) -> str:
+    if not is_local(instance):
+        # Where write_config.py --nodes put the config for another host
+        return os.path.join(DATA, 'nodes', node(instance), f'hound-{instance}')
+    return os.path.join(DATA, instance_name(instance))
+
+
+def is_backend(backend: str) -> bool:
+    return backend in app.config['PORTS'] or backend in app.config['SHARDS']
+
+
+def list_backends() -> List[str]:
+    """Backends in display order, with shards folded into their logical backend"""
+    shard_of = {shard: name for name, shards in app.config['SHARDS'].items()
+                for shard in shards}
+    backends: List[str] = []
+    for target in list(app.config['PORTS']) + list(app.config['SHARDS']):
+        target = shard_of.get(target, target)
+        if target not in backends:
+            backends.append(target)
+    return backends
+
+
+# hound instance -> (config.json mtime, repo names)
+_instance_repos: Dict[str, Tuple[float, set]] = {}
+
+
+def instance_repos(instance: str) -> Optional[set]:
+    """Names of the repos configured for a hound instance, or None if unknown"""
+    path = os.path.join(instance_dir(instance), 'config.json')
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    cached = _instance_repos.get(instance)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            cached = (mtime, set(json.load(f)['repos']))
+        _instance_repos[instance] = cached
+    return cached[1]
+
+
+def shard_for(backend: str, repo: Optional[str]) -> str:
+    """Pick the shard that indexes a repo, defaulting to the first one"""
+    shards = app.config['SHARDS'][backend]
+    if repo:
+        for shard in shards:
+            if repo in (instance_repos(shard) or ()):
+                return shard
+    return shards[0]
+
+
+def shard_params(shard: str, params: dict) -> Optional[dict]:
+    """
+    Narrow a repos= filter down to what the shard indexes,
+    or return None if the shard has nothing to contribute
+    """
+    wanted = params.get('repos', '*').strip()
+    repos = instance_repos(shard)
+    if wanted in ('', '*') or repos is None:
+        return params
+    mine = [repo for repo in wanted.split(',') if repo in repos]
+    if not mine:
+        return None
+    return dict(params, repos=','.join(mine))
+
+
+def record_shard_latency(shard: str, seconds: float, outcome: str):
+    """Count a request to a shard, by outcome: ok, error or timeout"""
+    with _shard_lock:
+        stats = _shard_latency.setdefault((shard, outcome), [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+
+def record_shard_timeout(shard: str):
+    with _shard_lock:
+        _shard_timeouts[shard] = _shard_timeouts.get(shard, 0) + 1
+
+
+def _fetch_shard(shard: str, path: str, params: dict) -> requests.Response:
+    start = time.monotonic()
+    outcome = 'error'
+    try:
+        r = requests.get(f'{hound_url(shard)}/{path}', params=params,
+                         timeout=app.config['SHARD_TIMEOUT'])
+        if r.status_code == 200:
+            outcome = 'ok'
+        return r
+    except requests.exceptions.Timeout:
+        outcome = 'timeout'
+        raise
+    finally:
+        record_shard_latency(shard, time.monotonic() - start, outcome)
+
+
+def shard_fanout(backend: str, path: str, params) -> Response:
+    """
+    Send a search or repo listing to every shard of a backend at once,
+    and merge whatever arrives before the deadline into a single
+    hound-style response.
+    """
+    params = params.to_dict()
+    shards = app.config['SHARDS'][backend]
+    targets = OrderedDict()
+    for shard in shards:
+        narrowed = shard_params(shard, params) if path == 'api/v1/search' else params
+        if narrowed is not None:
+            targets[shard] = narrowed
+    if not targets:
+        # None of the requested repos exist, let hound say so
+        targets = OrderedDict((shard, params) for shard in shards)
+
+    executor = ThreadPoolExecutor(max_workers=len(targets))
+    futures = OrderedDict(
+        (executor.submit(_fetch_shard, shard, path, narrowed), shard)
+        for shard, narrowed in targets.items()
+    )
+    done, _ = wait_futures(futures, timeout=app.config['SHARD_TIMEOUT'])
+    executor.shutdown(wait=False)
+
+    merged: dict = {}
+    stats: Optional[dict] = None
+    missing = []
+    starting_up = False
+    error = None
+    for future, shard in futures.items():
+        if future not in done:
+            record_shard_timeout(shard)
+            missing.append(shard)
+            continue
+        error = future.exception()
+        if error is not None:
+            missing.append(shard)
+            continue
+        r = future.result()
+        if r.text == HOUND_STARTUP:
+            starting_up = True
+            missing.append(shard)
+            continue
+        if r.status_code != 200:
+            # e.g. an invalid regex, which every shard rejects the same way
+            return Response(r.content, r.status_code,
+                            mimetype=r.headers.get('content-type', 'application/json'))
+        data = r.json()
+        if path == 'api/v1/repos':
+            merged.update(data)
+            continue
+        merged.update(data.get('Results') or {})
+        if 'Stats' in data:
+            if stats is None:
+                stats = dict(data['Stats'])
+            else:
+                stats['FilesOpened'] += data['Stats']['FilesOpened']
+                stats['Duration'] = max(stats['Duration'], data['Stats']['Duration'])
+
+    if len(missing) == len(futures):
+        if starting_up:
+            return Response(STARTING_UP_MSG + describe_progress(indexing_progress(backend)),
+                            503, mimetype='text/plain')
+        return Response(UNAVAILABLE_MSG + repr(error), 503, mimetype='text/plain')
+
+    if path == 'api/v1/search':
+        merged = {'Results': merged}
+        if stats is not None:
+            merged['Stats'] = stats
+    resp = Response(json.dumps(merged), 200, mimetype='application/json')
+    if missing:
+        resp.headers['X-Codesearch-Missing-Shards'] = ','.join(missing)
+    if path == 'api/v1/repos' and not missing:
+        resp.add_etag()
+    return resp
+
+
 def _health() -> OrderedDict:
-    status = OrderedDict()
-    for backend, port in sorted(app.config['PORTS'].items()):
+    status = {}
+    canaries.wanted()
+    for backend in app.config['PORTS']:
         # First try to hit the hound backend, if it's up, we're good
         try:
-            r = requests.get(f'http://localhost:{port}/api/v1/search')
+            r = requests.get(f'{hound_url(backend)}/api/v1/search')
             if r.text == HOUND_STARTUP:
                 status[backend] = 'starting up'
+            elif canaries.degraded(backend):
+                # Answering, but real searches are slow or failing
+                status[backend] = 'degraded'
             else:
                 status[backend] = 'up'
         except requests.exceptions.ConnectionError:
+            if not is_local(backend):
+                status[backend] = 'down'
+                track_indexing(backend, status[backend])
+                continue
             # See whether the systemd unit is running
             try:
-                show = subprocess.check_output(
-                    ['systemctl', 'show', f'hound-{backend}']
-                )
-                info = parse_systemctl_show(show.decode())
-                if info['MainPID'] == '0':
+                if main_pid(backend) == 0:
                     status[backend] = 'down'
                 else:
                     # No webservice, so hound hasn't started yet so it's waiting
                     status[backend] = 'pre-start'
             except subprocess.CalledProcessError:
                 status[backend] = 'unknown'
+        track_indexing(backend, status[backend])
+
+    # A sharded backend is only as healthy as its worst shard
+    severity = ['down', 'unknown', 'pre-start', 'starting up', 'degraded', 'up']
+    for backend, shards in app.config['SHARDS'].items():
+        status[backend] = min((status.get(shard, 'unknown') for shard in shards),
+                              key=severity.index)
+
+    return OrderedDict(sorted(status.items()))
+
+
+class Canaries:
+    """
+    Runs the CANARY_QUERIES against each hound instance from a background
+    thread, to see how long real searches take. The thread exits once
+    health stops being checked.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (instance, canary name) -> latest result
+        self.results: Dict[Tuple[str, str], dict] = {}
+        self.failures: Dict[Tuple[str, str], int] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.last_wanted = 0.0
+
+    @staticmethod
+    def queries(instance: str) -> List[dict]:
+        config = app.config['CANARY_QUERIES']
+        if instance in config:
+            return config[instance]
+        for backend, shards in app.config['SHARDS'].items():
+            if instance in shards and backend in config:
+                return config[backend]
+        return config.get('default', [])
 
-    return status
+    def run_one(self, instance: str, canary: dict):
+        name = canary.get('name') or canary['q']
+        params = {key: value for key, value in canary.items() if key != 'name'}
+        start = time.monotonic()
+        try:
+            r = requests.get(f'{hound_url(instance)}/api/v1/search', params=params,
+                             timeout=app.config['CANARY_TIMEOUT'])
+            if r.text == HOUND_STARTUP:
+                # Not ready to be measured yet
+                return
+            ok = r.status_code == 200
+            files = sum(result.get('FilesWithMatch', 0)
+                        for result in (r.json().get('Results') or {}).values()) if ok else 0
+        except (requests.exceptions.RequestException, ValueError):
+            ok = False
+            files = 0
+        result = {'seconds': time.monotonic() - start, 'files': files, 'ok': ok,
+                  'when': time.monotonic()}
+        with self.lock:
+            self.results[(instance, name)] = result
+            if not ok:
+                self.failures[(instance, name)] = self.failures.get((instance, name), 0) + 1
+
+    def run_all(self):
+        for instance in app.config['PORTS']:
+            for canary in self.queries(instance):
+                self.run_one(instance, canary)
+
+    def run(self):
+        while time.monotonic() - self.last_wanted < 10 * app.config['CANARY_INTERVAL']:
+            try:
+                self.run_all()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(app.config['CANARY_INTERVAL'])
+        with self.lock:
+            self.thread = None
+
+    def wanted(self):
+        """Make sure canaries are running, if any are configured"""
+        if not app.config['CANARY_QUERIES']:
+            return
+        with self.lock:
+            self.last_wanted = time.monotonic()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def degraded(self, instance: str) -> bool:
+        # Results from before a restart or a long pause don't count
+        recent = time.monotonic() - 3 * app.config['CANARY_INTERVAL']
+        with self.lock:
+            return any(
+                not result['ok'] or result['seconds'] > app.config['CANARY_DEGRADED_SECONDS']
+                for (name, _), result in self.results.items()
+                if name == instance and result['when'] >= recent
+            )
+
+
+canaries = Canaries()
+
+
+def main_pid(backend: str) -> int:
+    """PID of the hound-<backend> systemd unit, 0 if it isn't running"""
+    show = subprocess.check_output(
+        ['systemctl', 'show', instance_name(backend)]
+    )
+    return int(parse_systemctl_show(show.decode())['MainPID'])
+
+
+def houndd_instance(pid: int) -> Optional[str]:
+    """
+    Which instance directory (hound-<name> or its green copy) a houndd
+    process serves: the directory of its -conf file, or when that is in a
+    container, the host directory mounted there
+    """
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            args = f.read().decode(errors='replace').split('\0')
+    except OSError:
+        return None
+    conf = 'config.json'
+    for i, arg in enumerate(args):
+        if arg in ('-conf', '--conf') and i + 1 < len(args):
+            conf = args[i + 1]
+        elif arg.startswith(('-conf=', '--conf=')):
+            conf = arg.split('=', 1)[1]
+    directory = os.path.dirname(conf)
+    if os.path.basename(directory).startswith('hound-'):
+        return os.path.basename(directory)
+    try:
+        with open(f'/proc/{pid}/mountinfo') as f:
+            # Fields are: ID, parent ID, device, the mount's root within
+            # its filesystem, and where it is mounted
+            mounts = {fields[4]: fields[3] for fields in map(str.split, f) if len(fields) > 4}
+    except OSError:
+        return None
+    source = os.path.basename(mounts.get(directory, ''))
+    return source if source.startswith('hound-') else None
+
+
+def hound_pid(backend: str) -> int:
+    """
+    PID of houndd for a backend, 0 if it isn't running. Hound runs in a
+    docker container, so the unit's MainPID is only the `docker run`
+    client. Find houndd in /proc instead, which unlike asking docker
+    needs no privileges.
+    """
+    wanted = instance_name(backend)
+    for entry in os.listdir('/proc'):
+        if entry.isdigit() and process_name(int(entry)) == 'houndd' \
+                and houndd_instance(int(entry)) == wanted:
+            return int(entry)
+    return 0
+
+
+def process_name(pid: int) -> Optional[str]:
+    try:
+        with open(f'/proc/{pid}/comm') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def process_start_time(pid: int) -> Optional[float]:
+    """When a process was started, as a unix timestamp"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # The command name may contain spaces, so split after it
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/stat') as f:
+            btime = next(int(line.split()[1]) for line in f if line.startswith('btime '))
+    except (OSError, IndexError, StopIteration):
+        return None
+    # starttime is the 22nd field, in clock ticks after boot
+    return btime + int(fields[19]) / os.sysconf('SC_CLK_TCK')
+
+
+class ProcessStats:
+    """
+    Samples the resource usage of each houndd process from /proc in a
+    background thread, which exits once /_metrics stops being scraped.
+    PIDs are cached until the process goes away or is replaced.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # backend -> (pid, start time)
+        self.pids: Dict[str, Tuple[int, Optional[float]]] = {}
+        self.samples: Dict[str, dict] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.last_wanted = 0.0
+
+    def pid(self, backend: str) -> int:
+        cached = self.pids.get(backend)
+        if cached is not None and cached[0] and process_start_time(cached[0]) == cached[1]:
+            return cached[0]
+        pid = hound_pid(backend)
+        self.pids[backend] = (pid, process_start_time(pid) if pid else None)
+        return pid
+
+    @staticmethod
+    def sample(pid: int) -> Optional[dict]:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{pid}/statm') as f:
+                rss_pages = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            return None
+        ticks = os.sysconf('SC_CLK_TCK')
+        # Fields are numbered from 3 (state) on after the command name
+        sample = {
+            'rss': rss_pages * os.sysconf('SC_PAGE_SIZE'),
+            'cpu_user': int(fields[11]) / ticks,
+            'cpu_system': int(fields[12]) / ticks,
+            'threads': int(fields[17]),
+        }
+        # Only readable by hound's own user (or root)
+        try:
+            sample['fds'] = len(os.listdir(f'/proc/{pid}/fd'))
+        except OSError:
+            pass
+        try:
+            with open(f'/proc/{pid}/io') as f:
+                io = dict(line.split(': ') for line in f.read().splitlines())
+            sample['read_bytes'] = int(io['rchar'])
+            sample['write_bytes'] = int(io['wchar'])
+        except (OSError, KeyError, ValueError):
+            pass
+        return sample
+
+    def sample_all(self):
+        samples = {}
+        for backend in app.config['PORTS']:
+            if not is_local(backend):
+                continue
+            try:
+                pid = self.pid(backend)
+            except (subprocess.CalledProcessError, OSError, KeyError, ValueError):
+                continue
+            sample = self.sample(pid) if pid else None
+            if sample is not None:
+                samples[backend] = sample
+        with self.lock:
+            self.samples = samples
+
+    def run(self):
+        while time.monotonic() - self.last_wanted < 10 * app.config['PROCESS_SAMPLE_INTERVAL']:
+            try:
+                self.sample_all()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(app.config['PROCESS_SAMPLE_INTERVAL'])
+        with self.lock:
+            self.thread = None
+
+    def get(self) -> Dict[str, dict]:
+        """The latest samples, making sure that sampling is going on"""
+        with self.lock:
+            self.last_wanted = time.monotonic()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            return self.samples
+
+
+process_stats = ProcessStats()
+
+
+# backend -> when the current round of indexing began
+_indexing_since: Dict[str, float] = {}
+# backend -> start of the unit whose indexing time is already known
+_indexing_checked: Dict[str, float] = {}
+# What hound logs once it has built every index after starting
+INDEXING_DONE_LOG = 'All indexes built'
+
+
+def unit_start_time(backend: str) -> Optional[float]:
+    """When the serving unit of a backend was last started, as a unix timestamp"""
+    try:
+        show = subprocess.check_output(
+            ['systemctl', 'show', '-p', 'ExecMainStartTimestampMonotonic', instance_name(backend)]
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    usec = int(parse_systemctl_show(show.decode()).get('ExecMainStartTimestampMonotonic') or 0)
+    if not usec:
+        return None
+    # systemd's timestamps and time.monotonic() are on the same clock
+    return round(time.time() - time.monotonic() + usec / 1e6)
+
+
+def indexing_finished_time(backend: str, since: float) -> Optional[float]:
+    """When hound said it was done indexing, going by the unit's journal"""
+    try:
+        output = subprocess.check_output(
+            ['journalctl', '--unit', instance_name(backend), '--since', f'@{int(since)}',
+             '--grep', INDEXING_DONE_LOG, '--output', 'short-unix', '--lines', '1', '--no-pager', '--quiet'],
+            stderr=subprocess.DEVNULL
+        )
+        return float(output.split()[0])
+    except (subprocess.CalledProcessError, OSError, IndexError, ValueError):
+        return None
+
+
+def track_indexing(backend: str, state: str):
+    """
+    Notice backends starting and finishing indexing, to learn how long it
+    takes. Each run is timed from the start of the unit, and recorded once
+    for all workers whichever of them notices it.
+    """
+    if state in ('pre-start', 'starting up'):
+        if backend not in _indexing_since:
+            _indexing_since[backend] = unit_start_time(backend) or time.time()
+        return
+    if state not in ('up', 'degraded'):
+        return
+    seen_starting = _indexing_since.pop(backend, None)
+    if not is_local(backend):
+        return
+    if seen_starting is None and backend in _indexing_checked:
+        # Up all along, as far as this worker knows
+        return
+    started = unit_start_time(backend)
+    if started is None or _indexing_checked.get(backend) == started:
+        return
+    _indexing_checked[backend] = started
+    # Hound's own log is exact even if nobody was watching it start up
+    finished = indexing_finished_time(backend, started)
+    if finished is None and seen_starting is not None:
+        finished = time.time()
+    if finished is not None:
+        record_indexing_duration(backend, finished - started, started)
+
+
+def indexing_history() -> Dict[str, List[float]]:
+    """Durations of the last few indexing runs, per backend"""
+    try:
+        with open(app.config['INDEXING_HISTORY']) as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # Entries used to be only the list of durations
+    return {backend: runs if isinstance(runs, list) else runs['runs']
+            for backend, runs in history.items()}
+
+
+def record_indexing_duration(backend: str, seconds: float, started: Optional[float] = None):
+    """Remember how long a run took, unless it was recorded already"""
+    path = app.config['INDEXING_HISTORY']
+    try:
+        with open(path + '.lock', 'a') as lock:
+            # Other workers may be recording the same run
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path) as f:
+                    history = json.load(f)
+            except (OSError, ValueError):
+                history = {}
+            entry = history.get(backend)
+            if not isinstance(entry, dict):
+                entry = {'runs': entry or [], 'started': None}
+            if started is not None and entry['started'] == started:
+                return
+            # Keep the last few runs
+            history[backend] = {'runs': (entry['runs'] + [round(seconds)])[-5:], 'started': started}
+            with open(path + '.tmp', 'w') as f:
+                json.dump(history, f)
+            os.replace(path + '.tmp', path)
+    except OSError:
+        # Not being able to remember this only makes the ETA worse
+        pass
+
+
+def indexing_progress(backend: str) -> Optional[dict]:
+    """
+    How far along a starting up backend is, based on how many idx-*
+    directories hound has written since it started. Hound reuses the
+    index of repos that haven't changed, so this is a lower bound.
+    """
+    instances = app.config['SHARDS'].get(backend, [backend])
+    total = indexed = 0
+    elapsed = 0.0
+    for instance in instances:
+        repos = instance_repos(instance)
+        if repos is None:
+            return None
+        total += len(repos)
+        since = _indexing_since.get(instance, time.time())
+        elapsed = max(elapsed, time.time() - since)
+        try:
+            with os.scandir(os.path.join(instance_dir(instance), 'data')) as it:
+                indexed += sum(1 for entry in it if entry.name.startswith('idx-')
+                               and entry.stat().st_mtime >= since)
+        except OSError:
+            pass
+    indexed = min(indexed, total)
+
+    eta: Optional[float] = None
+    past = [sum(runs) / len(runs) for instance, runs in indexing_history().items()
+            if instance in instances and runs]
+    if past:
+        eta = max(0.0, max(past) - elapsed)
+    elif indexed:
+        eta = elapsed / indexed * (total - indexed)
+    return {
+        'indexed': indexed,
+        'total': total,
+        'elapsed': round(elapsed),
+        'eta': None if eta is None else round(eta),
+    }
+
+
+def describe_progress(progress: Optional[dict]) -> str:
+    if not progress:
+        return ''
+    text = f'\nIndexed {progress["indexed"]} of {progress["total"]} repositories so far'
+    if progress['eta'] is not None:
+        text += f', roughly {progress["eta"] // 60 + 1} minutes to go'
+    return text + '.\n'
+
+
+class HealthMonitor:
+    """
+    Probes the backends from a background thread and wakes up long-polling
+    clients when the status changes, so that any number of waiters cost a
+    single probe every HEALTH_INTERVAL seconds. The thread exits once
+    nobody has asked for a while.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.status: Optional[OrderedDict] = None
+        self.etag: Optional[str] = None
+        self.thread: Optional[threading.Thread] = None
+        self.last_wanted = 0.0
+
+    def run(self):
+        while time.monotonic() - self.last_wanted < 2 * app.config['HEALTH_MAX_WAIT']:
+            try:
+                status = _health()
+            except Exception:
+                traceback.print_exc()
+            else:
+                etag = hashlib.sha1(json.dumps(status).encode()).hexdigest()
+                with self.cond:
+                    if etag != self.etag:
+                        self.status, self.etag = status, etag
+                        self.cond.notify_all()
+            time.sleep(app.config['HEALTH_INTERVAL'])
+        with self.cond:
+            self.thread = None
+            self.status = self.etag = None
+
+    def wait(self, etags, timeout: float) -> Tuple[Optional[OrderedDict], Optional[str]]:
+        """Wait for the status to no longer match any of the given etags"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.last_wanted = time.monotonic()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            while self.etag is None or self.etag in etags:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.status, self.etag
+
+
+health_monitor = HealthMonitor()
 
 
 @app.route('/_health')
@@ -97,7 +1077,62 @@ def health():
 
 @app.route('/_health.json')
 def health_json():
-    return jsonify(_health())
+    wait = request.args.get('wait', type=float)
+    if wait is None:
+        status = _health()
+        return jsonify(with_nodes(status, with_details(status)))
+    # Long poll: hold the request until the status differs from the
+    # client's If-None-Match, and answer 304 if it never does
+    status, etag = health_monitor.wait(
+        request.if_none_match, min(wait, app.config['HEALTH_MAX_WAIT'])
+    )
+    if status is None:
+        # The first background probe hasn't finished yet
+        status = _health()
+        etag = hashlib.sha1(json.dumps(status).encode()).hexdigest()
+    resp = jsonify(with_nodes(status, with_details(status)))
+    resp.set_etag(etag)
+    resp.headers['cache-control'] = 'no-store'
+    return resp.make_conditional(request)
+
+
+def node_health(status: OrderedDict) -> OrderedDict:
+    """Status of each host running hound instances, and of its instances"""
+    nodes: Dict[str, dict] = {}
+    for instance in app.config['PORTS']:
+        if instance in status:
+            nodes.setdefault(node(instance), {})[instance] = status[instance]
+    health = OrderedDict()
+    for host, instances in sorted(nodes.items()):
+        states = set(instances.values())
+        if states <= {'up'}:
+            state = 'up'
+        elif states <= {'down', 'unknown'}:
+            state = 'down'
+        else:
+            state = 'partial'
+        health[host] = {'status': state, 'backends': OrderedDict(sorted(instances.items()))}
+    return health
+
+
+def with_nodes(status: OrderedDict, body):
+    """With ?nodes=1, add the status of each host"""
+    if not request.args.get('nodes'):
+        return body
+    return OrderedDict([('backends', body), ('nodes', node_health(status))])
+
+
+def with_details(status: OrderedDict) -> OrderedDict:
+    """With ?details=1, add indexing progress to each backend's status"""
+    if not request.args.get('details'):
+        return status
+    return OrderedDict(
+        (backend, {
+            'status': state,
+            'progress': indexing_progress(backend) if state in ('pre-start', 'starting up') else None,
+        })
+        for backend, state in status.items()
+    )
 
 
 @app.route('/_metrics')
@@ -106,18 +1141,353 @@ def metrics():
 # HELP codesearch_backend Whether Hound backend is up or not
 # TYPE codesearch_backend gauge
 """
-    for backend, status in _health().items():
-        text += 'codesearch_backend{backend="%s"} %s\n' % (backend, int(status == "up"))
+    health = _health()
+    for backend, status in health.items():
+        text += 'codesearch_backend{backend="%s"} %s\n' % (backend, int(status in ("up", "degraded")))
+    text += indexing_metrics(health)
+    text += disk_metrics()
+    text += cache_metrics()
+    text += client_metrics()
+    text += shard_metrics()
+    text += process_metrics()
+    text += canary_metrics()
     return Response(text, mimetype="text/plain")
 
 
+def escape_label(value: str) -> str:
+    """Escape a Prometheus label value"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class DiskUsage:
+    """
+    Keeps track of the space and inodes used under each hound instance
+    directory without re-walking everything on every scrape.
+
+    Each entry in an instance's data directory (a vcs-* clone or an idx-*
+    index) is measured as a whole, and only measured again once its
+    signature changes: the mtime of a clone's .git directory, which git
+    touches on every fetch and checkout, or the mtime of the entry itself,
+    as hound never modifies an index after writing it. A walk that runs out
+    of time carries on where it stopped during the next scrape.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> (signature, bytes, inodes)
+        self.trees: Dict[str, Tuple[float, int, int]] = {}
+        # path -> (signature, directories left to look at, [bytes, inodes])
+        self.walks: Dict[str, Tuple[float, List[str], List[int]]] = {}
+        self.pending = 0
+
+    @staticmethod
+    def signature(entry: os.DirEntry) -> float:
+        if entry.name.startswith('vcs-'):
+            try:
+                return os.stat(os.path.join(entry.path, '.git')).st_mtime
+            except OSError:
+                pass
+        return entry.stat(follow_symlinks=False).st_mtime
+
+    def measure(self, entry: os.DirEntry, signature: float, deadline: float) -> Optional[Tuple[int, int]]:
+        """Size and inodes of an entry, or None if the deadline came first"""
+        if not entry.is_dir(follow_symlinks=False):
+            return entry.stat(follow_symlinks=False).st_size, 1
+        walk = self.walks.get(entry.path)
+        if walk is None or walk[0] != signature:
+            walk = self.walks[entry.path] = (signature, [entry.path], [0, 1])
+        _, stack, totals = walk
+        while stack:
+            if time.monotonic() >= deadline:
+                return None
+            try:
+                with os.scandir(stack[-1]) as it:
+                    children = list(it)
+            except OSError:
+                # Removed while we were looking
+                children = []
+            stack.pop()
+            for child in children:
+                totals[1] += 1
+                try:
+                    if child.is_dir(follow_symlinks=False):
+                        stack.append(child.path)
+                    else:
+                        totals[0] += child.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+        del self.walks[entry.path]
+        return totals[0], totals[1]
+
+    def entries(self, instance_dir: str):
+        """Everything in an instance directory, looking inside data/"""
+        with os.scandir(instance_dir) as it:
+            for entry in it:
+                if entry.name == 'data' and entry.is_dir():
+                    with os.scandir(entry.path) as data:
+                        yield from data
+                else:
+                    yield entry
+
+    def collect(self, budget: float) -> Dict[str, Dict[str, Tuple[int, int]]]:
+        """Usage per instance, split by repo (or the kind of entry)"""
+        deadline = time.monotonic() + budget
+        usage: Dict[str, Dict[str, Tuple[int, int]]] = {}
+        seen = set()
+        pending = 0
+        with self.lock:
+            for instance_dir in sorted(glob.glob(os.path.join(DATA, 'hound-*'))):
+                instance = os.path.basename(instance_dir)[len('hound-'):]
+                repos = vcs_repo_names(instance)
+                parts = usage.setdefault(instance, {})
+                try:
+                    entries = list(self.entries(instance_dir))
+                except OSError:
+                    continue
+                for entry in entries:
+                    seen.add(entry.path)
+                    try:
+                        signature = self.signature(entry)
+                    except OSError:
+                        continue
+                    cached = self.trees.get(entry.path)
+                    if cached is None or cached[0] != signature:
+                        try:
+                            measured = self.measure(entry, signature, deadline)
+                        except OSError:
+                            continue
+                        if measured is not None:
+                            cached = (signature,) + measured
+                            self.trees[entry.path] = cached
+                        else:
+                            pending += 1
+                    if cached is None:
+                        continue
+                    if entry.name.startswith('vcs-'):
+                        part = repos.get(entry.name, entry.name)
+                    elif entry.name.startswith('idx-'):
+                        part = '(index)'
+                    else:
+                        part = '(other)'
+                    size, inodes = parts.get(part, (0, 0))
+                    parts[part] = (size + cached[1], inodes + cached[2])
+            for path in set(self.trees) - seen:
+                del self.trees[path]
+            for path in set(self.walks) - seen:
+                del self.walks[path]
+            self.pending = pending
+        return usage
+
+
+disk_usage = DiskUsage()
+
+
+def vcs_repo_names(instance: str) -> Dict[str, str]:
+    """Map hound's vcs-<sha1 of url> directory names back to repo names"""
+    path = os.path.join(DATA, f'hound-{instance}', 'config.json')
+    try:
+        with open(path) as f:
+            repos = json.load(f)['repos']
+    except (OSError, ValueError, KeyError):
+        return {}
+    return {'vcs-' + hashlib.sha1(info['url'].encode()).hexdigest(): name
+            for name, info in repos.items()}
+
+
+def disk_metrics() -> str:
+    usage = disk_usage.collect(app.config['DISK_SCAN_BUDGET'])
+    if not usage:
+        return ''
+    text = """# HELP codesearch_disk_bytes Bytes used by each hound instance
+# TYPE codesearch_disk_bytes gauge
+"""
+    for instance, parts in usage.items():
+        text += 'codesearch_disk_bytes{backend="%s"} %d\n' % (instance, sum(p[0] for p in parts.values()))
+    text += """# HELP codesearch_disk_inodes Inodes used by each hound instance
+# TYPE codesearch_disk_inodes gauge
+"""
+    for instance, parts in usage.items():
+        text += 'codesearch_disk_inodes{backend="%s"} %d\n' % (instance, sum(p[1] for p in parts.values()))
+
+    repos = sorted(((size, inodes, instance, repo)
+                    for instance, parts in usage.items()
+                    for repo, (size, inodes) in parts.items()
+                    if not repo.startswith('(')), reverse=True)[:app.config['DISK_TOP_REPOS']]
+    text += """# HELP codesearch_repo_disk_bytes Bytes used by the clones of the largest repos
+# TYPE codesearch_repo_disk_bytes gauge
+"""
+    for size, _, instance, repo in repos:
+        text += 'codesearch_repo_disk_bytes{backend="%s",repo="%s"} %d\n' % (instance, escape_label(repo), size)
+    text += """# HELP codesearch_repo_disk_inodes Inodes used by the clones of the largest repos
+# TYPE codesearch_repo_disk_inodes gauge
+"""
+    for _, inodes, instance, repo in repos:
+        text += 'codesearch_repo_disk_inodes{backend="%s",repo="%s"} %d\n' % (instance, escape_label(repo), inodes)
+    text += """# HELP codesearch_disk_scan_pending Changed entries left to measure on a later scrape
+# TYPE codesearch_disk_scan_pending gauge
+codesearch_disk_scan_pending %d
+""" % disk_usage.pending
+    return text
+
+
+def client_metrics() -> str:
+    top = rate_limiter.top(app.config['RATE_LIMIT_TOP_CLIENTS'])
+    if not top:
+        return ''
+    text = """# HELP codesearch_client_cost_total Estimated search cost spent by the heaviest clients
+# TYPE codesearch_client_cost_total counter
+"""
+    for client, spent, _ in top:
+        text += 'codesearch_client_cost_total{client="%s"} %f\n' % (escape_label(client), spent)
+    text += """# HELP codesearch_client_throttled_total Searches rejected by the rate limit for the heaviest clients
+# TYPE codesearch_client_throttled_total counter
+"""
+    for client, _, throttled in top:
+        text += 'codesearch_client_throttled_total{client="%s"} %d\n' % (escape_label(client), throttled)
+    return text
+
+
+def cache_metrics() -> str:
+    if shared_cache is None:
+        return ''
+    stats = shared_cache.stats()
+    text = """# HELP codesearch_cache_requests_total Lookups in the shared response cache
+# TYPE codesearch_cache_requests_total counter
+"""
+    for backend, counters in sorted(stats.items()):
+        for result, counter in (('hit', 'hits'), ('miss', 'misses'), ('stale', 'stale')):
+            text += 'codesearch_cache_requests_total{backend="%s",result="%s"} %d\n' % (
+                backend, result, counters.get(counter, 0))
+    text += """# HELP codesearch_refined_queries_total Searches answered by narrowing down a cached broader search
+# TYPE codesearch_refined_queries_total counter
+"""
+    for backend, counters in sorted(stats.items()):
+        for counter, value in sorted(counters.items()):
+            if counter.startswith('refined:'):
+                text += 'codesearch_refined_queries_total{backend="%s",kind="%s"} %d\n' % (
+                    backend, counter[len('refined:'):], value)
+    text += """# HELP codesearch_cache_evictions_total Entries evicted from the shared response cache
+# TYPE codesearch_cache_evictions_total counter
+"""
+    for backend, counters in sorted(stats.items()):
+        text += 'codesearch_cache_evictions_total{backend="%s"} %d\n' % (backend, counters.get('evictions', 0))
+    text += """# HELP codesearch_cache_bytes Size of the shared response cache
+# TYPE codesearch_cache_bytes gauge
+codesearch_cache_bytes %d
+""" % shared_cache.size()
+    return text
+
+
+def indexing_metrics(health: OrderedDict) -> str:
+    progress = OrderedDict()
+    for backend, status in health.items():
+        if status in ('pre-start', 'starting up'):
+            info = indexing_progress(backend)
+            if info is not None:
+                progress[backend] = info
+    if not progress:
+        return ''
+    text = """# HELP codesearch_indexing_repos Repositories indexed so far by backends that are starting up
+# TYPE codesearch_indexing_repos gauge
+"""
+    for backend, info in progress.items():
+        text += 'codesearch_indexing_repos{backend="%s",state="indexed"} %d\n' % (backend, info['indexed'])
+        text += 'codesearch_indexing_repos{backend="%s",state="configured"} %d\n' % (backend, info['total'])
+    text += """# HELP codesearch_indexing_eta_seconds Estimated time until a starting up backend is ready
+# TYPE codesearch_indexing_eta_seconds gauge
+"""
+    for backend, info in progress.items():
+        if info['eta'] is not None:
+            text += 'codesearch_indexing_eta_seconds{backend="%s"} %d\n' % (backend, info['eta'])
+    return text
+
+
+def process_metrics() -> str:
+    samples = process_stats.get()
+    if not samples:
+        return ''
+    text = ''
+    for name, kind, help, lines in (
+        ('resident_memory_bytes', 'gauge', 'Resident memory of the hound process',
+         [('', 'rss')]),
+        ('cpu_seconds_total', 'counter', 'CPU time used by the hound process',
+         [('mode="user"', 'cpu_user'), ('mode="system"', 'cpu_system')]),
+        ('threads', 'gauge', 'Threads of the hound process', [('', 'threads')]),
+        ('open_fds', 'gauge', 'Open file descriptors of the hound process', [('', 'fds')]),
+        ('io_bytes_total', 'counter', 'Bytes read and written by the hound process',
+         [('direction="read"', 'read_bytes'), ('direction="write"', 'write_bytes')]),
+    ):
+        values = [(backend, label, sample[key]) for backend, sample in sorted(samples.items())
+                  for label, key in lines if key in sample]
+        if not values:
+            continue
+        text += f"""# HELP codesearch_hound_{name} {help}
+# TYPE codesearch_hound_{name} {kind}
+"""
+        for backend, label, value in values:
+            labels = f'backend="{backend}"' + (f',{label}' if label else '')
+            text += f'codesearch_hound_{name}{{{labels}}} {round(value, 2)}\n'
+    return text
+
+
+def canary_metrics() -> str:
+    with canaries.lock:
+        results = sorted(canaries.results.items())
+        failures = dict(canaries.failures)
+    if not results:
+        return ''
+    text = """# HELP codesearch_canary_seconds How long the latest canary search took
+# TYPE codesearch_canary_seconds gauge
+"""
+    for (instance, name), result in results:
+        text += 'codesearch_canary_seconds{backend="%s",query="%s"} %.3f\n' % (
+            instance, escape_label(name), result['seconds'])
+    text += """# HELP codesearch_canary_files Files matched by the latest canary search
+# TYPE codesearch_canary_files gauge
+"""
+    for (instance, name), result in results:
+        text += 'codesearch_canary_files{backend="%s",query="%s"} %d\n' % (
+            instance, escape_label(name), result['files'])
+    text += """# HELP codesearch_canary_failures_total Canary searches that failed or timed out
+# TYPE codesearch_canary_failures_total counter
+"""
+    for (instance, name), _ in results:
+        text += 'codesearch_canary_failures_total{backend="%s",query="%s"} %d\n' % (
+            instance, escape_label(name), failures.get((instance, name), 0))
+    return text
+
+
+def shard_metrics() -> str:
+    with _shard_lock:
+        latency = {key: list(stats) for key, stats in _shard_latency.items()}
+        timeouts = dict(_shard_timeouts)
+    if not latency and not timeouts:
+        return ''
+    shard_of = {shard: name for name, shards in app.config['SHARDS'].items()
+                for shard in shards}
+    text = """# HELP codesearch_shard_request_duration_seconds Time taken by shards to answer fanned out requests, by outcome
+# TYPE codesearch_shard_request_duration_seconds summary
+"""
+    for (shard, outcome), (count, total) in sorted(latency.items()):
+        labels = 'backend="%s",shard="%s",outcome="%s"' % (shard_of.get(shard, shard), shard, outcome)
+        text += 'codesearch_shard_request_duration_seconds_sum{%s} %f\n' % (labels, total)
+        text += 'codesearch_shard_request_duration_seconds_count{%s} %d\n' % (labels, count)
+    text += """# HELP codesearch_shard_timeouts_total Fanned out requests that missed the deadline
+# TYPE codesearch_shard_timeouts_total counter
+"""
+    for shard, missed in sorted(timeouts.items()):
+        labels = 'backend="%s",shard="%s"' % (shard_of.get(shard, shard), shard)
+        text += 'codesearch_shard_timeouts_total{%s} %d\n' % (labels, missed)
+    return text
+
+
 @app.route('/<backend>/')
 def index(backend):
-    if backend not in app.config['PORTS']:
+    if not is_backend(backend):
         return 'invalid backend'
     sep = '</li><li class="index">'
     urls = sep.join('<a href="{}">{}</a>'.format(url_for('index', backend=target), target)
-                    for target in app.config['PORTS']
+                    for target in list_backends()
                     if target not in HIDDEN)
 
     title = f'<title>Hound: {backend} - MediaWiki Codesearch</title>'
@@ -170,10 +1540,20 @@ License: GPL-3.0-or-later.
 
 @app.route('/<backend>/config.json')
 def config_json(backend):
-    if backend not in app.config['PORTS']:
+    if not is_backend(backend):
         return 'invalid backend'
+    if backend in app.config['SHARDS']:
+        conf: dict = {}
+        for shard in app.config['SHARDS'][backend]:
+            with open(os.path.join(instance_dir(shard), 'config.json')) as f:
+                shard_conf = json.load(f)
+            if conf:
+                conf['repos'].update(shard_conf['repos'])
+            else:
+                conf = shard_conf
+        return jsonify(conf)
     resp = send_from_directory(
-        f'/srv/hound/hound-{backend}',
+        instance_dir(backend),
         'config.json'
     )
     return resp
@@ -181,30 +1561,524 @@ def config_json(backend):
 
 @app.route('/<backend>/<path:path>')
 def proxy(backend, path='', mangle=False):
-    if backend not in app.config['PORTS']:
+    if not is_backend(backend):
         return 'invalid backend'
-    port = app.config['PORTS'][backend]
+    resp = hound_response(backend, path, request.args, client_id(), mangle=mangle)
+    return resp.make_conditional(request)
+
+
+def hound_response(backend: str, path: str, params, client: str, mangle=False) -> Response:
+    """
+    Answer a request for a backend from the cache or from hound, given its
+    query parameters (a MultiDict) and who it is for
+    """
+    projection = None
+    if path == 'api/v1/search' and params.get('fields'):
+        try:
+            projection = parse_fields(params['fields'])
+        except ValueError as e:
+            return Response(json.dumps({'Error': str(e)}), 400, mimetype='application/json')
+    key = cache_key(backend, path, params)
+    if key is not None:
+        cached = cache_get(backend, key)
+        if cached is not None:
+            return cached
+    if path == 'api/v1/search' and key is not None:
+        refined = refine_from_cache(backend, key[0], params, projection)
+        if refined is not None:
+            cache_put(backend, key, refined)
+            return refined
+    if path == 'api/v1/search':
+        throttled = rate_limit(backend, params, client)
+        if throttled is not None:
+            return throttled
+    resp = fetch(backend, path, params, mangle=mangle, projection=projection)
+    if key is not None and resp.status_code == 200 \
+            and 'X-Codesearch-Missing-Shards' not in resp.headers:
+        cache_put(backend, key, resp)
+    elif key is not None and resp.status_code == 503:
+        # Hound is (re)starting, so an answer from the previous index
+        # is better than none
+        stale = cache_get_stale(backend, key)
+        if stale is not None:
+            return stale
+    return resp
+
+
+def search(backend: str, params: dict, client: str) -> Tuple[int, str]:
+    """Run a search outside of a request for it, e.g. from a batch"""
+    with app.app_context():
+        resp = hound_response(backend, 'api/v1/search', MultiDict(params), client)
+        return resp.status_code, resp.get_data(as_text=True)
+
+
+# backend -> slots for batch queries running against it
+_batch_slots: Dict[str, threading.BoundedSemaphore] = {}
+_batch_lock = threading.Lock()
+
+
+def batch_slots(backend: str) -> threading.BoundedSemaphore:
+    with _batch_lock:
+        if backend not in _batch_slots:
+            _batch_slots[backend] = threading.BoundedSemaphore(app.config['BATCH_CONCURRENCY'])
+        return _batch_slots[backend]
+
+
+@app.route('/_batch', methods=['POST'])
+def batch():
+    """
+    Run many searches, e.g. {"queries": [{"id": "x", "backend": "search",
+    "q": "wfGetDB", "files": "\\.php$"}, ...]}, streaming each result as a
+    line of JSON as soon as it is done. Every query goes through the same
+    cache and rate limits as a single search, waiting for the client's
+    budget rather than failing (without taking up a slot while it waits),
+    and identical queries in a batch are only run once.
+    """
+    body = request.get_json(silent=True)
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(queries, list) or not all(isinstance(query, dict) for query in queries):
+        return jsonify(Error='Expected {"queries": [{"backend": ..., "q": ...}, ...]}'), 400
+    if len(queries) > app.config['BATCH_MAX_QUERIES']:
+        return jsonify(Error=f'At most {app.config["BATCH_MAX_QUERIES"]} queries per batch'), 400
+
+    client = client_id()
+    # Set once the client has gone away, to stop queries waiting for its budget
+    cancelled = threading.Event()
+    unique: Dict[str, List[int]] = OrderedDict()
+    for i, query in enumerate(queries):
+        params = {name: str(value) for name, value in query.items() if name not in ('id', 'backend')}
+        unique.setdefault(json.dumps([query.get('backend'), sorted(params.items())]), []).append(i)
+
+    def run(signature: str) -> Tuple[str, dict]:
+        backend, params = json.loads(signature)
+        if not isinstance(backend, str) or not is_backend(backend):
+            return signature, {'status': 404, 'seconds': 0, 'error': 'invalid backend'}
+        while True:
+            delay = rate_limit_delay(backend, MultiDict(params), client)
+            if delay:
+                if cancelled.wait(delay):
+                    return signature, {'status': 429, 'seconds': 0, 'error': 'cancelled'}
+                continue
+            with batch_slots(backend):
+                start = time.monotonic()
+                status, data = search(backend, params, client)
+                line: dict = {'status': status, 'seconds': round(time.monotonic() - start, 3)}
+            # Another of the client's queries took the tokens first
+            if status != 429:
+                break
+        try:
+            line['result'] = json.loads(data)
+        except ValueError:
+            # e.g. hound is starting up
+            line['error'] = data.strip()
+        return signature, line
+
+    def generate():
+        executor = ThreadPoolExecutor(max_workers=max(1, min(len(unique), 32)))
+        try:
+            futures = [executor.submit(run, signature) for signature in unique]
+            for future in as_completed(futures):
+                signature, line = future.result()
+                for i in unique[signature]:
+                    yield json.dumps(dict(line, index=i, id=queries[i].get('id'),
+                                          backend=queries[i].get('backend'))) + '\n'
+        finally:
+            cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def git_revision(path: str) -> Optional[str]:
+    """The commit a clone has checked out"""
+    git = os.path.join(path, '.git')
+    try:
+        with open(os.path.join(git, 'HEAD')) as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head
+        ref = head[len('ref: '):]
+        try:
+            with open(os.path.join(git, ref)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            with open(os.path.join(git, 'packed-refs')) as f:
+                for line in f:
+                    if line.rstrip().endswith(' ' + ref):
+                        return line.split()[0]
+    except OSError:
+        pass
+    return None
+
+
+def repo_revisions(backend: str) -> Dict[str, Optional[str]]:
+    """
+    The revision hound last indexed for each repo of a backend, None for
+    repos on other nodes
+    """
+    revisions: Dict[str, Optional[str]] = {}
+    for instance in app.config['SHARDS'].get(backend, [backend]):
+        if not is_local(instance):
+            # The clones are on another node, only its config is here
+            try:
+                with open(os.path.join(instance_dir(instance), 'config.json')) as f:
+                    revisions.update(dict.fromkeys(json.load(f)['repos']))
+            except (OSError, ValueError, KeyError):
+                pass
+            continue
+        # hound-<name> or its green copy, whichever is serving
+        serving = instance_name(instance)[len('hound-'):]
+        for vcs_dir, repo in vcs_repo_names(serving).items():
+            revisions[repo] = git_revision(os.path.join(DATA, f'hound-{serving}', 'data', vcs_dir))
+    return revisions
+
+
+# backend -> (index generation, repo -> revision), see indexed_revisions()
+_revisions: Dict[str, Tuple[Optional[str], Dict[str, Optional[str]]]] = {}
+_revisions_lock = threading.Lock()
+
+
+def indexed_revisions(backend: str) -> Tuple[Optional[str], Dict[str, Optional[str]]]:
+    """
+    The backend's index generation and repo_revisions(), only looked up
+    again once the generation changes. The same pair is returned until
+    then, so callers can tell whether anything changed by identity.
+    """
+    generation = index_generation(backend)
+    with _revisions_lock:
+        cached = _revisions.get(backend)
+        if cached is not None and cached[0] == generation:
+            return cached
+    revisions = (generation, repo_revisions(backend))
+    with _revisions_lock:
+        _revisions[backend] = revisions
+    return revisions
+
+
+def flatten_results(data: dict) -> Dict[tuple, List[dict]]:
+    """
+    Matching lines by repo, file and text, so that lines moving around
+    within a file don't count as a change. Files-only results have no
+    line text.
+    """
+    flat: Dict[tuple, List[dict]] = {}
+    for repo, result in (data.get('Results') or {}).items():
+        for match in result.get('Matches') or []:
+            lines = match.get('Matches')
+            if not lines:
+                flat.setdefault((repo, match['Filename'], ''), [])
+            for line in lines or []:
+                flat.setdefault((repo, match['Filename'], line.get('Line', '')), []).append(line)
+    return flat
+
+
+def diff_results(old: dict, new: dict) -> dict:
+    """What a search finds now that it didn't before, and the other way around"""
+    before = flatten_results(old)
+    after = flatten_results(new)
+    diff: dict = {'added': {}, 'removed': {}, 'counts': {}}
+    for kind, ours, theirs in (('added', after, before), ('removed', before, after)):
+        for key in sorted(ours):
+            extra = len(ours[key]) - len(theirs.get(key, []))
+            if key in theirs and extra <= 0:
+                continue
+            repo, filename = key[:2]
+            files = diff[kind].setdefault(repo, {})
+            files.setdefault(filename, []).extend(ours[key][-extra:] if extra > 0 else [])
+    old_results = old.get('Results') or {}
+    new_results = new.get('Results') or {}
+    for repo in sorted(old_results.keys() | new_results.keys()):
+        counts = [(results.get(repo) or {}).get('FilesWithMatch', 0)
+                  for results in (old_results, new_results)]
+        if counts[0] != counts[1]:
+            diff['counts'][repo] = counts
+    return diff
+
+
+class SavedQueries:
+    """
+    Named searches whose last result is kept on disk, shared by all
+    workers. A saved query is only run again once hound has indexed a new
+    revision of a repo that it could match, and then the difference to the
+    previous result is kept too.
+    """
+
+    # Use with fullmatch(), $ would allow a trailing newline
+    NAME = re.compile(r'[A-Za-z0-9_.-]{1,100}')
+
+    def __init__(self):
+        # Names being refreshed by this worker
+        self.refreshing: set = set()
+        self.lock = threading.Lock()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(app.config['SAVED_QUERIES_DIR'], name + '.json')
+
+    def names(self) -> List[str]:
+        try:
+            return sorted(filename[:-len('.json')]
+                          for filename in os.listdir(app.config['SAVED_QUERIES_DIR'])
+                          if filename.endswith('.json'))
+        except OSError:
+            return []
+
+    def load(self, name: str) -> Optional[dict]:
+        try:
+            with open(self._path(name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, name: str, saved: dict):
+        os.makedirs(app.config['SAVED_QUERIES_DIR'], exist_ok=True)
+        dest = self._path(name)
+        with open(dest + '.tmp', 'w') as f:
+            json.dump(saved, f)
+        os.replace(dest + '.tmp', dest)
+
+    def delete(self, name: str) -> bool:
+        try:
+            os.unlink(self._path(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    @staticmethod
+    def relevant(revisions: Dict[str, Optional[str]], params: dict) -> Dict[str, Optional[str]]:
+        repos = params.get('repos', '*')
+        if repos in ('', '*'):
+            return revisions
+        wanted = set(repos.split(','))
+        return {repo: revision for repo, revision in revisions.items() if repo in wanted}
+
+    @staticmethod
+    def stale(saved: dict, generation: Optional[str]) -> bool:
+        """Whether a saved query may need running again"""
+        if generation is not None:
+            return generation != saved.get('generation')
+        if all(is_local(instance) for instance in app.config['SHARDS'].get(saved['backend'], [saved['backend']])):
+            # Hound hasn't written an index yet
+            return False
+        # On another node, whose index we can't see, so go by age
+        return time.time() - (saved.get('refreshed') or 0) >= app.config['SAVED_QUERIES_MAX_AGE']
+
+    def refresh(self, name: str, client: str = 'saved-queries', force=False) -> bool:
+        """Run a saved query again if its repos changed, returning whether it did"""
+        saved = self.load(name)
+        if saved is None:
+            return False
+        lock_path = self._path(name) + '.lock'
+        with open(lock_path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is on it
+                return False
+            if self.load(name) != saved:
+                # Deleted, changed or refreshed since we looked
+                return False
+            generation, revisions = indexed_revisions(saved['backend'])
+            if not force and not self.stale(saved, generation):
+                return False
+            revisions = self.relevant(revisions, saved['params'])
+            if not force and generation is not None and revisions == saved.get('revisions'):
+                saved['generation'] = generation
+                self.save(name, saved)
+                return False
+            status, data = search(saved['backend'], saved['params'], client)
+            if status != 200:
+                saved['error'] = data.strip()
+                self.save(name, saved)
+                return False
+            result = json.loads(data)
+            if saved.get('result') is not None:
+                saved['diff'] = dict(diff_results(saved['result'], result),
+                                     since=saved['refreshed'])
+            saved.update(result=result, revisions=revisions, generation=generation,
+                         refreshed=time.time(), error=None)
+            self.save(name, saved)
+            return True
+
+    def refresh_later(self, name: str):
+        """Refresh in the background, unless that is already happening"""
+        with self.lock:
+            if name in self.refreshing:
+                return
+            self.refreshing.add(name)
+
+        def run():
+            try:
+                with app.app_context():
+                    self.refresh(name)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.refreshing.discard(name)
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+saved_queries = SavedQueries()
+
+
+@app.route('/_saved')
+def saved_list():
+    listing = {}
+    for name in saved_queries.names():
+        saved = saved_queries.load(name)
+        if saved is not None:
+            listing[name] = {'backend': saved['backend'], 'params': saved['params'],
+                             'owner': saved.get('owner'), 'refreshed': saved.get('refreshed')}
+    return jsonify(listing)
+
+
+@app.route('/_saved/<name>', methods=['GET', 'PUT', 'DELETE'])
+def saved_query(name):
+    if not SavedQueries.NAME.fullmatch(name):
+        return jsonify(Error='Invalid name'), 400
+    if request.method in ('PUT', 'DELETE'):
+        owner = token_owner()
+        if owner is None:
+            return jsonify(Error=f'Saving queries needs a token in {app.config["RATE_LIMIT_HEADER"]}'), 401
+        existing = saved_queries.load(name)
+        if existing is not None and existing.get('owner') != owner \
+                and owner not in app.config['SAVED_QUERIES_ADMINS']:
+            return jsonify(Error=f'Saved by {existing.get("owner")}'), 403
+    if request.method == 'PUT':
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not is_backend(str(body.get('backend'))) or not body.get('q'):
+            return jsonify(Error='Expected {"backend": ..., "q": ..., ...}'), 400
+        if existing is None and len(saved_queries.names()) >= app.config['SAVED_QUERIES_MAX']:
+            return jsonify(Error='Too many saved queries'), 400
+        saved_queries.save(name, {
+            'backend': body['backend'],
+            'params': {key: str(value) for key, value in body.items() if key != 'backend'},
+            # An admin editing a query doesn't take it over
+            'owner': (existing or {}).get('owner') or owner,
+            'result': None,
+            'refreshed': None,
+        })
+        # The first run counts against the client's rate limit
+        saved_queries.refresh(name, client_id(), force=True)
+    elif request.method == 'DELETE':
+        if not saved_queries.delete(name):
+            return jsonify(Error='No such saved query'), 404
+        return '', 204
+    saved = saved_queries.load(name)
+    if saved is None:
+        return jsonify(Error='No such saved query'), 404
+    if request.method == 'GET' and SavedQueries.stale(saved, index_generation(saved['backend'])):
+        # Answer with what we have, and catch up for next time
+        saved_queries.refresh_later(name)
+    return jsonify({key: saved.get(key) for key in ('backend', 'params', 'owner', 'refreshed', 'error', 'result')})
+
+
+@app.route('/_saved/<name>/diff')
+def saved_query_diff(name):
+    saved = saved_queries.load(name) if SavedQueries.NAME.fullmatch(name) else None
+    if saved is None:
+        return jsonify(Error='No such saved query'), 404
+    return jsonify(dict(saved.get('diff') or {'added': {}, 'removed': {}, 'counts': {}, 'since': None},
+                        refreshed=saved.get('refreshed')))
+
+
+class RepoDirectory:
+    """
+    Which backends index each repo, and at what revision, from the
+    directory.json written by write_config.py. Kept in memory and only
+    updated for backends whose index changed since the last request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = WatchedFile('directory.json')
+        self.repos: Dict[str, dict] = {}
+        # backend -> the indexed_revisions() the body was built from
+        self.revisions: Dict[str, Tuple[Optional[str], Dict[str, Optional[str]]]] = {}
+        self.body = b''
+        self.etag = ''
+
+    def _load(self) -> bool:
+        """Reread directory.json if it changed, returning whether it did"""
+        if not self.file.load():
+            return False
+        self.repos = (self.file.data or {}).get('repos', {})
+        return True
+
+    def get(self) -> Optional[Tuple[bytes, str]]:
+        """The directory as JSON and its ETag, or None if there isn't one"""
+        with self.lock:
+            changed = self._load()
+            backends = {backend for entry in self.repos.values() for backend in entry['backends']}
+            for backend in list(self.revisions):
+                if backend not in backends:
+                    del self.revisions[backend]
+                    changed = True
+            for backend in sorted(backends):
+                if not is_backend(backend):
+                    continue
+                revisions = indexed_revisions(backend)
+                if self.revisions.get(backend) is not revisions:
+                    self.revisions[backend] = revisions
+                    changed = True
+            if self.file.data is None:
+                return None
+            if changed:
+                repos = {}
+                for name, entry in self.repos.items():
+                    repos[name] = {
+                        'url': entry['url'],
+                        'poll': entry['poll'],
+                        'backends': {backend: self.revisions.get(backend, (None, {}))[1].get(name)
+                                     for backend in entry['backends']},
+                    }
+                self.body = json.dumps({'repos': repos}, separators=(',', ':')).encode()
+                self.etag = hashlib.sha1(self.body).hexdigest()[:16]
+            return self.body, self.etag
+
+
+repo_directory = RepoDirectory()
+
+
+@app.route('/_repos')
+def repos():
+    directory = repo_directory.get()
+    if directory is None:
+        return jsonify(Error='write_config.py has not written a repo directory yet'), 404
+    body, etag = directory
+    resp = Response(body, 200, mimetype='application/json')
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+
+def fetch(backend, path, params, mangle=False, projection=None):
+    """Get a response from hound, or from all shards of a sharded backend"""
+    if backend in app.config['SHARDS']:
+        if path in ('api/v1/search', 'api/v1/repos'):
+            merged = shard_fanout(backend, path, params)
+            if projection is not None and merged.status_code == 200:
+                merged.set_data(json.dumps(project_results(json.loads(merged.get_data()), projection)))
+            return merged
+        backend = shard_for(backend, params.get('repo'))
     try:
         r = requests.get(
-            f'http://localhost:{port}/{path}',
-            params=request.args
+            f'{hound_url(backend)}/{path}',
+            params=[(name, value) for name, value in params.items(multi=True)
+                    if name != 'fields'],
+            stream=projection is not None,
         )
+        if projection is not None and r.status_code == 200 \
+                and r.headers.get('content-type', '').startswith('application/json'):
+            # Trim the response as it arrives rather than holding all of
+            # the matches and their context in memory
+            return Response(stream_projected(r.iter_content(STREAM_CHUNK), projection),
+                            200, mimetype='application/json')
         if r.text == HOUND_STARTUP:
-            return Response("""
-Hound is still starting up, please wait a few minutes for the initial indexing
-to complete. See <https://codesearch.wmcloud.org/_health> for more
-information.
-""", 503, mimetype='text/plain')
+            return Response(STARTING_UP_MSG + describe_progress(indexing_progress(backend)),
+                            503, mimetype='text/plain')
     except requests.exceptions.ConnectionError:
-        resp = """
-Unable to contact hound. If <https://codesearch.wmcloud.org/_health>
-says "starting up", please wait a few minutes for the initial indexing
-to complete.
-
-If this error continues, please report it in Phabricator
-with the following information:
-
-"""
+        resp = UNAVAILABLE_MSG
         resp += traceback.format_exc()
         return Response(resp, 503, mimetype='text/plain')
     excluded_headers = [
@@ -224,7 +2098,254 @@ with the following information:
     if path == 'api/v1/repos':
         # Allow this endpoint to be cached
         resp.add_etag()
-    return resp.make_conditional(request)
+    return resp
+
+
+# backend -> (when it was checked, index generation)
+_generations: Dict[str, Tuple[float, Optional[str]]] = {}
+
+
+def index_generation(backend: str) -> Optional[str]:
+    """
+    Identify the current state of a backend's index. Hound writes a new
+    idx-* directory whenever a repo is reindexed, so the set of those
+    changes exactly when search results can. Rechecked at most every
+    CACHE_REVALIDATE seconds.
+    """
+    checked = _generations.get(backend)
+    if checked is not None and time.monotonic() - checked[0] < app.config['CACHE_REVALIDATE']:
+        return checked[1]
+    digest = hashlib.sha1()
+    generation: Optional[str] = None
+    for instance in app.config['SHARDS'].get(backend, [backend]):
+        if not is_local(instance):
+            # The index is on another node, so there's nothing to go by
+            break
+        try:
+            with os.scandir(os.path.join(instance_dir(instance), 'data')) as it:
+                names = sorted(entry.name for entry in it if entry.name.startswith('idx-'))
+        except OSError:
+            break
+        digest.update(('\n'.join(names) + '\0').encode())
+    else:
+        generation = digest.hexdigest()[:16]
+    _generations[backend] = (time.monotonic(), generation)
+    return generation
+
+
+def cache_key(backend: str, path: str, params) -> Optional[Tuple[str, str]]:
+    """Where a response would be in the shared cache, if it can be cached"""
+    if shared_cache is None or path not in CACHEABLE:
+        return None
+    generation = index_generation(backend)
+    if generation is None:
+        return None
+    return generation, cache_hash(path, params.items(multi=True))
+
+
+def cache_hash(path: str, params) -> str:
+    # Hound treats empty parameters like missing ones
+    parts: list = [path, sorted((name, value) for name, value in params if value)]
+    if path == '':
+        # The index page links to all the backends
+        parts.append(list_backends())
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+
+def cache_get(backend: str, key: Tuple[str, str]) -> Optional[Response]:
+    assert shared_cache is not None
+    hit = shared_cache.get(backend, *key)
+    if hit is None:
+        return None
+    meta, body = hit
+    return Response(body, meta['status'], meta['headers'])
+
+
+# backend -> generation this worker last stored responses for
+_stored_generations: Dict[str, str] = {}
+
+
+def cache_put(backend: str, key: Tuple[str, str], resp: Response):
+    assert shared_cache is not None
+    meta = {'status': resp.status_code, 'headers': list(resp.headers.items())}
+    shared_cache.put(backend, *key, meta, resp.get_data())
+    # Older generations are only dropped once the new index is serving,
+    # so they can stand in while hound is restarting
+    if _stored_generations.get(backend) != key[0]:
+        shared_cache.invalidate(backend, keep=key[0])
+        _stored_generations[backend] = key[0]
+
+
+def cache_get_stale(backend: str, key: Tuple[str, str]) -> Optional[Response]:
+    """The same response for an older index, if there is one"""
+    assert shared_cache is not None
+    hit = shared_cache.get_stale(backend, key[1])
+    if hit is None:
+        return None
+    meta, body = hit
+    resp = Response(body, meta['status'], meta['headers'])
+    resp.headers['X-Codesearch-Stale'] = '1'
+    resp.headers['Warning'] = '110 - "Response is Stale"'
+    return resp
+
+
+# Hound stops collecting matches in a repo after this many lines
+HOUND_MATCH_LIMIT = 5000
+# How many shorter versions of a query to look for in the cache
+MAX_REFINE_CANDIDATES = 16
+
+
+def literal_text(q: str, literal: bool) -> Optional[str]:
+    """The text a query matches literally, or None if it is a real regex"""
+    if literal:
+        return q
+    text = ''
+    escaped = False
+    for char in q:
+        if escaped:
+            if char not in string.punctuation:
+                # \d, \w and friends
+                return None
+            text += char
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in '.+*?()|[]{}^$':
+            return None
+        else:
+            text += char
+    return None if escaped else text
+
+
+def portable_regex(pattern: str) -> Optional['re.Pattern']:
+    """
+    Compile a hound (Go) regex with Python's re, if it means the same
+    thing in both. Character classes like \\w, POSIX classes and flags
+    differ, so anything using those is left to hound.
+    """
+    if re.search(r'\\[a-zA-Z]|\[\[:|\(\?', pattern):
+        return None
+    try:
+        return re.compile(pattern)
+    except re.error:
+        return None
+
+
+def refine_results(data: dict, repos: Optional[set], files, exclude,
+                   text: Optional[str], ignore_case: bool) -> Optional[dict]:
+    """
+    Narrow down a complete hound search response, or return None if it
+    was cut short and so might be missing matches of the narrower query
+    """
+    if text is not None and ignore_case:
+        text = text.lower()
+    results = {}
+    for repo, result in (data.get('Results') or {}).items():
+        if repos is not None and repo not in repos:
+            continue
+        matches = result.get('Matches') or []
+        if result.get('FilesWithMatch') != len(matches) \
+                or sum(len(match['Matches']) for match in matches) >= HOUND_MATCH_LIMIT:
+            return None
+        kept = []
+        for match in matches:
+            if files is not None and not files.search(match['Filename']):
+                continue
+            if exclude is not None and exclude.search(match['Filename']):
+                continue
+            if text is not None:
+                lines = [line for line in match['Matches']
+                         if text in (line['Line'].lower() if ignore_case else line['Line'])]
+                if not lines:
+                    continue
+                match = dict(match, Matches=lines)
+            kept.append(match)
+        if kept:
+            results[repo] = dict(result, Matches=kept, FilesWithMatch=len(kept))
+    refined: dict = {'Results': results}
+    if 'Stats' in data:
+        refined['Stats'] = dict(data['Stats'], Duration=0)
+    return refined
+
+
+def refine_from_cache(backend: str, generation: str, params,
+                      projection: Optional[Projection] = None) -> Optional[Response]:
+    """
+    Answer a search locally if it only narrows down a broader search that
+    is already cached for the same index: the same query limited to fewer
+    repos or files, or a literal query extending a cached one. Trimmed
+    responses are also made from a cached complete one.
+    """
+    assert shared_cache is not None
+    params = {name: value for name, value in params.items() if value and name != 'fields'}
+    offset = params.get('rng', '').partition(':')[0]
+    if offset not in ('', '0'):
+        return None
+    q = params.get('q', '')
+    literal = hound_bool(params.get('literal'))
+    ignore_case = hound_bool(params.get('i'))
+    text = literal_text(q, literal)
+    if text is not None and ('\n' in text or (ignore_case and not text.isascii())):
+        text = None
+
+    # Each dimension can be kept as is (None), or widened
+    queries: List[Optional[str]] = [None]
+    if text is not None:
+        for end in range(len(q) - 1, 2, -1):
+            if len(queries) > MAX_REFINE_CANDIDATES:
+                break
+            if literal_text(q[:end], literal):
+                queries.append(q[:end])
+        for start in range(1, len(q) - 2):
+            if len(queries) > 2 * MAX_REFINE_CANDIDATES:
+                break
+            if literal_text(q[start:], literal):
+                queries.append(q[start:])
+    repos: List[Optional[str]] = [None]
+    if params.get('repos', '*') != '*':
+        repos.append('*')
+    files: List[Optional[str]] = [None]
+    if 'files' in params and portable_regex(params['files']):
+        files.append('')
+    excludes: List[Optional[str]] = [None]
+    if 'excludeFiles' in params and portable_regex(params['excludeFiles']):
+        excludes.append('')
+
+    for wider_q, wider_repos, wider_files, wider_exclude in itertools.product(
+            queries, repos, files, excludes):
+        kinds = [kind for kind, wider in (('query', wider_q), ('repos', wider_repos),
+                                          ('files', wider_files), ('excludeFiles', wider_exclude))
+                 if wider is not None]
+        if not kinds and projection is None:
+            continue
+        candidate = dict(params)
+        for name, wider in (('q', wider_q), ('repos', wider_repos),
+                            ('files', wider_files), ('excludeFiles', wider_exclude)):
+            if wider is not None:
+                candidate[name] = wider
+        hit = shared_cache.get(backend, generation, cache_hash('api/v1/search', candidate.items()),
+                               count=False)
+        if hit is None:
+            continue
+        refined = refine_results(
+            json.loads(hit[1]),
+            repos=set(params['repos'].split(',')) if wider_repos is not None else None,
+            files=portable_regex(params['files']) if wider_files is not None else None,
+            exclude=portable_regex(params['excludeFiles']) if wider_exclude is not None else None,
+            text=text if wider_q is not None else None,
+            ignore_case=ignore_case,
+        )
+        if refined is None:
+            continue
+        if projection is not None:
+            refined = project_results(refined, projection)
+            kinds.append('fields')
+        kind = '+'.join(kinds)
+        shared_cache.count(backend, f'refined:{kind}')
+        resp = Response(json.dumps(refined), 200, mimetype='application/json')
+        resp.headers['X-Codesearch-Refined'] = kind
+        return resp
+    return None
 
 
 if __name__ == '__main__':
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+Benchmark config generation against local stub servers
+Copyright (C) 2026 MediaWiki Codesearch contributors
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+from collections import Counter
+from configparser import ConfigParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Tuple
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+import yaml
+
+import write_config
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_fixtures.json')
+# Timing differences smaller than this are noise
+MIN_SECONDS = 0.1
+
+
+def scaled(count: int, scale: float) -> int:
+    return max(1, int(count * scale))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves generated responses for the APIs write_config.py talks to.
+    Requests arrive as /<original host>/<original path>.
+    """
+    fixtures: dict = {}
+    scale = 1.0
+    counts: Counter = Counter()
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        host, _, path = url.path.lstrip('/').partition('/')
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        with self.lock:
+            self.counts[host] += 1
+        headers: Dict[str, str] = {}
+        if host == 'www.mediawiki.org':
+            body = self.extdist()
+        elif host == 'raw.githubusercontent.com':
+            body = self.gitmodules(f'https://{host}/{path}')
+        elif host == 'gerrit.wikimedia.org' and path == 'r/projects/':
+            body = self.gerrit_projects(query['p'])
+        elif host == 'gitlab.wikimedia.org' and path.endswith('/-/children.json'):
+            group = path[len('groups/'):-len('/-/children.json')]
+            body, next_page = self.gitlab_children(group, int(query.get('page', 1)),
+                                                   int(query.get('per_page', 20)))
+            if next_page:
+                headers['X-Next-Page'] = str(next_page)
+        elif host == 'gitlab.wikimedia.org' and path.endswith('make-release/settings.yaml'):
+            body = self.settings_yaml()
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def extdist(self) -> str:
+        counts = self.fixtures['extdist']
+        return json.dumps({'query': {'extdistrepos': {
+            'extensions': [f'Ext{i}' for i in range(scaled(counts['extensions'], self.scale))],
+            'skins': [f'Skin{i}' for i in range(scaled(counts['skins'], self.scale))],
+        }}})
+
+    def gitmodules(self, url: str) -> str:
+        hosts = ['https://github.com/org', 'https://gitlab.com/org', 'https://bitbucket.org/org']
+        lines = []
+        for i in range(scaled(self.fixtures['gitmodules'].get(url, 10), self.scale)):
+            lines.append(f'[submodule "repo{i}"]\n\tpath = repo{i}\n'
+                         f'\turl = {hosts[i % len(hosts)]}/repo{i}.git\n')
+        return ''.join(lines)
+
+    def gerrit_projects(self, prefix: str) -> str:
+        count = scaled(self.fixtures['gerrit_prefixes'].get(prefix, 10), self.scale)
+        projects = {f'{prefix}project{i}': {'state': 'ACTIVE'} for i in range(count)}
+        return ")]}'\n" + json.dumps(projects)
+
+    def gitlab_children(self, group: str, page: int, per_page: int):
+        groups = self.fixtures['gitlab_groups']
+        if group in groups:
+            projects = scaled(groups[group]['projects'], self.scale)
+            subgroups = scaled(groups[group]['subgroups'], self.scale) if groups[group]['subgroups'] else 0
+        else:
+            projects = scaled(self.fixtures['gitlab_subgroup_projects'], self.scale)
+            subgroups = 0
+        children = [{'name': f'sub{i}', 'type': 'group', 'relative_path': f'/{group}/sub{i}'}
+                    for i in range(subgroups)]
+        children += [{'name': f'proj{i}', 'type': 'project', 'relative_path': f'/{group}/proj{i}'}
+                     for i in range(projects)]
+        start = (page - 1) * per_page
+        next_page = page + 1 if start + per_page < len(children) else None
+        return json.dumps(children[start:start + per_page]), next_page
+
+    def settings_yaml(self) -> str:
+        bundles = self.fixtures['bundles']
+        return yaml.safe_dump({'bundles': {
+            name: {f'mediawiki/extensions/Bundled{i}': {} for i in range(scaled(count, self.scale))}
+            for name, count in bundles.items()
+        }})
+
+
+class StubServer:
+    """Run the stubs on a random local port, and send write_config's requests there"""
+
+    def __init__(self, fixtures: dict, scale: float):
+        self.counts: Counter = Counter()
+        handler = type('Handler', (StubHandler,), {
+            'fixtures': fixtures, 'scale': scale, 'counts': self.counts,
+        })
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.patch = mock.patch.object(requests.adapters.HTTPAdapter, 'send', self._send(
+            requests.adapters.HTTPAdapter.send, self.server.server_address[1]))
+
+    @staticmethod
+    def _send(send, port):
+        def rewrite(adapter, req, **kwargs):
+            url = urlsplit(req.url)
+            req.url = f'http://127.0.0.1:{port}/{url.netloc}{url.path}' + \
+                (f'?{url.query}' if url.query else '')
+            return send(adapter, req, **kwargs)
+        return rewrite
+
+    def requests(self) -> int:
+        return sum(self.counts.values())
+
+    def __enter__(self):
+        self.thread.start()
+        self.patch.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def clear_caches():
+    for func in (write_config.get_extdist_repos, write_config.parse_gitmodules,
+                 write_config._settings_yaml, write_config.clone_sizes,
+                 write_config.clone_file_stats):
+        func.cache_clear()
+    for state in (write_config.source_stats, write_config.profile_stats, write_config.instance_stats,
+                  write_config.repo_directory):
+        state.clear()
+
+
+def run(scale: float = 1.0, fixtures: Optional[dict] = None) -> dict:
+    """Run write_config.main() against the stubs and report per profile"""
+    if fixtures is None:
+        with open(FIXTURES) as f:
+            fixtures = json.load(f)
+    report: Dict[str, dict] = {}
+    make_conf = write_config.make_conf
+
+    with tempfile.TemporaryDirectory() as data, StubServer(fixtures, scale) as stubs:
+        def timed_make_conf(name, *args, **kwargs):
+            requests_before = stubs.requests()
+            tracemalloc.reset_peak()
+            start = time.perf_counter()
+            instances = make_conf(name, *args, **kwargs)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            output = 0
+            repos = 0
+            for instance in instances:
+                with open(os.path.join(data, f'hound-{instance}', 'config.json')) as f:
+                    text = f.read()
+                output += len(text)
+                repos += len(json.loads(text)['repos'])
+            report[name] = {
+                'seconds': round(elapsed, 4),
+                'requests': stubs.requests() - requests_before,
+                'peak_memory': peak,
+                'output_bytes': output,
+                'repos': repos,
+            }
+            return instances
+
+        clear_caches()
+        tracemalloc.start()
+        try:
+            with mock.patch.object(write_config, 'DATA', data), \
+                    mock.patch.object(write_config, 'make_conf', timed_make_conf), \
+                    mock.patch.object(sys, 'argv', ['write_config.py']), \
+                    mock.patch('builtins.print'):
+                write_config.main()
+        finally:
+            tracemalloc.stop()
+            clear_caches()
+
+    profiles = list(report.values())
+    report['total'] = {
+        key: sum(profile[key] for profile in profiles)
+        for key in ('seconds', 'requests', 'output_bytes', 'repos')
+    }
+    report['total']['peak_memory'] = max(profile['peak_memory'] for profile in profiles)
+    return report
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """List the profiles that got slower or chattier than the baseline allows"""
+    regressions = []
+    for name, profile in report.items():
+        if name not in baseline:
+            continue
+        for key in ('seconds', 'requests', 'peak_memory'):
+            old = baseline[name][key]
+            if key == 'seconds' and profile[key] - old < MIN_SECONDS:
+                continue
+            if old and profile[key] > old * (1 + tolerance):
+                regressions.append(f'{name}: {key} went from {old} to {profile[key]}')
+    return regressions
+
+
+def live_gitlab_children(group: str) -> Tuple[List[str], List[str]]:
+    """Paths of the projects and subgroups directly within a GitLab group"""
+    projects: List[str] = []
+    subgroups: List[str] = []
+    page = 1
+    while page:
+        r = requests.get(f'https://gitlab.wikimedia.org/groups/{group}/-/children.json',
+                         params={'per_page': 100, 'page': page})
+        r.raise_for_status()
+        for child in r.json():
+            if child.get('archived', False):
+                continue
+            path = child['relative_path'].lstrip('/')
+            if child['type'] == 'group':
+                subgroups.append(path)
+            elif child['type'] == 'project':
+                projects.append(path)
+        page = int(r.headers.get('X-Next-Page') or 0)
+    return projects, subgroups
+
+
+def record(path: str):
+    """Refresh the fixture counts from the live APIs"""
+    with open(path) as f:
+        fixtures = json.load(f)
+    clear_caches()
+    data = write_config.get_extdist_repos()['query']['extdistrepos']
+    fixtures['extdist'] = {'extensions': len(data['extensions']), 'skins': len(data['skins'])}
+    for url in fixtures['gitmodules']:
+        r = requests.get(url)
+        r.raise_for_status()
+        config = ConfigParser()
+        config.read_string(r.text)
+        fixtures['gitmodules'][url] = len(config.sections())
+    for bundle in fixtures['bundles']:
+        fixtures['bundles'][bundle] = len(write_config._settings_yaml()['bundles'][bundle])
+    for prefix in fixtures['gerrit_prefixes']:
+        fixtures['gerrit_prefixes'][prefix] = len(write_config.gerrit_prefix_list(prefix))
+    # The stub's subgroups all have the same number of projects, and no
+    # subgroups of their own, so use the average of everything under them
+    subgroup_projects = []
+    for group in fixtures['gitlab_groups']:
+        projects, subgroups = live_gitlab_children(group)
+        fixtures['gitlab_groups'][group] = {'projects': len(projects), 'subgroups': len(subgroups)}
+        for subgroup in subgroups:
+            subgroup_projects.append(len(write_config.wmf_gitlab_group_projects(subgroup)))
+    if subgroup_projects:
+        fixtures['gitlab_subgroup_projects'] = round(sum(subgroup_projects) / len(subgroup_projects))
+    with open(path, 'w') as f:
+        json.dump(fixtures, f, indent='\t')
+        f.write('\n')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark hound config generation')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply the recorded repo counts by this much')
+    parser.add_argument('--fixtures', default=FIXTURES, help='Recorded repo counts')
+    parser.add_argument('--record', action='store_true',
+                        help='Update the fixtures from the live APIs instead of benchmarking')
+    parser.add_argument('--output', help='Write the report as JSON to this file')
+    parser.add_argument('--baseline', help='Fail if worse than this previous report')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed growth over the baseline, as a fraction')
+    return parser.parse_args(args=argv)
+
+
+def main():
+    args = parse_args()
+    if args.record:
+        record(args.fixtures)
+        return
+    with open(args.fixtures) as f:
+        report = run(args.scale, json.load(f))
+    print(f'{"profile":<12} {"seconds":>9} {"requests":>9} {"peak MiB":>9} {"output KiB":>11} {"repos":>7}')
+    for name, profile in report.items():
+        print(f'{name:<12} {profile["seconds"]:>9.3f} {profile["requests"]:>9} '
+              f'{profile["peak_memory"] / 2**20:>9.1f} {profile["output_bytes"] / 2**10:>11.1f} '
+              f'{profile["repos"]:>7}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent='\t')
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""
+Response cache shared between proxy workers
+Copyright (C) 2026 MediaWiki Codesearch contributors
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import fcntl
+import glob
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+
+class SharedCache:
+    """
+    A size-bounded cache of responses that every worker on the host can
+    read, and that survives worker restarts.
+
+    Entries live in <root>/<backend>/<generation>/<key>, where the
+    generation identifies the state of the backend's index. Each file is a
+    4 byte header length, a JSON header and the body, and is read through
+    mmap. Files are written to a temporary name and renamed into place, so
+    readers never see a partial entry. The least recently used entries
+    (by mtime, which is bumped on every hit) are evicted once the cache
+    grows past max_bytes.
+
+    Counters, including each backend's size in bytes, are kept per process
+    and written to <root>/.stats-<pid>-*.json every FLUSH_INTERVAL seconds,
+    so that lookups never wait on other workers. Reading the stats adds up
+    those files, folding in the ones left by workers that have exited.
+    """
+
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        # Bytes this process has written since it last checked the size
+        self.written = 0
+        # Events since this process started, backend -> event -> count
+        self.counters: Dict[str, Dict[str, int]] = {}
+        self.lock = threading.Lock()
+        self.flushed = 0.0
+        self.pid: Optional[int] = None
+        self.stats_path = ''
+        os.makedirs(root, exist_ok=True)
+        if not os.path.exists(os.path.join(root, '.stats.json')):
+            # A new cache, or one from before sizes were counted
+            self.evict()
+
+    def _path(self, backend: str, generation: str, key: str) -> str:
+        return os.path.join(self.root, backend, generation, key)
+
+    def get(self, backend: str, generation: str, key: str,
+            count=True) -> Optional[Tuple[dict, bytes]]:
+        path = self._path(backend, generation, key)
+        try:
+            with open(path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                length = int.from_bytes(mm[:4], 'big')
+                meta = json.loads(mm[4:4 + length])
+                body = mm[4 + length:]
+            os.utime(path)
+        except (OSError, ValueError):
+            if count:
+                self.count(backend, 'misses')
+            return None
+        if count:
+            self.count(backend, 'hits')
+        return meta, body
+
+    def get_stale(self, backend: str, key: str) -> Optional[Tuple[dict, bytes]]:
+        """Find an entry in any generation, newest first"""
+        generations = self.generations(backend)
+        for generation in sorted(generations, key=generations.__getitem__, reverse=True):
+            hit = self.get(backend, generation, key, count=False)
+            if hit is not None:
+                self.count(backend, 'stale')
+                return hit
+        return None
+
+    def put(self, backend: str, generation: str, key: str, meta: dict, body: bytes):
+        path = self._path(backend, generation, key)
+        header = json.dumps(meta).encode()
+        try:
+            replaced = os.stat(path).st_size
+        except OSError:
+            replaced = 0
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(len(header).to_bytes(4, 'big'))
+                f.write(header)
+                f.write(body)
+            os.replace(tmp, path)
+        except OSError:
+            # e.g. the generation was invalidated by another worker meanwhile
+            return
+        self.count(backend, 'bytes', len(header) + len(body) + 4 - replaced)
+        self.written += len(header) + len(body) + 4
+        if self.written > self.max_bytes // 20:
+            self.evict()
+
+    def generations(self, backend: str) -> Dict[str, float]:
+        """Generations stored for a backend, with when they were created"""
+        try:
+            with os.scandir(os.path.join(self.root, backend)) as it:
+                return {entry.name: entry.stat().st_mtime for entry in it
+                        if entry.is_dir() and not entry.name.startswith('.')}
+        except OSError:
+            return {}
+
+    def invalidate(self, backend: str, keep: str):
+        """Drop everything for a backend that isn't from the given generation"""
+        for generation in self.generations(backend):
+            if generation == keep:
+                continue
+            # Move it out of the way first, so that only one worker counts it
+            doomed = os.path.join(self.root, backend, f'.old-{generation}-{os.getpid()}')
+            try:
+                os.rename(os.path.join(self.root, backend, generation), doomed)
+            except OSError:
+                continue
+            self.count(backend, 'bytes', -_tree_size(doomed))
+            shutil.rmtree(doomed, ignore_errors=True)
+
+    def evict(self):
+        self.written = 0
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, os.path.join(dirpath, filename)))
+        total = sum(entry[1] for entry in entries)
+        # Having looked at everything anyway, correct the running totals for
+        # anything they missed, e.g. entries replaced by two workers at once
+        actual: Dict[str, int] = {}
+        for _, size, path in entries:
+            backend = os.path.relpath(path, self.root).split(os.sep)[0]
+            actual[backend] = actual.get(backend, 0) + size
+        counted = self.stats()
+        for backend in set(actual) | set(counted):
+            drift = actual.get(backend, 0) - counted.get(backend, {}).get('bytes', 0)
+            if drift:
+                self.count(backend, 'bytes', drift)
+        if total <= self.max_bytes:
+            self.flush()
+            return
+        # Make some room, so that we don't end up evicting on every write
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            backend = os.path.relpath(path, self.root).split(os.sep)[0]
+            self.count(backend, 'evictions')
+            self.count(backend, 'bytes', -size)
+        self.flush()
+
+    def count(self, backend: str, event: str, amount: int = 1):
+        """Bump a counter, which other workers see once it is flushed"""
+        with self.lock:
+            counters = self.counters.setdefault(backend, {})
+            counters[event] = counters.get(event, 0) + amount
+            due = time.monotonic() - self.flushed >= self.FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Publish this process's counters"""
+        pid = os.getpid()
+        with self.lock:
+            if self.pid != pid:
+                if self.pid is not None:
+                    # Forked, the counters so far belong to the parent
+                    self.counters = {}
+                self.pid = pid
+                self.stats_path = os.path.join(self.root, f'.stats-{pid}-{uuid.uuid4().hex[:8]}.json')
+            data = json.dumps(self.counters)
+            self.flushed = time.monotonic()
+        try:
+            with open(self.stats_path + '.tmp', 'w') as f:
+                f.write(data)
+            os.replace(self.stats_path + '.tmp', self.stats_path)
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Counters of all workers, past and present, added up"""
+        self.flush()
+        paths = glob.glob(os.path.join(self.root, '.stats-*.json'))
+        for path in paths:
+            if path != self.stats_path and not _alive(int(os.path.basename(path).split('-')[1])):
+                self._fold(path)
+        with self._locked_stats() as base:
+            totals = {backend: dict(counters) for backend, counters in base.items()}
+        for path in paths:
+            try:
+                with open(path) as f:
+                    process = json.load(f)
+            except (OSError, ValueError):
+                # Folded in just now
+                continue
+            _add(totals, process)
+        return totals
+
+    def size(self) -> int:
+        return sum(counters.get('bytes', 0) for counters in self.stats().values())
+
+    def _fold(self, path: str):
+        """Move the counters of a process that has gone into the shared totals"""
+        with self._locked_stats() as base:
+            try:
+                with open(path) as f:
+                    process = json.load(f)
+                os.unlink(path)
+            except (OSError, ValueError):
+                return
+            _add(base, process)
+
+    def _locked_stats(self):
+        return _LockedJSON(os.path.join(self.root, '.stats.json'))
+
+
+def _add(totals: Dict[str, Dict[str, int]], counters: Dict[str, Dict[str, int]]):
+    for backend, events in counters.items():
+        merged = totals.setdefault(backend, {})
+        for event, value in events.items():
+            merged[event] = merged.get(event, 0) + value
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _tree_size(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.stat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class _LockedJSON:
+    """Read-modify-write a small JSON file under an exclusive lock"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data: dict = {}
+
+    def __enter__(self) -> dict:
+        self.f = open(self.path, 'a+')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        self.f.seek(0)
+        try:
+            self.data = json.loads(self.f.read() or '{}')
+        except ValueError:
+            self.data = {}
+        return self.data
+
+    def __exit__(self, *exc):
+        self.f.seek(0)
+        self.f.truncate()
+        json.dump(self.data, self.f)
+        self.f.flush()
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
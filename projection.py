@@ -0,0 +1,206 @@
+"""
+Trim hound search responses down to the fields a client asked for
+Copyright (C) 2026 MediaWiki Codesearch contributors
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import codecs
+import json
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, Union
+
+# Fields of a matching line in hound's response
+LINE_FIELDS = frozenset(['Line', 'LineNumber', 'Before', 'After'])
+# A mode name, or the line fields to keep
+Projection = Union[str, FrozenSet[str]]
+MODES: Dict[str, Projection] = {
+    # Per repo numbers of matching files and lines
+    'counts': 'counts',
+    # Names of matching files
+    'files': 'files',
+    # Matching lines without the lines around them
+    'nocontext': frozenset(['Line', 'LineNumber']),
+}
+
+
+def parse_fields(value: str) -> Projection:
+    """
+    Parse the fields parameter: counts, files, nocontext, or a comma
+    separated list of line fields to keep. Raises ValueError if invalid.
+    """
+    if value in MODES:
+        return MODES[value]
+    fields = frozenset(field.strip() for field in value.split(',') if field.strip())
+    if not fields or not fields <= LINE_FIELDS:
+        raise ValueError(f'fields must be one of {", ".join(MODES)}, '
+                         f'or a list of {", ".join(sorted(LINE_FIELDS))}')
+    return fields
+
+
+def project_file(match: dict, projection: Projection) -> dict:
+    """Trim one file's entry in a repo's Matches"""
+    if projection == 'files':
+        return {'Filename': match['Filename']}
+    return dict(match, Matches=[{field: line[field] for field in projection if field in line}
+                                for line in match.get('Matches') or []])
+
+
+def project_results(data: dict, projection: Projection) -> dict:
+    """Trim a complete (already parsed) search response"""
+    results = {}
+    for repo, result in (data.get('Results') or {}).items():
+        matches = result.get('Matches') or []
+        if projection == 'counts':
+            result = {key: value for key, value in result.items() if key != 'Matches'}
+            result['LineMatches'] = sum(len(match.get('Matches') or []) for match in matches)
+        elif result.get('Matches') is not None:
+            result = dict(result, Matches=[project_file(match, projection) for match in matches])
+        results[repo] = result
+    return dict(data, Results=results)
+
+
+class _Reader:
+    """Just enough of an incremental JSON parser to walk a hound response"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.done = False
+
+    def _fill(self) -> bool:
+        if self.done:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.buf += self.decoder.decode(b'', final=True)
+            self.done = True
+            return True
+        # Drop what has been consumed, so only the current value is held
+        self.buf = self.buf[self.pos:] + self.decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON')
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} at {self.buf[self.pos:self.pos + 20]!r}')
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Read a complete value, e.g. a key or one file's matches"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A number could continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def members(self) -> Iterator[str]:
+        """Keys of an object, leaving the reader at each value"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+                continue
+            self.expect('}')
+            return
+
+    def items(self) -> Iterator[Any]:
+        """Values of an array"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+                continue
+            self.expect(']')
+            return
+
+
+def stream_projected(chunks: Iterable[bytes], projection: Projection) -> Iterator[str]:
+    """
+    Trim a search response while it is being received, holding no more
+    than one file's matches in memory at a time
+    """
+    reader = _Reader(chunks)
+    first = True
+    for key in reader.members():
+        yield ('{' if first else ',') + json.dumps(key) + ':'
+        first = False
+        if key != 'Results' or reader.peek() != '{':
+            yield json.dumps(reader.value())
+            continue
+        yield '{'
+        for i, repo in enumerate(reader.members()):
+            yield (',' if i else '') + json.dumps(repo) + ':'
+            yield from _stream_repo(reader, projection)
+        yield '}'
+    yield '{}' if first else '}'
+
+
+def _stream_repo(reader: _Reader, projection: Projection) -> Iterator[str]:
+    if reader.peek() != '{':
+        yield json.dumps(reader.value())
+        return
+    sep = '{'
+    lines = 0
+    for key in reader.members():
+        if key == 'Matches' and projection == 'counts':
+            lines = 0
+            if reader.peek() != '[':
+                reader.value()
+                continue
+            for match in reader.items():
+                lines += len(match.get('Matches') or [])
+            continue
+        if key != 'Matches' or reader.peek() != '[':
+            yield sep + json.dumps(key) + ':' + json.dumps(reader.value())
+        else:
+            yield sep + '"Matches":['
+            for i, match in enumerate(reader.items()):
+                yield (',' if i else '') + json.dumps(project_file(match, projection))
+            yield ']'
+        sep = ','
+    if projection == 'counts':
+        yield sep + '"LineMatches":' + str(lines)
+        sep = ','
+    yield '{}' if sep == '{' else '}'
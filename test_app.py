@@ -14,7 +14,13 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
 import json
+import sys
+import threading
+import time
+
 import pytest
 
 import app
@@ -28,10 +34,22 @@ def client():
         'extensions': 6081,
         'skins': 6082,
     }
+    app.app.config['SHARDS'] = {}
     with app.app.test_client() as client:
         yield client
 
 
+@pytest.fixture
+def sharded(client):
+    app.app.config['PORTS'] = {
+        'search-1': 6090,
+        'search-2': 6091,
+        'core': 6083,
+    }
+    app.app.config['SHARDS'] = {'search': ['search-1', 'search-2']}
+    yield client
+
+
 def test_homepage(client):
     # Redirect to /search/
     rv = client.get('/')
@@ -88,6 +106,7 @@ def test_metrics(mocker, client):
     health = {'search': 'starting up', 'extensions': 'up', 'skins': 'down'}
     mock = mocker.patch('app._health')
     mock.return_value = health
+    mocker.patch.object(app.process_stats, 'get', return_value={})
     rv = client.get('/_metrics')
     assert rv.data.decode() == """
 # HELP codesearch_backend Whether Hound backend is up or not
@@ -98,6 +117,173 @@ codesearch_backend{backend="skins"} 0
 """
 
 
+def test_process_metrics(client, mocker, monkeypatch):
+    stats = app.ProcessStats()
+    monkeypatch.setattr(app, 'process_stats', stats)
+    monkeypatch.setitem(app.app.config, 'PORTS', {'search': 6080})
+    hound_pid = mocker.patch('app.hound_pid', return_value=app.os.getpid())
+    stats.sample_all()
+    stats.sample_all()
+    # The PID is remembered while the process lives
+    assert hound_pid.call_count == 1
+    sample = stats.samples['search']
+    assert sample['rss'] > 0
+    assert sample['threads'] >= 1
+    mocker.patch.object(stats, 'get', return_value={'search': dict(sample, rss=1234567890)})
+    text = app.process_metrics()
+    assert 'codesearch_hound_resident_memory_bytes{backend="search"} 1234567890\n' in text
+    assert 'codesearch_hound_cpu_seconds_total{backend="search",mode="user"}' in text
+    assert '# TYPE codesearch_hound_cpu_seconds_total counter' in text
+
+    # Backends that aren't running are left out
+    hound_pid.return_value = 0
+    stats.pids.clear()
+    stats.sample_all()
+    assert stats.samples == {}
+
+
+def test_hound_pid(client, mocker, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.app.config, 'PORTS', {'search': 6080, 'core': 6081})
+    # Any binary will do, /proc only has to call it houndd
+    (tmp_path / 'houndd').symlink_to(sys.executable)
+    proc = app.subprocess.Popen([str(tmp_path / 'houndd'), '-c', 'import time; time.sleep(30)',
+                                 '-conf', str(tmp_path / 'hound-search' / 'config.json')])
+    try:
+        deadline = time.monotonic() + 10
+        while app.process_name(proc.pid) != 'houndd' and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert app.hound_pid('search') == proc.pid
+        assert app.hound_pid('core') == 0
+    finally:
+        proc.kill()
+        proc.wait()
+
+    # In a container, the config is in whatever directory is mounted there
+    mountinfo = ('1 0 8:1 / / rw - ext4 /dev/sda1 rw\n'
+                 '2 1 8:2 /hound/hound-core-green /data rw - ext4 /dev/sdb1 rw\n')
+    mocker.patch('app.open', create=True, side_effect=[
+        mocker.mock_open(read_data=b'./houndd\0-conf\0/data/config.json\0')(),
+        mocker.mock_open(read_data=mountinfo)(),
+    ])
+    assert app.houndd_instance(1) == 'hound-core-green'
+
+
+def test_canaries(client, requests_mock, mocker, monkeypatch):
+    canaries = app.Canaries()
+    monkeypatch.setattr(app, 'canaries', canaries)
+    mocker.patch.object(canaries, 'wanted')
+    monkeypatch.setitem(app.app.config, 'PORTS', {'search': 6080})
+    monkeypatch.setitem(app.app.config, 'CANARY_QUERIES', {
+        'default': [{'name': 'core', 'q': 'wfGetDB', 'repos': 'MediaWiki core'}],
+    })
+    mock = requests_mock.get('http://localhost:6080/api/v1/search',
+                             json={'Results': {'MediaWiki core': {'FilesWithMatch': 3}}})
+    canaries.run_all()
+    assert mock.last_request.qs == {'q': ['wfgetdb'], 'repos': ['mediawiki core']}
+    assert canaries.results[('search', 'core')]['files'] == 3
+    assert app._health()['search'] == 'up'
+    assert 'codesearch_canary_files{backend="search",query="core"} 3' in app.canary_metrics()
+
+    monkeypatch.setitem(app.app.config, 'CANARY_DEGRADED_SECONDS', -1)
+    assert app._health()['search'] == 'degraded'
+    monkeypatch.setitem(app.app.config, 'CANARY_DEGRADED_SECONDS', 5)
+    requests_mock.get('http://localhost:6080/api/v1/search', status_code=500)
+    canaries.run_all()
+    assert canaries.degraded('search')
+    assert 'codesearch_canary_failures_total{backend="search",query="core"} 1' in app.canary_metrics()
+
+    # Starting up isn't a failure, that's reported separately
+    requests_mock.get('http://localhost:6080/api/v1/search', text=app.HOUND_STARTUP)
+    canaries.results.clear()
+    canaries.run_all()
+    assert canaries.results == {}
+
+
+class FakeHound(BaseHTTPRequestHandler):
+    """Answers every search with the host it is listening on"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = json.dumps({'Results': {self.server.server_address[0]: {}}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def nodes():
+    """Hound stand-ins on two loopback addresses, acting as separate hosts"""
+    servers = [ThreadingHTTPServer((host, 0), FakeHound) for host in ('127.0.0.1', '127.0.0.2')]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield ['%s:%d' % server.server_address for server in servers]
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_remote_nodes(client, nodes, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.app.config, 'PORTS', {
+        'search': nodes[0], 'extensions': nodes[1], 'skins': '127.0.0.3:1',
+    })
+    monkeypatch.setattr(app, 'DATA', str(tmp_path))
+    config = tmp_path / 'nodes' / '127.0.0.2' / 'hound-extensions'
+    config.mkdir(parents=True)
+    (config / 'config.json').write_text('{"repos": {"Foo": {"url": "foo"}}}')
+    assert json.loads(client.get('/extensions/config.json').data)['repos'] == {'Foo': {'url': 'foo'}}
+    assert app.hound_url('extensions') == f'http://{nodes[1]}'
+    assert app.target(6080) == 'localhost:6080'
+    assert not app.is_local('extensions')
+    rv = client.get('/extensions/api/v1/search?q=foo')
+    assert json.loads(rv.data) == {'Results': {'127.0.0.2': {}}}
+
+    health = json.loads(client.get('/_health.json?nodes=1').data)
+    assert health['backends'] == {'search': 'up', 'extensions': 'up', 'skins': 'down'}
+    assert health['nodes'] == {
+        '127.0.0.1': {'status': 'up', 'backends': {'search': 'up'}},
+        '127.0.0.2': {'status': 'up', 'backends': {'extensions': 'up'}},
+        '127.0.0.3': {'status': 'down', 'backends': {'skins': 'down'}},
+    }
+
+
+def test_reload_topology(client, data_dir, monkeypatch):
+    monkeypatch.setattr(app, 'shards_file', app.WatchedFile('shards.json'))
+    monkeypatch.setattr(app, 'placement_file', app.WatchedFile('placement.json'))
+    monkeypatch.setattr(app, 'base_ports', {'search-1': 6090, 'search-2': 6091, 'core': 6083})
+    monkeypatch.setitem(app.app.config, 'PORTS', dict(app.base_ports))
+    monkeypatch.setitem(app.app.config, 'SHARDS', {})
+
+    def write(name, data, mtime):
+        (data_dir / name).write_text(json.dumps(data))
+        app.os.utime(data_dir / name, (mtime, mtime))
+
+    # Nothing written yet leaves the configured topology alone
+    client.get('/_repos')
+    assert app.app.config['SHARDS'] == {}
+    write('shards.json', {'search': ['search-1', 'search-2']}, 1000)
+    client.get('/_repos')
+    assert app.is_backend('search')
+    assert app.app.config['SHARDS'] == {'search': ['search-1', 'search-2']}
+    (data_dir / 'shards.json').unlink()
+    client.get('/_repos')
+    assert not app.is_backend('search')
+
+    write('placement.json', {'targets': {'search-1': '10.0.0.2:6090', 'core': '10.0.0.3:6083'}}, 1000)
+    client.get('/_repos')
+    assert app.app.config['PORTS'] == {'search-1': '10.0.0.2:6090', 'search-2': 6091, 'core': '10.0.0.3:6083'}
+    # Rebuilt from the configured ports, so instances moved back are local again
+    write('placement.json', {'targets': {'search-2': '10.0.0.2:6091'}}, 2000)
+    client.get('/_repos')
+    assert app.app.config['PORTS'] == {'search-1': 6090, 'search-2': '10.0.0.2:6091', 'core': 6083}
+    (data_dir / 'placement.json').unlink()
+    client.get('/_repos')
+    assert app.app.config['PORTS'] == app.base_ports
+
+
 @pytest.mark.parametrize('input,expected', ((
     ('<title>Hound</title>', '<title>Hound: search - MediaWiki Codesearch</title>'),
     (app.HOUND_STARTUP, 'Hound is still starting up')
@@ -111,3 +297,614 @@ def test_backend(client, requests_mock, input, expected):
 def test_invalid_backend(client):
     rv = client.get('/foobarbaz/')
     assert b'invalid backend' == rv.data
+
+
+def test_sharded_index(sharded, requests_mock):
+    requests_mock.get('http://localhost:6090/', text='<body>')
+    rv = sharded.get('/search/')
+    assert '<ul><li class="index"><a href="/search/">search</a></li>' \
+           '<li class="index"><a href="/core/">core</a></li></ul>' in rv.data.decode()
+
+
+def test_sharded_search(sharded, requests_mock):
+    requests_mock.get('http://localhost:6090/api/v1/search', json={
+        'Results': {'MediaWiki core': {'Matches': [], 'FilesWithMatch': 1}},
+        'Stats': {'FilesOpened': 3, 'Duration': 10},
+    })
+    requests_mock.get('http://localhost:6091/api/v1/search', json={
+        'Results': {'Extension:Foo': {'Matches': [], 'FilesWithMatch': 2}},
+        'Stats': {'FilesOpened': 4, 'Duration': 20},
+    })
+    rv = sharded.get('/search/api/v1/search?q=foo&repos=*')
+    assert rv.status_code == 200
+    assert json.loads(rv.data.decode()) == {
+        'Results': {
+            'MediaWiki core': {'Matches': [], 'FilesWithMatch': 1},
+            'Extension:Foo': {'Matches': [], 'FilesWithMatch': 2},
+        },
+        'Stats': {'FilesOpened': 7, 'Duration': 20},
+    }
+    assert 'X-Codesearch-Missing-Shards' not in rv.headers
+    assert 'search-1' in app.shard_metrics()
+
+
+def test_sharded_search_partial(sharded, requests_mock):
+    requests_mock.get('http://localhost:6090/api/v1/search', json={'Results': {'MediaWiki core': {}}})
+    requests_mock.get('http://localhost:6091/api/v1/search', text=app.HOUND_STARTUP)
+    rv = sharded.get('/search/api/v1/search?q=foo')
+    assert rv.status_code == 200
+    assert rv.headers['X-Codesearch-Missing-Shards'] == 'search-2'
+    assert json.loads(rv.data.decode()) == {'Results': {'MediaWiki core': {}}}
+
+
+def test_shard_latency_errors(sharded, requests_mock, monkeypatch):
+    monkeypatch.setattr(app, '_shard_latency', {})
+    requests_mock.get('http://localhost:6090/api/v1/search', json={'Results': {}})
+    requests_mock.get('http://localhost:6091/api/v1/search', exc=app.requests.exceptions.ReadTimeout)
+    sharded.get('/search/api/v1/search?q=foo')
+    requests_mock.get('http://localhost:6091/api/v1/search', exc=app.requests.exceptions.ConnectionError)
+    sharded.get('/search/api/v1/search?q=foo')
+    requests_mock.get('http://localhost:6091/api/v1/search', status_code=500, text='oops')
+    sharded.get('/search/api/v1/search?q=foo')
+    counts = [line.rsplit(' ', 1) for line in app.shard_metrics().splitlines()
+              if line.startswith('codesearch_shard_request_duration_seconds_count')]
+    assert counts == [
+        ['codesearch_shard_request_duration_seconds_count{backend="search",shard="search-1",outcome="ok"}', '3'],
+        ['codesearch_shard_request_duration_seconds_count{backend="search",shard="search-2",outcome="error"}', '2'],
+        ['codesearch_shard_request_duration_seconds_count{backend="search",shard="search-2",outcome="timeout"}', '1'],
+    ]
+
+
+def test_sharded_search_starting_up(sharded, requests_mock):
+    requests_mock.get('http://localhost:6090/api/v1/search', text=app.HOUND_STARTUP)
+    requests_mock.get('http://localhost:6091/api/v1/search', text=app.HOUND_STARTUP)
+    rv = sharded.get('/search/api/v1/search?q=foo')
+    assert rv.status_code == 503
+    assert 'Hound is still starting up' in rv.data.decode()
+
+
+def test_sharded_health(mocker, sharded, requests_mock):
+    requests_mock.get('http://localhost:6090/api/v1/search', text='{}')
+    requests_mock.get('http://localhost:6091/api/v1/search', text=app.HOUND_STARTUP)
+    requests_mock.get('http://localhost:6083/api/v1/search', text='{}')
+    assert app._health() == {
+        'core': 'up',
+        'search': 'starting up',
+        'search-1': 'up',
+        'search-2': 'starting up',
+    }
+
+
+def test_health_json_long_poll(mocker, client):
+    health = {'search': 'starting up', 'extensions': 'up', 'skins': 'down'}
+    mocker.patch('app._health').return_value = health
+    mocker.patch.dict(app.app.config, {'HEALTH_INTERVAL': 0.01})
+    rv = client.get('/_health.json?wait=5')
+    assert rv.status_code == 200
+    assert json.loads(rv.data.decode()) == health
+    etag = rv.headers['etag']
+    # Nothing changes, so the client is told so once the wait is over
+    rv2 = client.get('/_health.json?wait=0.1', headers={'if-none-match': etag})
+    assert rv2.status_code == 304
+    # A change wakes up the waiting client
+    health['search'] = 'up'
+    rv3 = client.get('/_health.json?wait=5', headers={'if-none-match': etag})
+    assert rv3.status_code == 200
+    assert json.loads(rv3.data.decode())['search'] == 'up'
+    # Let the background thread go away
+    thread = app.health_monitor.thread
+    app.health_monitor.last_wanted = float('-inf')
+    thread.join()
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DATA', str(tmp_path))
+    monkeypatch.setitem(app.app.config, 'INDEXING_HISTORY', str(tmp_path / 'history.json'))
+    instance = tmp_path / 'hound-search'
+    (instance / 'data').mkdir(parents=True)
+    (instance / 'config.json').write_text(json.dumps({
+        'repos': {name: {'url': name} for name in 'abcd'}
+    }))
+    yield tmp_path
+
+
+def test_indexing_progress(client, data_dir, monkeypatch, requests_mock):
+    monkeypatch.setitem(app._indexing_since, 'search', 1000.0)
+    (data_dir / 'hound-search' / 'data' / 'idx-1').mkdir()
+    (data_dir / 'hound-search' / 'data' / 'idx-2').mkdir()
+    progress = app.indexing_progress('search')
+    assert progress['indexed'] == 2
+    assert progress['total'] == 4
+    # Guessed from the rate so far
+    assert progress['eta'] == progress['elapsed']
+
+    app.record_indexing_duration('search', 600)
+    monkeypatch.setitem(app._indexing_since, 'search', app.time.time() - 100)
+    assert app.indexing_progress('search')['eta'] == 500
+
+    requests_mock.get('http://localhost:6080/api/v1/search', text=app.HOUND_STARTUP)
+    rv = client.get('/search/api/v1/search')
+    assert rv.status_code == 503
+    assert 'Indexed 2 of 4 repositories so far, roughly 9 minutes to go.' in rv.data.decode()
+
+
+def test_track_indexing(client, data_dir, monkeypatch, mocker):
+    monkeypatch.setattr(app, '_indexing_since', {})
+    monkeypatch.setattr(app, '_indexing_checked', {})
+    mocker.patch('app.unit_start_time', return_value=1000)
+    finished = mocker.patch('app.indexing_finished_time', return_value=1600.0)
+    app.track_indexing('search', 'starting up')
+    assert app._indexing_since['search'] == 1000
+    app.track_indexing('search', 'up')
+    assert app.indexing_history() == {'search': [600]}
+    app.track_indexing('search', 'up')
+    assert finished.call_count == 1
+
+    # Another worker that saw the same startup doesn't record it again
+    monkeypatch.setattr(app, '_indexing_since', {})
+    monkeypatch.setattr(app, '_indexing_checked', {})
+    app.track_indexing('search', 'starting up')
+    app.track_indexing('search', 'up')
+    assert app.indexing_history() == {'search': [600]}
+
+    # Restarted while nobody was looking, hound's log still tells
+    app.unit_start_time.return_value = 2000
+    finished.return_value = 2300.0
+    monkeypatch.setattr(app, '_indexing_checked', {})
+    app.track_indexing('search', 'up')
+    assert app.indexing_history() == {'search': [600, 300]}
+
+    # Without the log, only a startup that was seen can be timed
+    app.unit_start_time.return_value = 3000
+    finished.return_value = None
+    monkeypatch.setattr(app, '_indexing_checked', {})
+    app.track_indexing('search', 'up')
+    assert app.indexing_history() == {'search': [600, 300]}
+    app.unit_start_time.return_value = app.time.time() - 60
+    app.track_indexing('search', 'starting up')
+    app.track_indexing('search', 'up')
+    assert app.indexing_history()['search'][-1] == 60
+
+
+def test_disk_usage(data_dir, mocker):
+    clone = data_dir / 'hound-search' / 'data' / ('vcs-' + app.hashlib.sha1(b'a').hexdigest())
+    (clone / '.git').mkdir(parents=True)
+    (clone / 'README').write_text('x' * 100)
+    (data_dir / 'hound-search' / 'data' / 'idx-1').mkdir()
+    (data_dir / 'hound-search' / 'data' / 'idx-1' / 'tri').write_text('y' * 50)
+    disk_usage = app.DiskUsage()
+    usage = disk_usage.collect(10)
+    assert usage['search']['a'] == (100, 3)
+    assert usage['search']['(index)'] == (50, 2)
+
+    # Nothing changed, so nothing is walked again
+    measure = mocker.spy(disk_usage, 'measure')
+    assert disk_usage.collect(10) == usage
+    assert measure.call_count == 0
+
+    # Out of budget, so the old numbers are kept for now
+    (clone / '.git' / 'FETCH_HEAD').write_text('')
+    app.os.utime(clone / '.git', (0, 0))
+    assert disk_usage.collect(0)['search']['a'] == (100, 3)
+    assert disk_usage.pending == 1
+    assert disk_usage.collect(10)['search']['a'] == (100, 4)
+    assert disk_usage.pending == 0
+
+
+def test_disk_usage_resumes(data_dir, mocker):
+    clone = data_dir / 'hound-search' / 'data' / ('vcs-' + app.hashlib.sha1(b'a').hexdigest())
+    (clone / '.git').mkdir(parents=True)
+    for i in range(5):
+        (clone / f'dir{i}').mkdir()
+        (clone / f'dir{i}' / 'file').write_text('x' * 10)
+    disk_usage = app.DiskUsage()
+    # Every check of the clock takes a second
+    mocker.patch.object(app.time, 'monotonic', side_effect=itertools.count())
+    scandir = mocker.spy(app.os, 'scandir')
+    scrapes = 0
+    while 'a' not in disk_usage.collect(3)['search']:
+        scrapes += 1
+        assert scrapes < 10
+    assert scrapes > 1
+    assert disk_usage.collect(3)['search']['a'] == (50, 12)
+    # Each directory was only looked at once, however many scrapes it took
+    clone_dirs = [call.args[0] for call in scandir.call_args_list if str(call.args[0]).startswith(str(clone))]
+    assert sorted(clone_dirs) == sorted(set(clone_dirs))
+
+
+@pytest.fixture
+def cached(client, data_dir, monkeypatch):
+    monkeypatch.setattr(app, 'shared_cache', app.SharedCache(str(data_dir / 'cache'), 1024 * 1024))
+    monkeypatch.setattr(app, '_generations', {})
+    monkeypatch.setattr(app, '_stored_generations', {})
+    yield client
+
+
+def test_shared_cache(cached, data_dir, requests_mock, monkeypatch):
+    mock = requests_mock.get('http://localhost:6080/api/v1/search', json={'Results': {}})
+    assert cached.get('/search/api/v1/search?q=foo').status_code == 200
+    assert json.loads(cached.get('/search/api/v1/search?q=foo').data) == {'Results': {}}
+    assert mock.call_count == 1
+    # A different query isn't a hit
+    cached.get('/search/api/v1/search?q=bar')
+    assert mock.call_count == 2
+
+    # Reindexing invalidates the cache
+    (data_dir / 'hound-search' / 'data' / 'idx-1').mkdir()
+    monkeypatch.setattr(app, '_generations', {})
+    cached.get('/search/api/v1/search?q=foo')
+    assert mock.call_count == 3
+    assert 'codesearch_cache_requests_total{backend="search",result="hit"} 1' in app.cache_metrics()
+
+
+def test_shared_cache_errors(cached, requests_mock):
+    mock = requests_mock.get('http://localhost:6080/api/v1/search', text=app.HOUND_STARTUP)
+    assert cached.get('/search/api/v1/search?q=foo').status_code == 503
+    assert cached.get('/search/api/v1/search?q=foo').status_code == 503
+    assert mock.call_count == 2
+
+
+def test_shared_cache_stale(cached, data_dir, requests_mock, monkeypatch):
+    requests_mock.get('http://localhost:6080/api/v1/search', json={'Results': {}})
+    cached.get('/search/api/v1/search?q=foo')
+    # Restarted with a new index that isn't ready yet
+    (data_dir / 'hound-search' / 'data' / 'idx-1').mkdir()
+    monkeypatch.setattr(app, '_generations', {})
+    mock = requests_mock.get('http://localhost:6080/api/v1/search', text=app.HOUND_STARTUP)
+    rv = cached.get('/search/api/v1/search?q=foo')
+    assert rv.status_code == 200
+    assert rv.headers['X-Codesearch-Stale'] == '1'
+    assert json.loads(rv.data) == {'Results': {}}
+    assert cached.get('/search/api/v1/search?q=bar').status_code == 503
+    assert mock.call_count == 2
+
+    # Once the new index answers, the old one is dropped
+    requests_mock.get('http://localhost:6080/api/v1/search', json={'Results': {'x': {}}})
+    cached.get('/search/api/v1/search?q=foo')
+    assert list(app.shared_cache.generations('search')) == [app.index_generation('search')]
+
+
+def test_active_slot(client, data_dir, requests_mock, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'STANDBY_PORTS', {'search': 7080})
+    assert app.hound_url('search') == 'http://localhost:6080'
+    (data_dir / 'hound-search' / 'active').write_text('green\n')
+    (data_dir / 'hound-search-green').mkdir()
+    (data_dir / 'hound-search-green' / 'config.json').write_text(json.dumps({'repos': {'e': {}}}))
+    assert app.hound_url('search') == 'http://localhost:7080'
+    assert app.instance_repos('search') == {'e'}
+    requests_mock.get('http://localhost:7080/api/v1/search', json={'Results': {}})
+    assert client.get('/search/api/v1/search?q=foo').status_code == 200
+    # Only instances with a standby copy can be switched
+    monkeypatch.setitem(app.app.config, 'STANDBY_PORTS', {})
+    assert app.hound_url('search') == 'http://localhost:6080'
+
+
+def test_search_fields(cached, requests_mock):
+    requests_mock.get('http://localhost:6080/api/v1/search', json={'Results': {'a': {
+        'Matches': [{'Filename': 'f', 'Matches': [{'Line': 'x', 'LineNumber': 1, 'Before': [], 'After': []}]}],
+        'FilesWithMatch': 1, 'Revision': 'r',
+    }}}, headers={'Content-Type': 'application/json;charset=utf-8'})
+    rv = cached.get('/search/api/v1/search?q=x&fields=counts')
+    assert json.loads(rv.data) == {'Results': {'a': {'FilesWithMatch': 1, 'Revision': 'r', 'LineMatches': 1}}}
+    assert 'fields' not in requests_mock.last_request.qs
+    # Trimmed from the complete response once that is cached
+    cached.get('/search/api/v1/search?q=x')
+    rv = cached.get('/search/api/v1/search?q=x&fields=files')
+    assert rv.headers['X-Codesearch-Refined'] == 'fields'
+    assert json.loads(rv.data)['Results']['a']['Matches'] == [{'Filename': 'f'}]
+    assert requests_mock.call_count == 2
+    assert cached.get('/search/api/v1/search?q=x&fields=Nope').status_code == 400
+
+
+def test_batch(client, requests_mock, monkeypatch, mocker):
+    mock = requests_mock.get('http://localhost:6080/api/v1/search', json={'Results': {}})
+    rv = client.post('/_batch', json={'queries': [
+        {'id': 'a', 'backend': 'search', 'q': 'wfGetDB'},
+        {'id': 'b', 'backend': 'nope', 'q': 'wfGetDB'},
+        {'id': 'c', 'backend': 'search', 'q': 'wfGetDB'},
+        {'id': 'd', 'backend': 'search', 'q': 'wfFoo', 'files': 'php$'},
+    ]})
+    assert rv.mimetype == 'application/x-ndjson'
+    lines = {line['id']: line for line in map(json.loads, rv.data.decode().splitlines())}
+    assert sorted(lines) == ['a', 'b', 'c', 'd']
+    assert lines['a']['result'] == {'Results': {}}
+    assert lines['a']['status'] == 200 and lines['a']['index'] == 0
+    assert lines['b']['status'] == 404
+    assert lines['c']['result'] == lines['a']['result']
+    # The identical query only went to hound once
+    assert mock.call_count == 2
+    assert {'q': ['wffoo'], 'files': ['php$']} in [r.qs for r in mock.request_history]
+
+    # Rate limits apply to each query, which waits for its turn
+    monkeypatch.setitem(app.app.config, 'RATE_LIMITS', {'default': {'rate': 10, 'burst': 1}})
+    monkeypatch.setattr(app, 'rate_limiter', app.RateLimiter())
+    rv = client.post('/_batch', json={'queries': [{'backend': 'search', 'q': 'xyz'}, {'backend': 'search', 'q': 'abc'}]})
+    assert [json.loads(line)['status'] for line in rv.data.decode().splitlines()] == [200, 200]
+    assert app.rate_limiter.top(1)[0][2] >= 1
+
+    assert client.post('/_batch', json={'nope': 1}).status_code == 400
+    monkeypatch.setitem(app.app.config, 'BATCH_MAX_QUERIES', 1)
+    assert client.post('/_batch', json={'queries': [{}, {}]}).status_code == 400
+
+
+def test_batch_throttled_client(client, requests_mock, monkeypatch):
+    requests_mock.get('http://localhost:6080/api/v1/search', json={'Results': {}})
+    monkeypatch.setitem(app.app.config, 'RATE_LIMITS', {'default': {'rate': 1, 'burst': 1}})
+    monkeypatch.setitem(app.app.config, 'RATE_LIMIT_TOKENS', {'t1': 'team1', 't2': 'team2'})
+    monkeypatch.setitem(app.app.config, 'BATCH_CONCURRENCY', 1)
+    monkeypatch.setattr(app, 'rate_limiter', app.RateLimiter())
+    monkeypatch.setattr(app, '_batch_slots', {})
+    slow = threading.Thread(target=lambda: app.app.test_client().post('/_batch', json={
+        'queries': [{'backend': 'search', 'q': q} for q in ('abc', 'def', 'ghi')]},
+        headers={'X-Codesearch-Token': 't1'}).data)
+    slow.start()
+    while requests_mock.call_count < 1:
+        time.sleep(0.01)
+    # The first client waiting for its budget doesn't hold the only slot
+    start = time.monotonic()
+    rv = client.post('/_batch', json={'queries': [{'backend': 'search', 'q': 'xyz'}]},
+                     headers={'X-Codesearch-Token': 't2'})
+    assert json.loads(rv.data)['status'] == 200
+    assert time.monotonic() - start < 0.5
+    slow.join()
+    assert requests_mock.call_count == 4
+
+
+def test_git_revision(tmp_path):
+    git = tmp_path / '.git'
+    (git / 'refs' / 'heads').mkdir(parents=True)
+    (git / 'HEAD').write_text('ref: refs/heads/master\n')
+    (git / 'packed-refs').write_text('# pack-refs\naaa refs/heads/master\n')
+    assert app.git_revision(str(tmp_path)) == 'aaa'
+    (git / 'refs' / 'heads' / 'master').write_text('bbb\n')
+    assert app.git_revision(str(tmp_path)) == 'bbb'
+    (git / 'HEAD').write_text('ccc\n')
+    assert app.git_revision(str(tmp_path)) == 'ccc'
+    assert app.git_revision(str(tmp_path / 'nope')) is None
+
+
+def test_saved_queries(client, data_dir, requests_mock, monkeypatch, mocker):
+    monkeypatch.setitem(app.app.config, 'SAVED_QUERIES_DIR', str(data_dir / 'saved'))
+    monkeypatch.setitem(app.app.config, 'RATE_LIMIT_TOKENS', {'t1': 'team1', 't2': 'team2', 't3': 'ops'})
+    monkeypatch.setitem(app.app.config, 'SAVED_QUERIES_ADMINS', ['ops'])
+    monkeypatch.setattr(app, '_generations', {})
+    monkeypatch.setattr(app, '_revisions', {})
+    team1 = {'X-Codesearch-Token': 't1'}
+
+    def set_revision(repo, revision):
+        git = data_dir / 'hound-search' / 'data' / ('vcs-' + app.hashlib.sha1(repo.encode()).hexdigest()) / '.git'
+        git.mkdir(parents=True, exist_ok=True)
+        (git / 'HEAD').write_text(revision)
+
+    def reindex(n):
+        (data_dir / 'hound-search' / 'data' / f'idx-{n}').mkdir()
+        monkeypatch.setattr(app, '_generations', {})
+
+    def result(*lines):
+        return {'Results': {'a': {'Matches': [{'Filename': 'f', 'Matches': [
+            {'Line': line, 'LineNumber': i} for i, line in enumerate(lines)]}], 'FilesWithMatch': 1}}}
+
+    set_revision('a', '1')
+    set_revision('b', '1')
+    mock = requests_mock.get('http://localhost:6080/api/v1/search', json=result('foo'))
+    query = {'backend': 'search', 'q': 'foo', 'repos': 'a'}
+    assert client.put('/_saved/deprecated', json=query).status_code == 401
+    rv = client.put('/_saved/deprecated', json=query, headers=team1)
+    assert json.loads(rv.data)['result'] == result('foo')
+    assert mock.call_count == 1
+    listing = json.loads(client.get('/_saved').data)['deprecated']
+    assert listing['params'] == {'q': 'foo', 'repos': 'a'}
+    assert listing['owner'] == 'team1'
+    assert client.put('/_saved/deprecated', json=query, headers={'X-Codesearch-Token': 't2'}).status_code == 403
+    assert client.delete('/_saved/deprecated', headers={'X-Codesearch-Token': 't2'}).status_code == 403
+    assert client.delete('/_saved/deprecated').status_code == 401
+
+    # A repo the query can't match changed
+    set_revision('b', '2')
+    reindex(1)
+    refresh_later = mocker.patch.object(app.saved_queries, 'refresh_later')
+    assert json.loads(client.get('/_saved/deprecated').data)['result'] == result('foo')
+    refresh_later.assert_called_once_with('deprecated')
+    assert app.saved_queries.refresh('deprecated') is False
+    assert mock.call_count == 1
+
+    set_revision('a', '2')
+    reindex(2)
+    requests_mock.get('http://localhost:6080/api/v1/search', json=result('bar', 'foo'))
+    assert app.saved_queries.refresh('deprecated') is True
+    assert json.loads(client.get('/_saved/deprecated').data)['result'] == result('bar', 'foo')
+    diff = json.loads(client.get('/_saved/deprecated/diff').data)
+    assert diff['added'] == {'a': {'f': [{'Line': 'bar', 'LineNumber': 0}]}}
+    # Only moved down a line
+    assert diff['removed'] == {}
+    assert diff['since'] < diff['refreshed']
+
+    # Admins can change anyone's query, without taking it over
+    repo_revisions = mocker.spy(app, 'repo_revisions')
+    client.put('/_saved/deprecated', json=query, headers={'X-Codesearch-Token': 't3'})
+    assert json.loads(client.get('/_saved/deprecated').data)['owner'] == 'team1'
+    # The revisions of the same index are only looked up once
+    assert repo_revisions.call_count == 0
+
+    # Deleted or changed while waiting for the lock
+    saved = app.saved_queries.load('deprecated')
+    calls = requests_mock.call_count
+    for current in (None, dict(saved, params={'q': 'other'})):
+        mocker.patch.object(app.saved_queries, 'load', side_effect=[saved, current])
+        assert app.saved_queries.refresh('deprecated', force=True) is False
+    mocker.stopall()
+    assert requests_mock.call_count == calls
+    assert client.delete('/_saved/deprecated', headers=team1).status_code == 204
+    assert client.get('/_saved/deprecated').status_code == 404
+    assert client.put('/_saved/x', json={'backend': 'nope', 'q': 'x'}, headers=team1).status_code == 400
+    assert client.get('/_saved/a%20b').status_code == 400
+    assert client.get('/_saved/deprecated%0A').status_code == 400
+
+
+def test_saved_queries_remote(client, data_dir, requests_mock, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'SAVED_QUERIES_DIR', str(data_dir / 'saved'))
+    monkeypatch.setitem(app.app.config, 'RATE_LIMIT_TOKENS', {'t1': 'team1'})
+    monkeypatch.setitem(app.app.config, 'PORTS', {'search': '10.0.0.2:6080'})
+    monkeypatch.setattr(app, '_generations', {})
+    monkeypatch.setattr(app, '_revisions', {})
+    config = data_dir / 'nodes' / '10.0.0.2' / 'hound-search'
+    config.mkdir(parents=True)
+    (config / 'config.json').write_text('{"repos": {"a": {"url": "a"}}}')
+    # Hound's index and clones are on the other node
+    assert app.index_generation('search') is None
+    assert app.repo_revisions('search') == {'a': None}
+
+    mock = requests_mock.get('http://10.0.0.2:6080/api/v1/search', json={'Results': {}})
+    client.put('/_saved/remote', json={'backend': 'search', 'q': 'foo'}, headers={'X-Codesearch-Token': 't1'})
+    assert mock.call_count == 1
+    assert app.saved_queries.refresh('remote') is False
+    # So it is run again once it is old enough
+    monkeypatch.setitem(app.app.config, 'SAVED_QUERIES_MAX_AGE', 0)
+    assert app.saved_queries.refresh('remote') is True
+    assert mock.call_count == 2
+
+
+def test_repo_directory(client, data_dir, monkeypatch, mocker):
+    monkeypatch.setattr(app, 'repo_directory', app.RepoDirectory())
+    monkeypatch.setattr(app, '_generations', {})
+    monkeypatch.setattr(app, '_revisions', {})
+    assert client.get('/_repos').status_code == 404
+
+    (data_dir / 'directory.json').write_text(json.dumps({'repos': {
+        'a': {'url': 'a', 'poll': 60, 'backends': ['search', 'core']},
+        'e': {'url': 'e', 'poll': 60, 'backends': ['core']},
+    }}))
+    git = data_dir / 'hound-search' / 'data' / ('vcs-' + app.hashlib.sha1(b'a').hexdigest()) / '.git'
+    git.mkdir(parents=True)
+    (git / 'HEAD').write_text('1')
+    repo_revisions = mocker.spy(app, 'repo_revisions')
+    rv = client.get('/_repos')
+    assert json.loads(rv.data)['repos'] == {
+        'a': {'url': 'a', 'poll': 60, 'backends': {'search': '1', 'core': None}},
+        'e': {'url': 'e', 'poll': 60, 'backends': {'core': None}},
+    }
+    etag = rv.headers['ETag']
+    assert client.get('/_repos', headers={'If-None-Match': etag}).status_code == 304
+
+    # Only the backend that reindexed is looked at again
+    repo_revisions.reset_mock()
+    (git / 'HEAD').write_text('2')
+    (data_dir / 'hound-search' / 'data' / 'idx-1').mkdir()
+    monkeypatch.setattr(app, '_generations', {})
+    rv = client.get('/_repos', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert json.loads(rv.data)['repos']['a']['backends'] == {'search': '2', 'core': None}
+    assert [call.args for call in repo_revisions.call_args_list] == [('search',)]
+    assert rv.headers['ETag'] != etag
+
+
+def test_diff_results():
+    old = {'Results': {'a': {'Matches': [{'Filename': 'f'}, {'Filename': 'g'}], 'FilesWithMatch': 2}}}
+    new = {'Results': {'a': {'Matches': [{'Filename': 'g'}, {'Filename': 'h'}], 'FilesWithMatch': 2},
+                       'b': {'Matches': [{'Filename': 'f', 'Matches': [{'Line': 'x'}, {'Line': 'x'}]}],
+                             'FilesWithMatch': 1}}}
+    diff = app.diff_results(old, new)
+    assert diff['added'] == {'a': {'h': []}, 'b': {'f': [{'Line': 'x'}, {'Line': 'x'}]}}
+    assert diff['removed'] == {'a': {'f': []}}
+    assert diff['counts'] == {'b': [0, 1]}
+
+
+def test_query_cost():
+    assert app.query_cost({'q': 'wfGetDB', 'repos': 'MediaWiki core'}) == 1
+    assert app.query_cost({'q': 'wfGetDB'}) == 2
+    assert app.query_cost({'q': 'a.*b', 'repos': 'MediaWiki core'}) == 4
+    assert app.query_cost({'q': 'a.*b', 'literal': 'true', 'repos': 'MediaWiki core'}) == 1
+
+
+def test_rate_limit(client, requests_mock, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'RATE_LIMITS', {'search': {'rate': 0.5, 'burst': 4}})
+    monkeypatch.setitem(app.app.config, 'RATE_LIMIT_TOKENS', {'secret': 'mybot'})
+    monkeypatch.setattr(app, 'rate_limiter', app.RateLimiter())
+    requests_mock.get('http://localhost:6080/api/v1/search', text='{}')
+    url = '/search/api/v1/search?q=wfGetDB&repos=MediaWiki+core'
+    for _ in range(4):
+        assert client.get(url).status_code == 200
+    rv = client.get(url)
+    assert rv.status_code == 429
+    assert rv.headers['Retry-After'] == '2'
+    # Other clients and backends aren't affected
+    assert client.get(url, headers={'X-Codesearch-Token': 'secret'}).status_code == 200
+    requests_mock.get('http://localhost:6081/api/v1/search', text='{}')
+    assert client.get('/extensions/api/v1/search?q=x').status_code == 200
+    metrics = app.client_metrics()
+    assert 'codesearch_client_cost_total{client="127.0.0.1"} 4.000000' in metrics
+    assert 'codesearch_client_throttled_total{client="127.0.0.1"} 1' in metrics
+    assert 'codesearch_client_cost_total{client="mybot"} 1.000000' in metrics
+
+
+def test_rate_limiter_prune():
+    limiter = app.RateLimiter()
+    now = app.time.monotonic()
+    assert limiter.acquire('slow', 'search', 10, 0.001, 10) == 0
+    assert limiter.acquire('fast', 'core', 1, 100, 1) == 0
+    # Each bucket refills at its own backend's rate
+    limiter.prune(now + 1)
+    assert list(limiter.buckets) == [('slow', 'search')]
+
+
+def test_literal_text():
+    assert app.literal_text('wfGetDB', False) == 'wfGetDB'
+    assert app.literal_text(r'wfGetDB\(', False) == 'wfGetDB('
+    assert app.literal_text('wfGetDB(', True) == 'wfGetDB('
+    assert app.literal_text('wfGet.*', False) is None
+    assert app.literal_text(r'\wfoo', False) is None
+
+
+def test_refine_from_cache(cached, requests_mock):
+    broad = {
+        'Results': {
+            'MediaWiki core': {'FilesWithMatch': 2, 'Revision': 'abc', 'Matches': [
+                {'Filename': 'includes/Foo.php', 'Matches': [
+                    {'Line': 'wfGetDB( DB_REPLICA );', 'LineNumber': 1, 'Before': [], 'After': []},
+                    {'Line': '// wfGetDB is deprecated', 'LineNumber': 5, 'Before': [], 'After': []},
+                ]},
+                {'Filename': 'tests/FooTest.php', 'Matches': [
+                    {'Line': 'wfGetDB', 'LineNumber': 3, 'Before': [], 'After': []},
+                ]},
+            ]},
+            'Extension:Bar': {'FilesWithMatch': 1, 'Revision': 'def', 'Matches': [
+                {'Filename': 'Bar.php', 'Matches': [
+                    {'Line': 'wfGetDB( DB_PRIMARY )', 'LineNumber': 9, 'Before': [], 'After': []},
+                ]},
+            ]},
+        },
+        'Stats': {'FilesOpened': 10, 'Duration': 100},
+    }
+    mock = requests_mock.get('http://localhost:6080/api/v1/search', json=broad)
+    cached.get('/search/api/v1/search?q=wfGetDB&repos=*&files=')
+    assert mock.call_count == 1
+
+    rv = cached.get('/search/api/v1/search?q=wfGetDB&repos=Extension:Bar')
+    assert rv.headers['X-Codesearch-Refined'] == 'repos'
+    assert list(json.loads(rv.data)['Results']) == ['Extension:Bar']
+
+    rv = cached.get('/search/api/v1/search?q=wfGetDB&repos=*&files=^includes/')
+    assert rv.headers['X-Codesearch-Refined'] == 'files'
+    assert json.loads(rv.data)['Results']['MediaWiki core']['FilesWithMatch'] == 1
+
+    rv = cached.get('/search/api/v1/search?q=wfGetDB\\(&repos=MediaWiki core')
+    assert rv.headers['X-Codesearch-Refined'] == 'query+repos'
+    result = json.loads(rv.data)['Results']['MediaWiki core']
+    assert [match['Filename'] for match in result['Matches']] == ['includes/Foo.php']
+    assert [line['LineNumber'] for line in result['Matches'][0]['Matches']] == [1]
+    assert mock.call_count == 1
+    assert 'codesearch_refined_queries_total{backend="search",kind="query+repos"} 1' in app.cache_metrics()
+
+    # Regexes that Python might interpret differently go to hound
+    cached.get('/search/api/v1/search?q=wfGetDB&repos=*&files=\\w+Test')
+    assert mock.call_count == 2
+
+
+def test_refine_truncated(cached, requests_mock):
+    mock = requests_mock.get('http://localhost:6080/api/v1/search', json={'Results': {
+        'MediaWiki core': {'FilesWithMatch': 30, 'Matches': []},
+    }})
+    cached.get('/search/api/v1/search?q=wfGetDB&repos=*&rng=:20')
+    cached.get('/search/api/v1/search?q=wfGetDB&repos=MediaWiki core&rng=:20')
+    assert mock.call_count == 2
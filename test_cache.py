@@ -0,0 +1,73 @@
+"""
+Copyright (C) 2026 MediaWiki Codesearch contributors
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+
+from cache import SharedCache
+
+
+def test_get_put(tmp_path):
+    cache = SharedCache(str(tmp_path), 1024 * 1024)
+    assert cache.get('search', 'gen1', 'key') is None
+    cache.put('search', 'gen1', 'key', {'status': 200}, b'{"Results": {}}')
+    assert cache.get('search', 'gen1', 'key') == ({'status': 200}, b'{"Results": {}}')
+    # Another worker sees the same entry
+    other = SharedCache(str(tmp_path), 1024 * 1024)
+    assert other.get('search', 'gen1', 'key') == ({'status': 200}, b'{"Results": {}}')
+    # Counters are published every FLUSH_INTERVAL
+    cache.flush()
+    size = os.path.getsize(tmp_path / 'search' / 'gen1' / 'key')
+    assert other.stats() == {'search': {'hits': 2, 'misses': 1, 'bytes': size}}
+    assert other.size() == size
+
+
+def test_stats_of_exited_workers(tmp_path, mocker):
+    cache = SharedCache(str(tmp_path), 1024 * 1024)
+    cache.put('search', 'gen1', 'key', {}, b'body')
+    cache.get('search', 'gen1', 'key')
+    cache.flush()
+    before = cache.stats()
+    mocker.patch('cache._alive', return_value=False)
+    other = SharedCache(str(tmp_path), 1024 * 1024)
+    # Folded into the shared totals, not lost or counted twice
+    assert other.stats() == before
+    assert len(list(tmp_path.glob('.stats-*.json'))) == 1
+
+
+def test_invalidate(tmp_path):
+    cache = SharedCache(str(tmp_path), 1024 * 1024)
+    cache.put('search', 'gen1', 'key', {}, b'old')
+    cache.put('core', 'gen1', 'key', {}, b'core')
+    cache.invalidate('search', keep='gen2')
+    assert cache.get('search', 'gen1', 'key') is None
+    assert cache.get('core', 'gen1', 'key') == ({}, b'core')
+    assert cache.stats()['search']['bytes'] == 0
+    assert cache.size() == os.path.getsize(tmp_path / 'core' / 'gen1' / 'key')
+
+
+def test_evict(tmp_path):
+    cache = SharedCache(str(tmp_path), 1100)
+    for i in range(5):
+        cache.put('search', 'gen1', f'key{i}', {}, b'x' * 200)
+        path = tmp_path / 'search' / 'gen1' / f'key{i}'
+        os.utime(path, (i, i))
+    # Recently used, so it survives
+    cache.get('search', 'gen1', 'key0')
+    cache.put('search', 'gen1', 'key5', {}, b'x' * 200)
+    assert cache.size() <= 1100
+    assert cache.get('search', 'gen1', 'key0') is not None
+    assert cache.get('search', 'gen1', 'key1') is None
+    assert cache.stats()['search']['evictions'] >= 1
@@ -0,0 +1,81 @@
+"""
+Copyright (C) 2026 MediaWiki Codesearch contributors
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+
+import pytest
+
+from projection import parse_fields, project_results, stream_projected
+
+RESPONSE = {
+    'Results': {
+        'MediaWiki core': {
+            'Matches': [
+                {'Filename': 'includes/Foo.php', 'Matches': [
+                    {'Line': 'wfGetDB( DB_REPLICA ); // ünïcode', 'LineNumber': 12,
+                     'Before': ['a', 'b'], 'After': ['c']},
+                    {'Line': 'wfGetDB( DB_PRIMARY );', 'LineNumber': 1234567,
+                     'Before': [], 'After': []},
+                ]},
+                {'Filename': 'includes/Bar.php', 'Matches': [
+                    {'Line': 'wfGetDB()', 'LineNumber': 3, 'Before': [], 'After': []},
+                ]},
+            ],
+            'FilesWithMatch': 2,
+            'Revision': 'abc',
+        },
+        'Extension:Empty': {'Matches': None, 'FilesWithMatch': 0, 'Revision': 'def'},
+    },
+    'Stats': {'FilesOpened': 10, 'Duration': 5},
+}
+
+
+def test_parse_fields():
+    assert parse_fields('counts') == 'counts'
+    assert parse_fields('nocontext') == frozenset(['Line', 'LineNumber'])
+    assert parse_fields('Line, LineNumber') == frozenset(['Line', 'LineNumber'])
+    for invalid in ('', 'Filename', 'Line,Nope'):
+        with pytest.raises(ValueError):
+            parse_fields(invalid)
+
+
+def test_project_results():
+    counts = project_results(RESPONSE, 'counts')
+    assert counts['Results']['MediaWiki core'] == {'FilesWithMatch': 2, 'Revision': 'abc', 'LineMatches': 3}
+    assert counts['Results']['Extension:Empty']['LineMatches'] == 0
+    assert counts['Stats'] == RESPONSE['Stats']
+    files = project_results(RESPONSE, 'files')
+    assert files['Results']['MediaWiki core']['Matches'] == [
+        {'Filename': 'includes/Foo.php'}, {'Filename': 'includes/Bar.php'}]
+    lines = project_results(RESPONSE, frozenset(['LineNumber']))
+    assert lines['Results']['MediaWiki core']['Matches'][1]['Matches'] == [{'LineNumber': 3}]
+
+
+@pytest.mark.parametrize('projection', ['counts', 'files', frozenset(['Line', 'LineNumber'])])
+@pytest.mark.parametrize('chunk', [1, 7, 1 << 20])
+def test_stream_projected(projection, chunk):
+    body = json.dumps(RESPONSE, indent=1).encode()
+    chunks = [body[i:i + chunk] for i in range(0, len(body), chunk)]
+    streamed = json.loads(''.join(stream_projected(chunks, projection)))
+    assert streamed == project_results(RESPONSE, projection)
+
+
+def test_stream_projected_other():
+    assert json.loads(''.join(stream_projected([b'{"Error": "bad regex"}'], 'files'))) == {'Error': 'bad regex'}
+    assert json.loads(''.join(stream_projected([b'{"Results": null}'], 'counts'))) == {'Results': None}
+    assert json.loads(''.join(stream_projected([b'{}'], 'counts'))) == {}
+    with pytest.raises(ValueError):
+        ''.join(stream_projected([b'{"Results": {"a": '], 'counts'))
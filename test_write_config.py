@@ -14,6 +14,9 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import json
+
+import bench_write_config
 import write_config
 
 
@@ -29,6 +32,276 @@ def test_gerrit_prefix_list():
 def test_parse_args():
     assert write_config.parse_args([]).restart is False
     assert write_config.parse_args(['--restart']).restart is True
+    assert write_config.parse_args([]).shards == 1
+    assert write_config.parse_args(['--shards', '4']).shards == 4
+    assert write_config.parse_args(['--restart', '--blue-green']).blue_green is True
+
+
+def test_blue_green(tmp_path, monkeypatch, mocker):
+    monkeypatch.setattr(write_config, 'DATA', str(tmp_path))
+    monkeypatch.setattr(write_config, 'SWITCH_GRACE', 0)
+    mocker.patch.object(write_config, 'standby_ports', return_value={'search': 7080})
+    mocker.patch.object(write_config, 'ports', return_value={'search': 6080})
+    check_call = mocker.patch.object(write_config.subprocess, 'check_call')
+    check_output = mocker.patch.object(write_config.subprocess, 'check_output', return_value='loaded\n')
+    args = write_config.parse_args(['--restart', '--blue-green'])
+    (tmp_path / 'hound-search').mkdir()
+    (tmp_path / 'hound-search' / 'config.json').write_text('{"repos": {"a": {"url": "a"}}}')
+
+    write_config.write_conf('search', {'repos': {'b': {'url': 'b'}}}, args)
+    # The serving copy is left alone
+    assert 'b' not in (tmp_path / 'hound-search' / 'config.json').read_text()
+    assert 'b' in (tmp_path / 'hound-search-green' / 'config.json').read_text()
+    check_call.assert_called_with(['systemctl', 'restart', 'hound-search-green'])
+    assert write_config.pending_switches == [('search', 'green', 7080)]
+
+    ready = mocker.patch.object(write_config, 'hound_ready', return_value=False)
+    write_config.finish_switches(0)
+    assert write_config.active_slot('search') == 'blue'
+    assert write_config.pending_switches == []
+
+    write_config.pending_switches.append(('search', 'green', 7080))
+    ready.return_value = True
+    write_config.finish_switches(0)
+    assert write_config.active_slot('search') == 'green'
+    check_call.assert_called_with(['systemctl', 'stop', 'hound-search'])
+
+    # The next run compares against, and reindexes away from, the green copy
+    write_config.write_conf('search', {'repos': {'b': {'url': 'b'}}}, args)
+    assert write_config.pending_switches == []
+    write_config.write_conf('search', {'repos': {'c': {'url': 'c'}}}, args)
+    check_call.assert_called_with(['systemctl', 'restart', 'hound-search'])
+    assert write_config.pending_switches == [('search', 'blue', 6080)]
+    write_config.pending_switches.clear()
+
+    # Not installed yet: restart the serving copy in place
+    check_output.return_value = 'not-found\n'
+    write_config.write_conf('search', {'repos': {'d': {'url': 'd'}}}, args)
+    check_call.assert_called_with(['systemctl', 'restart', 'hound-search-green'])
+    assert write_config.pending_switches == []
+
+
+def test_blue_green_refresh(tmp_path, monkeypatch, mocker):
+    monkeypatch.setattr(write_config, 'DATA', str(tmp_path))
+    mocker.patch.object(write_config, 'standby_ports', return_value={'search': 7080})
+    mocker.patch.object(write_config, 'ports', return_value={'search': 6080})
+    check_call = mocker.patch.object(write_config.subprocess, 'check_call')
+    started = {'hound-search': write_config.time.monotonic() - 2 * 86400}
+
+    def check_output(command, text):
+        if 'LoadState' in command:
+            return 'loaded\n'
+        if command[-1] not in started:
+            return 'ActiveState=inactive\nActiveEnterTimestampMonotonic=0\n'
+        return f'ActiveState=active\nActiveEnterTimestampMonotonic={int(started[command[-1]] * 1e6)}\n'
+
+    mocker.patch.object(write_config.subprocess, 'check_output', side_effect=check_output)
+    args = write_config.parse_args(['--restart', '--blue-green', '--blue-green-refresh', '86400'])
+    conf = {'repos': {'a': {'url': 'a'}}}
+    (tmp_path / 'hound-search').mkdir()
+    (tmp_path / 'hound-search' / 'config.json').write_text(json.dumps(conf))
+
+    # Unchanged, but serving for long enough to be rebuilt in the standby
+    write_config.write_conf('search', conf, args)
+    check_call.assert_called_once_with(['systemctl', 'restart', 'hound-search-green'])
+    assert write_config.pending_switches == [('search', 'green', 7080)]
+    write_config.pending_switches.clear()
+
+    # The standby is still indexing after the last run timed out
+    started['hound-search-green'] = write_config.time.monotonic()
+    write_config.write_conf('search', conf, args)
+    assert check_call.call_count == 1
+    assert write_config.pending_switches == [('search', 'green', 7080)]
+    write_config.pending_switches.clear()
+
+    started['hound-search'] = write_config.time.monotonic()
+    write_config.write_conf('search', conf, args)
+    assert write_config.instance_stats['search']['restart'] == 'unchanged'
+    assert write_config.pending_switches == []
+
+
+def test_blue_green_stopped_standby(tmp_path, monkeypatch, mocker):
+    monkeypatch.setattr(write_config, 'DATA', str(tmp_path))
+    mocker.patch.object(write_config, 'standby_ports', return_value={'search': 7080})
+    mocker.patch.object(write_config, 'ports', return_value={'search': 6080})
+
+    def check_call(command):
+        # What systemctl does for an installed but stopped unit
+        if command[1] == 'status' and command[2] == 'hound-search-green':
+            raise write_config.subprocess.CalledProcessError(3, command)
+
+    calls = mocker.patch.object(write_config.subprocess, 'check_call', side_effect=check_call)
+    mocker.patch.object(write_config.subprocess, 'check_output', return_value='loaded\n')
+    (tmp_path / 'hound-search').mkdir()
+    (tmp_path / 'hound-search' / 'config.json').write_text('{"repos": {"a": {"url": "a"}}}')
+    write_config.write_conf('search', {'repos': {'b': {'url': 'b'}}},
+                            write_config.parse_args(['--restart', '--blue-green']))
+    calls.assert_called_with(['systemctl', 'restart', 'hound-search-green'])
+    assert 'b' not in (tmp_path / 'hound-search' / 'config.json').read_text()
+    assert write_config.pending_switches == [('search', 'green', 7080)]
+    write_config.pending_switches.clear()
+
+
+def test_shard_repos(monkeypatch):
+    sizes = {'a': 50, 'b': 40, 'c': 30, 'd': 20, 'e': 10}
+    monkeypatch.setattr(write_config, 'estimate_repo_size', lambda info: sizes[info['url']])
+    repos = {name: {'url': name} for name in sizes}
+    shards = write_config.shard_repos(repos, 2)
+    assert [sorted(shard) for shard in shards] == [['a', 'd', 'e'], ['b', 'c']]
+
+
+def test_canonical_url():
+    assert write_config.canonical_url('https://gerrit-replica.wikimedia.org/r/mediawiki/core.git') ==\
+           write_config.canonical_url('http://gerrit.wikimedia.org/r/mediawiki/core/')
+    assert write_config.canonical_url('https://github.com/wikimedia/mediawiki-extensions-Foo.git') ==\
+           'gerrit.wikimedia.org/r/mediawiki/extensions/Foo'
+    assert write_config.canonical_url('https://github.com/Org/Repo') == 'github.com/org/repo'
+    assert write_config.canonical_url('https://gitlab.wikimedia.org/Org/Repo.git') ==\
+           'gitlab.wikimedia.org/Org/Repo'
+
+
+def test_dedup_repos():
+    repos = {
+        'Foo': write_config.gh_repo('wikimedia/mediawiki-extensions-Foo'),
+        'Extension:Foo': write_config.repo_info('mediawiki/extensions/Foo'),
+        'Bar': write_config.gh_repo('org/bar'),
+        'org/Bar': write_config.gh_repo('Org/Bar'),
+    }
+    kept, removed = write_config.dedup_repos(repos)
+    assert list(kept) == ['Extension:Foo', 'Bar']
+    assert removed == {'Foo': 'Extension:Foo', 'org/Bar': 'Bar'}
+    kept, removed = write_config.dedup_repos(repos, 'first')
+    assert list(kept) == ['Foo', 'Bar']
+    kept, removed = write_config.dedup_repos(repos, 'shortest')
+    assert list(kept) == ['Foo', 'Bar']
+    assert write_config.parse_args(['--dedup-prefer', 'first']).dedup_prefer == 'first'
+
+
+def test_index_report(tmp_path, monkeypatch):
+    monkeypatch.setattr(write_config, 'DATA', str(tmp_path))
+    monkeypatch.setattr(write_config, 'LARGE_FILE', 1000)
+    write_config.clone_file_stats.cache_clear()
+    info = write_config.gh_repo('org/repo')
+    clone = tmp_path / 'hound-x' / 'data' / ('vcs-' + write_config.hashlib.sha1(info['url'].encode()).hexdigest())
+    for path, size in [('src/a.js', 100), ('src/a.min.js', 300), ('package-lock.json', 200),
+                       ('data/huge.json', 2000), ('img/a.png', 5000), ('.git/objects', 10 ** 6)]:
+        (clone / path).parent.mkdir(parents=True, exist_ok=True)
+        (clone / path).write_bytes(b'x' * size)
+    monkeypatch.setattr(write_config, 'repo_directory', {
+        'repo': {'url': info['url'], 'poll': 1, 'backends': ['search', 'core']},
+        'uncloned': {'url': 'https://example.org/x', 'poll': 1, 'backends': ['search']},
+    })
+    write_config.write_index_report()
+    report = json.loads((tmp_path / 'index-report.json').read_text())
+    stats = {'bytes': 2600, 'generated_bytes': 500, 'large_file_bytes': 2000,
+             'binary_bytes': 5000, 'saved_bytes': 2500}
+    assert report['repos'] == {'repo': stats}
+    assert report['profiles']['search'] == dict(stats, repos=1)
+    assert sorted(report['profiles']) == ['core', 'search']
+    write_config.clone_file_stats.cache_clear()
+
+
+def test_plan_placement():
+    sizes = {'search': 60, 'extensions': 20, 'skins': 10, 'core': 10}
+    loads = {'search': 1, 'extensions': 1, 'skins': 1, 'core': 1}
+    assert write_config.plan_placement(sizes, loads, ['a', 'b']) == {
+        'a': ['search'], 'b': ['extensions', 'core', 'skins'],
+    }
+    # Busy but small instances are spread out too
+    loads['skins'] = 100
+    assert write_config.plan_placement(sizes, loads, ['a', 'b'])['a'] == ['skins']
+
+
+def test_plan_placement_sticky():
+    sizes = {'search': 60, 'extensions': 20, 'skins': 10, 'core': 10}
+    loads = dict.fromkeys(sizes, 1.0)
+    previous = {'a': ['search', 'skins'], 'b': ['extensions', 'core']}
+    # A little heavier than a fresh plan would be, but nothing has to move
+    assert write_config.plan_placement(sizes, loads, ['a', 'b'], previous) == previous
+    # New instances go to the lightest node
+    sizes['apps'] = 10
+    loads['apps'] = 1.0
+    assert write_config.plan_placement(sizes, loads, ['a', 'b'], previous)['b'] == ['extensions', 'core', 'apps']
+    # Too lopsided, start over
+    sizes['extensions'] = 5
+    sizes['search'] = 200
+    assert write_config.plan_placement(sizes, loads, ['a', 'b'], previous)['a'] == ['search']
+    # A node that went away
+    assert sorted(write_config.plan_placement(sizes, loads, ['b'], previous)['b']) == sorted(sizes)
+
+
+def test_place_instances(tmp_path, monkeypatch, mocker):
+    monkeypatch.setattr(write_config, 'DATA', str(tmp_path))
+    mocker.patch.object(write_config, 'ports', return_value={'search': 6080, 'core': 6081})
+    mocker.patch.object(write_config, 'query_loads', return_value={})
+    mocker.patch.object(write_config, 'estimate_repo_size', return_value=10)
+    write_conf = mocker.patch.object(write_config, 'write_conf')
+    args = write_config.parse_args(['--nodes', 'a,b', '--node', 'a'])
+    write_config.emit_conf('search', {'repos': {'x': {'url': 'x'}, 'y': {'url': 'y'}}}, args)
+    write_config.emit_conf('core', {'repos': {'z': {'url': 'z'}}}, args)
+    assert write_conf.call_count == 0
+    write_config.place_instances(args)
+    write_conf.assert_called_once_with('search', mocker.ANY, args)
+    assert (tmp_path / 'nodes' / 'b' / 'hound-core' / 'config.json').exists()
+    with open(tmp_path / 'nodes' / 'b' / 'ports.json') as f:
+        assert write_config.json.load(f) == {'core': 6081}
+    with open(tmp_path / 'placement.json') as f:
+        placement = write_config.json.load(f)
+    assert placement['nodes'] == {'a': ['search'], 'b': ['core']}
+    # The proxy runs on this node
+    assert placement['targets'] == {'search': 'localhost:6080', 'core': 'b:6081'}
+    assert write_config.unplaced == {}
+
+
+def test_write_directory(tmp_path, monkeypatch, mocker):
+    mocker.patch.object(write_config, 'get_extdist_repos',
+                        return_value={'query': {'extdistrepos': {'extensions': [], 'skins': []}}})
+    monkeypatch.setattr(write_config, 'DATA', str(tmp_path))
+    monkeypatch.setattr(write_config, 'repo_directory', {})
+    monkeypatch.setattr(write_config, 'profile_stats', {})
+    args = write_config.parse_args([])
+    monkeypatch.setattr(write_config, 'write_conf', lambda *args: None)
+    write_config.make_conf('apps', args, apps=True)
+    write_config.make_conf('search', args, apps=True)
+    write_config.write_directory()
+    with open(tmp_path / 'directory.json') as f:
+        directory = json.load(f)['repos']
+    assert directory['Wikipedia iOS app'] == {
+        'url': 'https://github.com/wikimedia/wikipedia-ios',
+        'poll': write_config.POLL,
+        'backends': ['apps', 'search'],
+    }
+
+
+def test_metrics_file(tmp_path, monkeypatch, mocker, requests_mock):
+    for name in ('source_stats', 'profile_stats', 'instance_stats'):
+        monkeypatch.setattr(write_config, name, {})
+    requests_mock.get('https://example.org/ok', text='')
+    requests_mock.get('https://example.org/missing', status_code=404)
+    write_config.http_get('gerrit_projects', 'https://example.org/ok')
+    write_config.http_get('gerrit_projects', 'https://example.org/missing')
+    assert write_config.source_stats['gerrit_projects'][1:] == [2, 1]
+
+    monkeypatch.setattr(write_config, 'DATA', str(tmp_path))
+    mocker.patch.object(write_config.subprocess, 'check_call')
+    (tmp_path / 'hound-core').mkdir()
+    (tmp_path / 'hound-core' / 'config.json').write_text('{"repos": {"a": {"url": "a"}, "b": {"url": "b"}}}')
+    write_config.write_conf('core', {'repos': {'b': {'url': 'b'}, 'c': {'url': 'c'}, 'd': {'url': 'd'}}},
+                            write_config.parse_args(['--restart']))
+    write_config.profile_stats['core'] = {'seconds': 1.5, 'repos': 3, 'duplicates': 0}
+
+    path = str(tmp_path / 'write_config.prom')
+    write_config.write_metrics(path, True)
+    with open(path) as f:
+        text = f.read()
+    assert 'codesearch_write_config_success 1\n' in text
+    assert 'codesearch_write_config_source_requests{source="gerrit_projects"} 2\n' in text
+    assert 'codesearch_write_config_source_errors{source="gerrit_projects"} 1\n' in text
+    assert 'codesearch_write_config_profile_seconds{profile="core"} 1.5\n' in text
+    assert 'codesearch_write_config_urls_added{instance="core"} 2\n' in text
+    assert 'codesearch_write_config_urls_removed{instance="core"} 1\n' in text
+    assert 'codesearch_write_config_restart{instance="core",action="restarted"} 1\n' in text
+    assert 'codesearch_write_config_restart{instance="core",action="unchanged"} 0\n' in text
 
 
 def test_repo_info_gitlab():
@@ -67,3 +340,24 @@ def test_wmf_gitlab_group_projects():
     # to ensure that paging is working correctly and completely.
     assert "toolforge-repos/zoomviewer" in \
         write_config.wmf_gitlab_group_projects("toolforge-repos/")
+
+
+def test_bench_offline():
+    report = bench_write_config.run(scale=0.05)
+    assert report['search']['requests'] > 0
+    assert report['search']['repos'] >= report['extensions']['repos']
+    assert report['total']['repos'] == sum(
+        profile['repos'] for name, profile in report.items() if name != 'total'
+    )
+    assert bench_write_config.compare(report, report, 0) == []
+
+
+def test_bench_live_gitlab_children(requests_mock):
+    url = 'https://gitlab.wikimedia.org/groups/repos/x/-/children.json'
+    requests_mock.get(url + '?page=1', headers={'X-Next-Page': '2'}, json=[
+        {'name': 'sub', 'type': 'group', 'relative_path': '/repos/x/sub'},
+        {'name': 'a', 'type': 'project', 'relative_path': '/repos/x/a'},
+        {'name': 'old', 'type': 'project', 'relative_path': '/repos/x/old', 'archived': True},
+    ])
+    requests_mock.get(url + '?page=2', json=[{'name': 'b', 'type': 'project', 'relative_path': '/repos/x/b'}])
+    assert bench_write_config.live_gitlab_children('repos/x') == (['repos/x/a', 'repos/x/b'], ['repos/x/sub'])
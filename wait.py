@@ -17,31 +17,66 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import argparse
 import os
 import random
 import requests
+import sys
 import time
 
+HEALTH_URL = 'http://localhost:3002/_health.json'
+# How long to ask the proxy to hold each long-poll request
+LONG_POLL = 30
 
-def main():
+
+def poll_sleep():
+    # Random skew so all the waits hopefully
+    # don't give up at the same time
+    time.sleep(random.randint(5, 20))
+
+
+def main(argv=None):
     """Wait until no hound instances are starting up"""
-    wait = True
-    while wait:
-        req = requests.get('http://localhost:3002/_health.json')
+    parser = argparse.ArgumentParser(description='Wait until no hound instances are starting up')
+    parser.add_argument('--timeout', type=float,
+                        help='Give up (and exit with an error) after this many seconds')
+    args = parser.parse_args(args=argv)
+    deadline = time.monotonic() + args.timeout if args.timeout else None
+
+    etag = None
+    while deadline is None or time.monotonic() < deadline:
+        # Ask the proxy to tell us as soon as the health status changes,
+        # instead of re-probing every backend ourselves
+        headers = {'If-None-Match': etag} if etag else {}
+        # Don't hold on past --timeout
+        wait = LONG_POLL if deadline is None else max(0, min(LONG_POLL, deadline - time.monotonic()))
+        try:
+            req = requests.get(HEALTH_URL, params={'wait': round(wait, 1)},
+                               headers=headers, timeout=wait + 15)
+        except requests.exceptions.RequestException as e:
+            print(f'Unable to fetch health status, retrying: {e}')
+            etag = None
+            poll_sleep()
+            continue
+        if req.status_code == 304:
+            # Nothing changed
+            continue
         req.raise_for_status()
         health = req.json()
         wait_for = [name for name in health if health[name] == 'starting up']
-        if wait_for:
-            wait = True
-            print('{}: Sleeping while waiting for {}'.format(
-                os.environ.get('HOUND_NAME', 'unknown'),
-                ', '.join(wait_for))
-            )
-            # Random skew so all the waits hopefully
-            # don't give up at the same time
-            time.sleep(random.randint(5, 20))
-        else:
-            wait = False
+        if not wait_for:
+            return
+        print('{}: Sleeping while waiting for {}'.format(
+            os.environ.get('HOUND_NAME', 'unknown'),
+            ', '.join(wait_for))
+        )
+        etag = req.headers.get('ETag')
+        if etag is None:
+            # Proxy doesn't support long polling, fall back to polling
+            poll_sleep()
+
+    print('Timed out waiting for hound instances to start up')
+    sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -20,22 +20,94 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import argparse
 import base64
 from configparser import ConfigParser
+import fnmatch
 import functools
+import glob
+import hashlib
 import json
 import os
+import re
 import requests
+import socket
 import subprocess
-from typing import List
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 import yaml
 
 # 90 minutes
 POLL = 90 * 60 * 1000
 DATA = '/srv/hound'
+# Assumed index size for repos that haven't been cloned yet
+DEFAULT_REPO_SIZE = 10 * 1024 * 1024
+# Shared with the proxy, see app.py
+CONFIG = '/etc/codesearch_config.json'
+HOUND_STARTUP = 'Hound is not ready.\n'
+# Seconds to let requests to the old copy finish before stopping it
+SWITCH_GRACE = 10
+# How much more than its fair share the busiest node may carry before
+# instances are moved around, which means recloning them elsewhere
+PLACEMENT_SLACK = 0.25
+# Hosts that serve the same repos as another, canonical one
+REPLICA_HOSTS = {
+    'gerrit-replica.wikimedia.org': 'gerrit.wikimedia.org',
+}
+# Mirrors of Gerrit repos, (pattern, replacement) over host + path
+MIRRORS = [
+    (r'^github\.com/wikimedia/mediawiki-extensions-([^/]+)$',
+     r'gerrit.wikimedia.org/r/mediawiki/extensions/\1'),
+    (r'^github\.com/wikimedia/mediawiki-skins-([^/]+)$',
+     r'gerrit.wikimedia.org/r/mediawiki/skins/\1'),
+]
+# Hosts that ignore case in repo paths
+CASE_INSENSITIVE_HOSTS = {'github.com', 'gitlab.com', 'bitbucket.org'}
+# For --index-report: paths that are generated or vendored, and rarely
+# worth searching, files too large to be worth it, and binary files,
+# which hound skips anyway
+GENERATED_PATTERNS = [
+    '*.min.js', '*.min.css', '*.map', 'package-lock.json', 'yarn.lock',
+    'composer.lock', 'node_modules/*', '*/node_modules/*', 'vendor/*', 'dist/*',
+]
+LARGE_FILE = 512 * 1024
+BINARY_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.ico', '.webp', '.woff', '.woff2', '.ttf',
+    '.eot', '.pdf', '.zip', '.gz', '.jar', '.ogg', '.oga', '.mp3', '.mp4', '.webm',
+}
+# Instances whose standby copy is (re)indexing: (name, slot, port)
+pending_switches: List[Tuple[str, str, int]] = []
+# Configs waiting to be placed on nodes, see --nodes
+unplaced: Dict[str, dict] = {}
+# What this run did, for --metrics-file: source -> [seconds, requests,
+# errors], profile -> stats and instance -> stats
+source_stats: Dict[str, List[float]] = {}
+profile_stats: Dict[str, Dict[str, float]] = {}
+instance_stats: Dict[str, dict] = {}
+# repo name -> url, poll interval and the profiles indexing it, for the
+# proxy's /_repos
+repo_directory: Dict[str, dict] = {}
+
+
+def http_get(source: str, url: str, **kwargs) -> requests.Response:
+    """requests.get(), keeping count of the time and requests per source"""
+    stats = source_stats.setdefault(source, [0.0, 0, 0])
+    start = time.monotonic()
+    try:
+        r = requests.get(url, **kwargs)
+    except requests.exceptions.RequestException:
+        stats[2] += 1
+        raise
+    finally:
+        stats[0] += time.monotonic() - start
+        stats[1] += 1
+    if r.status_code >= 400:
+        stats[2] += 1
+    return r
 
 
 @functools.lru_cache()
 def get_extdist_repos() -> dict:
-    r = requests.get(
+    r = http_get(
+        'extdist',
         'https://www.mediawiki.org/w/api.php',
         params={
             "action": "query",
@@ -51,7 +123,7 @@ def get_extdist_repos() -> dict:
 
 @functools.lru_cache()
 def parse_gitmodules(url):
-    r = requests.get(url)
+    r = http_get('gitmodules', url)
     r.raise_for_status()
     config = ConfigParser()
     config.read_string(r.text)
@@ -95,14 +167,14 @@ def parse_gitmodules(url):
 def _get_gerrit_file(gerrit_name: str, path: str) -> str:
     url = f'https://gerrit.wikimedia.org/g/{gerrit_name}/+/master/{path}?format=TEXT'
     print('Fetching ' + url)
-    r = requests.get(url)
+    r = http_get('gerrit_files', url)
     return base64.b64decode(r.text).decode()
 
 
 def _get_gitlab_file(repo_name: str, path: str, branch="master") -> str:
     url = f'https://gitlab.wikimedia.org/{repo_name}/-/raw/{branch}/{path}'
     print('Fetching ' + url)
-    r = requests.get(url)
+    r = http_get('gitlab_files', url)
     return r.text
 
 
@@ -114,7 +186,7 @@ def _settings_yaml() -> dict:
 
 def gerrit_prefix_list(prefix: str) -> dict:
     """Generator based on Gerrit prefix search"""
-    req = requests.get('https://gerrit.wikimedia.org/r/projects/', params={
+    req = http_get('gerrit_projects', 'https://gerrit.wikimedia.org/r/projects/', params={
         'p': prefix,
     })
     req.raise_for_status()
@@ -211,7 +283,8 @@ def wmf_gitlab_group_projects(group: str) -> dict:
     # Ignore problematic repos (T413322)
     ignore = {'abstract-wiki-prototype'}
     while next_page and next_page <= max_pages:
-        resp = requests.get(
+        resp = http_get(
+            'gitlab_groups',
             f"https://gitlab.wikimedia.org/groups/{group}/-/children.json",
             params={'per_page': 100, "page": next_page}
         )
@@ -234,12 +307,168 @@ def wmf_gitlab_group_projects(group: str) -> dict:
     return repos
 
 
-def make_conf(name, args, core=False, exts=False, skins=False, ooui=False,
+def _dir_size(path: str) -> int:
+    total = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                total += _dir_size(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+@functools.lru_cache()
+def clone_sizes() -> Dict[str, int]:
+    """
+    Sizes of the existing hound clones, keyed by the directory name
+    hound derives from the repo URL (vcs-<sha1 of url>)
+    """
+    sizes = {}
+    for path in glob.glob(os.path.join(DATA, 'hound-*', 'data', 'vcs-*')):
+        sizes[os.path.basename(path)] = _dir_size(path)
+    return sizes
+
+
+def estimate_repo_size(repo: dict) -> int:
+    """Estimate how large a repo's index will be, based on previous clones"""
+    vcs_dir = 'vcs-' + hashlib.sha1(repo['url'].encode()).hexdigest()
+    return clone_sizes().get(vcs_dir, DEFAULT_REPO_SIZE)
+
+
+@functools.lru_cache(maxsize=None)
+def clone_file_stats(vcs_dir: str) -> Optional[Dict[str, int]]:
+    """
+    Bytes of text, generated, large and binary files in an existing clone,
+    or None if there is none. Only the totals are kept, not the paths.
+    """
+    for path in glob.glob(os.path.join(DATA, 'hound-*', 'data', vcs_dir)):
+        stats = {'bytes': 0, 'generated_bytes': 0, 'large_file_bytes': 0, 'binary_bytes': 0}
+        for dirpath, dirnames, filenames in os.walk(path):
+            if '.git' in dirnames:
+                dirnames.remove('.git')
+            for filename in filenames:
+                full = os.path.join(dirpath, filename)
+                try:
+                    size = os.lstat(full).st_size
+                except OSError:
+                    continue
+                relative = os.path.relpath(full, path)
+                if os.path.splitext(filename)[1].lower() in BINARY_EXTENSIONS:
+                    stats['binary_bytes'] += size
+                    continue
+                stats['bytes'] += size
+                if any(fnmatch.fnmatch(relative, pattern) or fnmatch.fnmatch(filename, pattern)
+                       for pattern in GENERATED_PATTERNS):
+                    stats['generated_bytes'] += size
+                elif size > LARGE_FILE:
+                    stats['large_file_bytes'] += size
+        return stats
+    return None
+
+
+def index_report() -> dict:
+    """
+    Estimate how many bytes of text each profile indexes, and how many
+    excluding generated and large files would save, per profile and per
+    repo. Nothing is excluded: upstream hound can only leave out whole
+    repos, which the per-repo figures help to pick.
+    """
+    report: dict = {'profiles': {}, 'repos': {}}
+    for repo, entry in sorted(repo_directory.items()):
+        stats = clone_file_stats('vcs-' + hashlib.sha1(entry['url'].encode()).hexdigest())
+        if stats is None:
+            # Not cloned yet
+            continue
+        stats = dict(stats, saved_bytes=stats['generated_bytes'] + stats['large_file_bytes'])
+        report['repos'][repo] = stats
+        for backend in entry['backends']:
+            totals = report['profiles'].setdefault(backend, dict.fromkeys(['repos', *stats], 0))
+            totals['repos'] += 1
+            for key, value in stats.items():
+                totals[key] += value
+    return report
+
+
+def write_index_report():
+    """Write out the --index-report, next to the configs"""
+    dest = os.path.join(DATA, 'index-report.json')
+    with open(dest + '.tmp', 'w') as f:
+        json.dump(index_report(), f, indent='\t')
+    os.replace(dest + '.tmp', dest)
+
+
+def shard_repos(repos: dict, shards: int) -> List[dict]:
+    """
+    Split repos into shards of roughly equal estimated size, by
+    handing out the largest repos first to the smallest shard
+    """
+    buckets: List[dict] = [{} for _ in range(shards)]
+    totals = [0] * shards
+    sized = sorted(((estimate_repo_size(info), name) for name, info in repos.items()),
+                   key=lambda pair: (-pair[0], pair[1]))
+    for size, name in sized:
+        smallest = totals.index(min(totals))
+        buckets[smallest][name] = repos[name]
+        totals[smallest] += size
+    return buckets
+
+
+def canonical_url(url: str) -> str:
+    """Identify a repo regardless of scheme, .git suffix, replica or mirror"""
+    parts = urlsplit(url)
+    host = parts.hostname or ''
+    host = REPLICA_HOSTS.get(host, host)
+    path = parts.path.rstrip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    canonical = host + path
+    for pattern, replacement in MIRRORS:
+        canonical = re.sub(pattern, replacement, canonical, flags=re.IGNORECASE)
+    if canonical.split('/')[0] in CASE_INSENSITIVE_HOSTS:
+        canonical = canonical.lower()
+    return canonical
+
+
+# Rules for which of several names for the same repo is kept, as sort keys
+# over (position added, name, info); the smallest wins
+DEDUP_RULES: Dict[str, Callable[[int, str, dict], tuple]] = {
+    # Whichever was added first, i.e. hand-written entries and earlier sources
+    'first': lambda pos, name, info: (pos,),
+    # Gerrit-hosted entries, which link to the canonical browser
+    'gerrit': lambda pos, name, info: (
+        urlsplit(info['url']).hostname not in ('gerrit.wikimedia.org', 'gerrit-replica.wikimedia.org'), pos),
+    'shortest': lambda pos, name, info: (len(name), pos),
+}
+
+
+def dedup_repos(repos: dict, rule: str = 'gerrit') -> Tuple[dict, Dict[str, str]]:
+    """
+    Drop repos that are indexed under more than one name. Returns the
+    remaining repos, in their original order, and the removed names mapped
+    to the name kept instead.
+    """
+    key = DEDUP_RULES[rule]
+    by_url: Dict[str, List[Tuple[int, str]]] = {}
+    for pos, (name, info) in enumerate(repos.items()):
+        by_url.setdefault(canonical_url(info['url']), []).append((pos, name))
+    removed = {}
+    for names in by_url.values():
+        if len(names) < 2:
+            continue
+        names.sort(key=lambda pair: key(pair[0], pair[1], repos[pair[1]]))
+        for _, name in names[1:]:
+            removed[name] = names[0][1]
+    return {name: info for name, info in repos.items() if name not in removed}, removed
+
+
+def make_conf(name, args, shards=1, core=False, exts=False, skins=False, ooui=False,
               operations=False, armchairgm=False, twn=False, milkshake=False,
               bundled=False, vendor=False, wikimedia=False, pywikibot=False,
               services=False, libs=False, analytics=False, puppet=False,
               shouthow=False, schemas=False, wmcs=False, devtools=False,
               apps=False, wdp=False):
+    start = time.monotonic()
     conf = {
         'max-concurrent-indexers': 2,
         'dbpath': 'data',
@@ -542,7 +771,138 @@ def make_conf(name, args, core=False, exts=False, skins=False, ooui=False,
     if wdp:
         conf['repos'].update(wmf_gitlab_group_projects("repos/wikidata-platform/"))
 
-    dirname = f'hound-{name}'
+    conf['repos'], removed = dedup_repos(conf['repos'], args.dedup_prefer)
+    if removed:
+        print(f'{name}: dropped {len(removed)} duplicate repos')
+        for dupe, kept in sorted(removed.items()):
+            print(f'  {dupe} (same as {kept})')
+
+    profile_stats[name] = {
+        'seconds': time.monotonic() - start,
+        'repos': len(conf['repos']),
+        'duplicates': len(removed),
+    }
+    for repo, info in conf['repos'].items():
+        entry = repo_directory.setdefault(repo, {
+            'url': info['url'],
+            'poll': info.get('ms-between-poll', POLL),
+            'backends': [],
+        })
+        entry['backends'].append(name)
+
+    if shards <= 1:
+        emit_conf(name, conf, args)
+        return [name]
+
+    names = []
+    for i, repos in enumerate(shard_repos(conf['repos'], shards), start=1):
+        names.append(f'{name}-{i}')
+        emit_conf(names[-1], dict(conf, repos=repos), args)
+    return names
+
+
+def emit_conf(name, conf, args):
+    """Write a config now, or once we know which node it goes to"""
+    if args.nodes:
+        unplaced[name] = conf
+    else:
+        write_conf(name, conf, args)
+
+
+@functools.lru_cache()
+def query_loads() -> Dict[str, float]:
+    """Relative search traffic by profile, for placing instances on nodes"""
+    return _load_json(CONFIG).get('QUERY_LOAD', {})
+
+
+def plan_placement(sizes: Dict[str, int], loads: Dict[str, float], nodes: List[str],
+                   previous: Optional[Dict[str, List[str]]] = None) -> Dict[str, List[str]]:
+    """
+    Spread instances over nodes so that each gets a similar share of the
+    total index size plus a similar share of the search traffic, handing
+    out the heaviest instances first to the least loaded node. Instances
+    stay where the previous plan put them unless that leaves the busiest
+    node more than PLACEMENT_SLACK over its fair share.
+    """
+    total_size = sum(sizes.values()) or 1
+    total_load = sum(loads.values()) or 1
+    weights = {name: sizes[name] / total_size + loads[name] / total_load for name in sizes}
+
+    def pack(plan: Dict[str, List[str]]) -> Tuple[Dict[str, List[str]], List[float]]:
+        placed = {name for names in plan.values() for name in names}
+        totals = [sum(weights[name] for name in plan[node]) for node in nodes]
+        for name in sorted(weights, key=lambda name: (-weights[name], name)):
+            if name in placed:
+                continue
+            lightest = totals.index(min(totals))
+            plan[nodes[lightest]].append(name)
+            totals[lightest] += weights[name]
+        return plan, totals
+
+    if previous:
+        kept, totals = pack({node: [name for name in previous.get(node, []) if name in weights]
+                             for node in nodes})
+        if max(totals) <= sum(totals) / len(nodes) * (1 + PLACEMENT_SLACK):
+            return kept
+    return pack({node: [] for node in nodes})[0]
+
+
+def place_instances(args):
+    """
+    Assign the generated instances to nodes, write the configs for this
+    node as usual and those for other nodes under DATA/nodes/<node>/, and
+    tell the proxy where each instance is
+    """
+    # Other nodes' clones aren't here, so fall back to what was measured
+    # back when an instance was last on this node
+    placement = _load_json(os.path.join(DATA, 'placement.json'))
+    previous = placement.get('sizes', {})
+    sizes = {}
+    for name, conf in unplaced.items():
+        vcs_dirs = {'vcs-' + hashlib.sha1(info['url'].encode()).hexdigest() for info in conf['repos'].values()}
+        if name in previous and not vcs_dirs & clone_sizes().keys():
+            sizes[name] = previous[name]
+        else:
+            sizes[name] = sum(estimate_repo_size(info) for info in conf['repos'].values())
+    loads = {}
+    for name in unplaced:
+        # Shards get every search for their profile
+        profile = name if name in query_loads() else name.rsplit('-', 1)[0]
+        loads[name] = float(query_loads().get(profile, 1))
+    plan = plan_placement(sizes, loads, args.nodes, placement.get('nodes'))
+    targets = {}
+    for node, names in plan.items():
+        print(f'{node}: {", ".join(sorted(names))} ({sum(sizes[name] for name in names) / 2**30:.1f} GiB)')
+        node_ports = {}
+        for name in names:
+            if name in ports():
+                # The proxy runs here, and only recognises its own instances by name
+                host = 'localhost' if node == args.node else node
+                targets[name] = f'{host}:{ports()[name]}'
+                node_ports[name] = ports()[name]
+            else:
+                print(f'hound-{name}: no port assigned, the proxy will not find it')
+            if node == args.node:
+                write_conf(name, unplaced[name], args)
+                continue
+            directory = os.path.join(DATA, 'nodes', node, f'hound-{name}')
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, 'config.json'), 'w') as f:
+                json.dump(unplaced[name], f, indent='\t')
+        os.makedirs(os.path.join(DATA, 'nodes', node), exist_ok=True)
+        with open(os.path.join(DATA, 'nodes', node, 'ports.json'), 'w') as f:
+            json.dump(node_ports, f, indent='\t')
+    unplaced.clear()
+    dest = os.path.join(DATA, 'placement.json')
+    with open(dest + '.tmp', 'w') as f:
+        json.dump({'nodes': plan, 'targets': targets, 'sizes': sizes}, f, indent='\t')
+    os.replace(dest + '.tmp', dest)
+
+
+def write_conf(name, conf, args):
+    """Write the config for a hound instance, and restart it if needed"""
+    active = active_slot(name)
+    dirname = slot_dirname(name, active)
     directory = os.path.join(DATA, dirname)
     if not os.path.isdir(directory):
         os.mkdir(directory)
@@ -553,6 +913,48 @@ def make_conf(name, args, core=False, exts=False, skins=False, ooui=False,
     else:
         old = set()
     new = extract_urls(conf)
+    stats = instance_stats[name] = {
+        'repos': len(conf['repos']),
+        'urls_added': len(new - old),
+        'urls_removed': len(old - new),
+        'restart': 'disabled',
+    }
+    standby = 'green' if active == 'blue' else 'blue'
+    rebuild = new != old
+    if args.restart and args.blue_green and args.blue_green_refresh and not rebuild \
+            and name in standby_ports():
+        # Instead of systemd restarting the serving copy every so often
+        since = unit_active_since(dirname)
+        rebuild = since is not None and time.monotonic() - since >= args.blue_green_refresh
+        if rebuild:
+            print(f'{dirname}: serving for over {args.blue_green_refresh}s, reindexing')
+    if args.restart and args.blue_green and rebuild and name in standby_ports():
+        # Build the new index in the standby copy while the active one
+        # keeps serving, and switch over once it's ready
+        standby_dirname = slot_dirname(name, standby)
+        standby_directory = os.path.join(DATA, standby_dirname)
+        port = standby_ports()[name] if standby == 'green' else ports()[name]
+        if not os.path.isdir(standby_directory):
+            os.mkdir(standby_directory)
+        if unit_active_since(standby_dirname) is not None \
+                and _load_json(os.path.join(standby_directory, 'config.json')) == conf:
+            # A previous run gave up waiting for it, so keep waiting
+            # rather than starting over
+            print(f'{standby_dirname}: still indexing this config')
+            pending_switches.append((name, standby, port))
+            stats['restart'] = 'standby'
+            return
+        print(f'{standby_dirname}: writing new config')
+        with open(os.path.join(standby_directory, 'config.json'), 'w') as f:
+            json.dump(conf, f, indent='\t')
+        if not unit_exists(standby_dirname):
+            print(f'{standby_dirname}: not in systemd yet, falling back to a restart')
+        else:
+            print(f'{standby_dirname}: restarting...')
+            subprocess.check_call(['systemctl', 'restart', standby_dirname])
+            pending_switches.append((name, standby, port))
+            stats['restart'] = 'standby'
+            return
     # Write the new config always, in case names or other stuff changed
     print(f'{dirname}: writing new config')
     with open(dest, 'w') as f:
@@ -563,11 +965,165 @@ def make_conf(name, args, core=False, exts=False, skins=False, ooui=False,
                 subprocess.check_call(['systemctl', 'status', dirname])
             except subprocess.CalledProcessError:
                 print(f'{dirname}: not in systemd yet, skipping restart')
+                stats['restart'] = 'not_in_systemd'
                 return
             print(f'{dirname}: restarting...')
             subprocess.check_call(['systemctl', 'restart', dirname])
+            stats['restart'] = 'restarted'
         else:
             print(f'{dirname}: config unchanged, skipping restart')
+            stats['restart'] = 'unchanged'
+
+
+def _load_json(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+@functools.lru_cache()
+def ports() -> Dict[str, int]:
+    return _load_json('/etc/codesearch_ports.json')
+
+
+@functools.lru_cache()
+def standby_ports() -> Dict[str, int]:
+    return _load_json(CONFIG).get('STANDBY_PORTS', {})
+
+
+def slot_dirname(name: str, slot: str) -> str:
+    return f'hound-{name}-green' if slot == 'green' else f'hound-{name}'
+
+
+def active_slot(name: str) -> str:
+    """Which copy of an instance the proxy is sending traffic to"""
+    try:
+        with open(os.path.join(DATA, f'hound-{name}', 'active')) as f:
+            return 'green' if f.read().strip() == 'green' else 'blue'
+    except OSError:
+        return 'blue'
+
+
+def unit_exists(unit: str) -> bool:
+    """
+    Whether systemd knows about a unit. Unlike `systemctl status`, this is
+    true for stopped units, which standby copies normally are.
+    """
+    try:
+        output = subprocess.check_output(['systemctl', 'show', '-p', 'LoadState', '--value', unit], text=True)
+    except subprocess.CalledProcessError:
+        return False
+    return output.strip() == 'loaded'
+
+
+def unit_active_since(unit: str) -> Optional[float]:
+    """When a systemd unit was started, in time.monotonic() terms, or None if it isn't running"""
+    try:
+        output = subprocess.check_output(
+            ['systemctl', 'show', '-p', 'ActiveState', '-p', 'ActiveEnterTimestampMonotonic', unit], text=True)
+    except subprocess.CalledProcessError:
+        return None
+    show = dict(line.split('=', 1) for line in output.splitlines() if '=' in line)
+    if show.get('ActiveState') != 'active':
+        return None
+    # Both are CLOCK_MONOTONIC, systemd's in microseconds
+    return int(show.get('ActiveEnterTimestampMonotonic') or 0) / 1e6
+
+
+def hound_ready(port: int) -> bool:
+    try:
+        r = requests.get(f'http://localhost:{port}/api/v1/search', timeout=30)
+    except requests.exceptions.RequestException:
+        return False
+    return r.text != HOUND_STARTUP
+
+
+def switch_slot(name: str, slot: str):
+    """Point the proxy at the other copy, then stop the old one"""
+    old = slot_dirname(name, active_slot(name))
+    dest = os.path.join(DATA, f'hound-{name}', 'active')
+    with open(dest + '.tmp', 'w') as f:
+        f.write(slot + '\n')
+    # Atomic, so the proxy sees either the old or the new copy
+    os.replace(dest + '.tmp', dest)
+    print(f'hound-{name}: switched to {slot_dirname(name, slot)}')
+    time.sleep(SWITCH_GRACE)
+    subprocess.check_call(['systemctl', 'stop', old])
+
+
+def finish_switches(timeout: float, interval: float = 30):
+    """Wait for standby copies to finish indexing, and switch to them"""
+    deadline = time.monotonic() + timeout
+    while pending_switches:
+        for switch in list(pending_switches):
+            name, slot, port = switch
+            if hound_ready(port):
+                switch_slot(name, slot)
+                pending_switches.remove(switch)
+        if not pending_switches or time.monotonic() >= deadline:
+            break
+        time.sleep(interval)
+    for name, slot, _ in pending_switches:
+        print(f'{slot_dirname(name, slot)}: not ready after {timeout}s, '
+              f'leaving {slot_dirname(name, active_slot(name))} in service')
+    pending_switches.clear()
+
+
+RESTART_ACTIONS = ['restarted', 'standby', 'unchanged', 'not_in_systemd', 'disabled']
+
+
+def format_metrics(success: bool) -> str:
+    """This run's statistics in the Prometheus text format"""
+    text = """# HELP codesearch_write_config_success Whether the last config generation run finished
+# TYPE codesearch_write_config_success gauge
+codesearch_write_config_success %d
+# HELP codesearch_write_config_last_run_timestamp_seconds When config generation last ran
+# TYPE codesearch_write_config_last_run_timestamp_seconds gauge
+codesearch_write_config_last_run_timestamp_seconds %d
+""" % (success, time.time())
+    for metric, index, kind, help in (
+        ('source_seconds', 0, 'gauge', 'Time spent fetching repo lists and files, by source'),
+        ('source_requests', 1, 'gauge', 'HTTP requests made, by source'),
+        ('source_errors', 2, 'gauge', 'HTTP requests that failed, by source'),
+    ):
+        text += f'# HELP codesearch_write_config_{metric} {help}\n'
+        text += f'# TYPE codesearch_write_config_{metric} {kind}\n'
+        for source, counts in sorted(source_stats.items()):
+            text += f'codesearch_write_config_{metric}{{source="{source}"}} {round(counts[index], 3)}\n'
+    for metric, key, help in (
+        ('profile_seconds', 'seconds', 'Time taken to discover the repos of a profile'),
+        ('profile_repos', 'repos', 'Repos in a profile'),
+        ('profile_duplicates', 'duplicates', 'Repos dropped from a profile as duplicates'),
+    ):
+        text += f'# HELP codesearch_write_config_{metric} {help}\n'
+        text += f'# TYPE codesearch_write_config_{metric} gauge\n'
+        for profile, profile_info in sorted(profile_stats.items()):
+            text += f'codesearch_write_config_{metric}{{profile="{profile}"}} {round(profile_info[key], 3)}\n'
+    for metric, key, help in (
+        ('instance_repos', 'repos', 'Repos in the config written for a hound instance'),
+        ('urls_added', 'urls_added', 'Repo URLs in a new config that were not in the old one'),
+        ('urls_removed', 'urls_removed', 'Repo URLs in the old config that are not in the new one'),
+    ):
+        text += f'# HELP codesearch_write_config_{metric} {help}\n'
+        text += f'# TYPE codesearch_write_config_{metric} gauge\n'
+        for instance, info in sorted(instance_stats.items()):
+            text += f'codesearch_write_config_{metric}{{instance="{instance}"}} {info[key]}\n'
+    text += """# HELP codesearch_write_config_restart What was done about restarting a hound instance
+# TYPE codesearch_write_config_restart gauge
+"""
+    for instance, info in sorted(instance_stats.items()):
+        for action in RESTART_ACTIONS:
+            text += 'codesearch_write_config_restart{instance="%s",action="%s"} %d\n' % (
+                instance, action, info['restart'] == action)
+    return text
+
+
+def write_metrics(path: str, success: bool):
+    """Atomically replace the file read by the node exporter's textfile collector"""
+    with open(path + '.tmp', 'w') as f:
+        f.write(format_metrics(success))
+    os.replace(path + '.tmp', path)
 
 
 def extract_urls(conf) -> set:
@@ -579,41 +1135,89 @@ def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Generate hound configuration')
     parser.add_argument('--restart', help='Restart hound instances if necessary',
                         action='store_true')
+    parser.add_argument('--shards', help='Split the "search" profile across this many hound instances',
+                        type=int, default=1)
+    parser.add_argument('--metrics-file',
+                        help='Write statistics about this run here, for the Prometheus textfile collector')
+    parser.add_argument('--nodes', type=lambda value: [node for node in value.split(',') if node],
+                        help='Comma separated hosts to spread the hound instances over')
+    parser.add_argument('--node', default=socket.gethostname(),
+                        help='Which of the --nodes this is, its instances are written and restarted here')
+    parser.add_argument('--dedup-prefer', choices=sorted(DEDUP_RULES), default='gerrit',
+                        help='Which name to keep for a repo that is listed more than once')
+    parser.add_argument('--blue-green', action='store_true',
+                        help='With --restart, reindex in the standby copy of an instance (see STANDBY_PORTS) '
+                             'and switch to it once ready, instead of restarting the serving one')
+    parser.add_argument('--blue-green-timeout', type=float, default=60 * 60,
+                        help='Seconds to wait for standby copies to become ready, the next run '
+                             'picks up any that are still indexing')
+    parser.add_argument('--blue-green-refresh', type=float,
+                        help='With --blue-green, also reindex an unchanged instance in its standby '
+                             'copy once the serving one has run for this many seconds')
+    parser.add_argument('--index-report', action='store_true',
+                        help='Estimate the bytes that excluding generated and large files would save, '
+                             'per profile and repo, in index-report.json')
     return parser.parse_args(args=argv)
 
 
+def write_shards(shards: Dict[str, List[str]]):
+    """Tell the proxy which hound instances make up a sharded backend"""
+    dest = os.path.join(DATA, 'shards.json')
+    with open(dest + '.tmp', 'w') as f:
+        json.dump(shards, f, indent='\t')
+    os.replace(dest + '.tmp', dest)
+
+
+def write_directory():
+    """Tell the proxy which backends index each repo"""
+    dest = os.path.join(DATA, 'directory.json')
+    with open(dest + '.tmp', 'w') as f:
+        json.dump({'repos': repo_directory}, f, separators=(',', ':'))
+    os.replace(dest + '.tmp', dest)
+
+
 def main():
     args = parse_args()
+    success = False
+    try:
+        generate(args)
+        success = True
+    finally:
+        if args.metrics_file:
+            write_metrics(args.metrics_file, success)
+
+
+def generate(args):
     # "Search" profile should include everything unless there's a good reason
-    make_conf('search', args,
-              core=True,
-              exts=True,
-              skins=True,
-              ooui=True,
-              operations=True,
-              puppet=True,
-              twn=True,
-              milkshake=True,
-              pywikibot=True,
-              services=True,
-              libs=True,
-              analytics=True,
-              wmcs=True,
-              schemas=True,
-              devtools=True,
-              apps=True,
-              wdp=True,
-              # A dead codebase used by just one person
-              armchairgm=False,
-              # All of these should already be included via core/exts/skins
-              bundled=False,
-              # Avoiding upstream libraries; to reconsider, see T227704
-              vendor=False,
-              # All of these should already be included via core/exts/skins
-              wikimedia=False,
-              # Heavily duplicates MediaWiki core + extensions
-              shouthow=False,
-              )
+    search = make_conf('search', args, shards=args.shards,
+                       core=True,
+                       exts=True,
+                       skins=True,
+                       ooui=True,
+                       operations=True,
+                       puppet=True,
+                       twn=True,
+                       milkshake=True,
+                       pywikibot=True,
+                       services=True,
+                       libs=True,
+                       analytics=True,
+                       wmcs=True,
+                       schemas=True,
+                       devtools=True,
+                       apps=True,
+                       wdp=True,
+                       # A dead codebase used by just one person
+                       armchairgm=False,
+                       # All of these should already be included via core/exts/skins
+                       bundled=False,
+                       # Avoiding upstream libraries; to reconsider, see T227704
+                       vendor=False,
+                       # All of these should already be included via core/exts/skins
+                       wikimedia=False,
+                       # Heavily duplicates MediaWiki core + extensions
+                       shouthow=False,
+                       )
 
     make_conf('core', args, core=True)
     make_conf('pywikibot', args, pywikibot=True)
@@ -635,6 +1239,17 @@ def main():
     make_conf('devtools', args, devtools=True)
     make_conf('apps', args, apps=True)
 
+    if args.nodes:
+        place_instances(args)
+    elif os.path.exists(os.path.join(DATA, 'placement.json')):
+        # Everything is on this host again
+        os.unlink(os.path.join(DATA, 'placement.json'))
+    write_shards({'search': search} if len(search) > 1 else {})
+    write_directory()
+    if args.index_report:
+        write_index_report()
+    finish_switches(args.blue_green_timeout)
+
 
 if __name__ == '__main__':
     main()